@@ -17,25 +17,33 @@ sys.path.append(py_dir)
 import sys,basic
 from RSImage import RSImageclass
 import math
+import threading
+import warnings
+from functools import lru_cache
 
+import numpy as np
+from pyproj import CRS, Transformer
+from pyproj.enums import WktVersion
 
 import io_function
 
+# the CRS of files, key: (absolute path, modified time, size), value: (pyproj CRS, wkt), None if no CRS
+_file_crs_cache = {}
+_file_crs_lock = threading.Lock()
+
 def wkt_to_proj4(wkt):
-    srs = osr.SpatialReference()
-    srs.importFromWkt(wkt)
-    proj4 = srs.ExportToProj4()
-    if proj4 is False:
-        basic.outputlogMessage('convert wkt to proj4 failed')
+    try:
+        proj4 = crs_to_string(CRS.from_wkt(wkt), 'proj4')
+    except Exception as e:
+        basic.outputlogMessage('convert wkt to proj4 failed: %s' % str(e))
         return False
     return proj4
 
 def proj4_to_wkt(proj4):
-    srs = osr.SpatialReference()
-    srs.ImportFromProj4(proj4)
-    wkt = srs.ExportToWkt()
-    if wkt is False:
-        basic.outputlogMessage('convert wkt to proj4 failed')
+    try:
+        wkt = crs_to_string(CRS.from_proj4(proj4), 'wkt')
+    except Exception as e:
+        basic.outputlogMessage('convert proj4 to wkt failed: %s' % str(e))
         return False
     return wkt
 
@@ -93,14 +101,52 @@ def convert_pixel_xy_to_map_coordinate(pixel_x,pixel_y,ref_image):
 
 
 
+def to_srs_input(srs):
+    # to the input (hashable) of CRS.from_user_input, accept osr SpatialReference too
+    if hasattr(srs, 'ExportToWkt'):
+        return srs.ExportToWkt()
+    if isinstance(srs, CRS):
+        return srs.to_wkt()
+    return srs
+
+@lru_cache(maxsize=256)
+def get_transformer(in_srs, out_srs):
+    '''
+    get a Transformer (cached), x is longitude (easting) and y is latitude (northing) for all SRS
+    Args:
+        in_srs: old SRS: wkt, proj4, "EPSG:n", or epsg code (int)
+        out_srs: new SRS
+
+    Returns: pyproj Transformer
+
+    '''
+    return Transformer.from_crs(CRS.from_user_input(in_srs), CRS.from_user_input(out_srs), always_xy=True)
+
+def transform_points(input_x, input_y, in_srs, out_srs):
+    '''
+    convert points coordinate from old SRS to new SRS, all points at once
+    Args:
+        input_x: points x, list or numpy array
+        input_y: points y, list or numpy array
+        in_srs: old SRS: wkt, proj4, "EPSG:n", epsg code (int), or CRS object
+        out_srs: new SRS
+
+    Returns: numpy array of x, numpy array of y
+
+    '''
+    transformer = get_transformer(to_srs_input(in_srs), to_srs_input(out_srs))
+    x_out, y_out = transformer.transform(np.asarray(input_x, dtype=np.float64),
+                                         np.asarray(input_y, dtype=np.float64))
+    return np.asarray(x_out), np.asarray(y_out)
+
 def convert_points_SpatialRef(input_x,input_y,inSpatialRef,outSpatialRef):
     """
     convert points coordinate from old SRS to new SRS
     Args:
-        input_x:input points x, list type
-        input_y:input points y, list type
-        inSpatialRef: object of old SpatialReference
-        outSpatialRef:object of new SpatialReference
+        input_x:input points x, list type (or numpy array), the new x are saved into it
+        input_y:input points y, list type (or numpy array), the new y are saved into it
+        inSpatialRef: old SRS (wkt, proj4, epsg code, CRS or osr SpatialReference)
+        outSpatialRef: new SRS
 
     Returns:True is successful, False Otherwise
 
@@ -113,39 +159,21 @@ def convert_points_SpatialRef(input_x,input_y,inSpatialRef,outSpatialRef):
         basic.outputlogMessage('the count of input x less than 1')
         return False
 
-    coordTransform = osr.CoordinateTransformation(inSpatialRef, outSpatialRef)
-    # print coordTransform
-    # start = time.time()
-    for i in range(0,ncount):
-        # pointX = input_x[i]
-        # pointY = input_y[i]
-        point = ogr.Geometry(ogr.wkbPoint)
-        point.AddPoint(input_x[i], input_y[i])
-        # transform point
-        point.Transform(coordTransform)
-        input_x[i] = point.GetX()
-        input_y[i] = point.GetY()
-    # end = time.time()
-    # cost = end - start #time in second
-    # print cost
+    try:
+        x_out, y_out = transform_points(input_x, input_y, inSpatialRef, outSpatialRef)
+    except Exception as e:
+        basic.outputlogMessage('convert points coordinate failed: %s' % str(e))
+        return False
+    input_x[:] = x_out.tolist()
+    input_y[:] = y_out.tolist()
 
     return True
 
 def convert_points_coordinate_proj4(input_x,input_y,in_proj4, out_proj4):
-    inSpatialRef = osr.SpatialReference()
-    # inSpatialRef.ImportFromEPSG(inputEPSG)
-    inSpatialRef.ImportFromProj4(in_proj4)
-    outSpatialRef = osr.SpatialReference()
-    # outSpatialRef.ImportFromEPSG(outputEPSG)
-    outSpatialRef.ImportFromProj4(out_proj4)
-    return convert_points_SpatialRef(input_x,input_y,inSpatialRef,outSpatialRef)
+    return convert_points_SpatialRef(input_x,input_y,in_proj4,out_proj4)
 
 def convert_points_coordinate_epsg(input_x,input_y,in_epsg, out_epsg):
-    inSpatialRef = osr.SpatialReference()
-    inSpatialRef.ImportFromEPSG(in_epsg)
-    outSpatialRef = osr.SpatialReference()
-    outSpatialRef.ImportFromEPSG(out_epsg)
-    return convert_points_SpatialRef(input_x,input_y,inSpatialRef,outSpatialRef)
+    return convert_points_SpatialRef(input_x,input_y,int(in_epsg),int(out_epsg))
 
 def  convert_points_coordinate(input_x,input_y,inwkt, outwkt ):
     """
@@ -159,46 +187,103 @@ def  convert_points_coordinate(input_x,input_y,inwkt, outwkt ):
     Returns: True is successful, False Otherwise
 
     """
-    # if (isinstance(input_x,list) is False) or (isinstance(input_y,list) is False):
-    #     syslog.outputlogMessage('input x or y type error')
-    #     return False
-    # create coordinate transformation
-    inSpatialRef = osr.SpatialReference()
-    # inSpatialRef.ImportFromEPSG(inputEPSG)
-    inSpatialRef.ImportFromWkt(inwkt)
-    outSpatialRef = osr.SpatialReference()
-    # outSpatialRef.ImportFromEPSG(outputEPSG)
-    outSpatialRef.ImportFromWkt(outwkt)
-    return convert_points_SpatialRef(input_x,input_y,inSpatialRef,outSpatialRef)
+    return convert_points_SpatialRef(input_x,input_y,inwkt,outwkt)
+
+def read_srs_wkt_of_file(spatial_data):
+    # read the wkt of a raster (rasterio) or vector (fiona) file, None if it does not have a projection
+    import rasterio
+    from rasterio.errors import RasterioIOError
+    try:
+        with rasterio.open(spatial_data) as src:
+            return None if src.crs is None else src.crs.to_wkt()
+    except RasterioIOError:
+        pass    # not a raster
+    import fiona
+    with fiona.open(spatial_data) as src:
+        return src.crs_wkt if src.crs_wkt else None
+
+def get_file_crs(spatial_data):
+    '''
+    get the CRS of a raster or vector file, in the same process (no gdalsrsinfo), cached by path and modified time
+    Args:
+        spatial_data: the path of raster or vector data
+
+    Returns: (pyproj CRS, wkt), (None, None) if it does not have a projection
+
+    '''
+    stat = os.stat(spatial_data)
+    key = (os.path.abspath(spatial_data), stat.st_mtime_ns, stat.st_size)
+    with _file_crs_lock:
+        if key in _file_crs_cache:
+            return _file_crs_cache[key]
+    wkt = read_srs_wkt_of_file(spatial_data)
+    crs = None if wkt is None else CRS.from_wkt(wkt)
+    res = (crs, None if crs is None else crs.to_wkt())
+    with _file_crs_lock:
+        _file_crs_cache[key] = res
+    return res
+
+def crs_to_string(crs, format):
+    # convert a pyproj CRS to a string, in the format (proj4, wkt, epsg) the same as the output of gdalsrsinfo
+    if format == 'proj4':
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')     # warning of losing information in proj4
+            proj4 = crs.to_proj4()
+        return proj4.replace(' +type=crs', '').strip()
+    elif format in ['wkt', 'wkt1']:
+        return crs.to_wkt(WktVersion.WKT1_GDAL)
+    elif format == 'wkt2':
+        return crs.to_wkt(WktVersion.WKT2_2019)
+    elif format == 'epsg':
+        epsg = crs.to_epsg()
+        return False if epsg is None else 'EPSG:%d' % epsg
+    else:
+        raise ValueError('Unknown format: %s' % str(format))
+
+@lru_cache(maxsize=1024)
+def is_same_crs_wkt(wkt1, wkt2):
+    # compare two SRS (wkt), the result is cached
+    if wkt1 == wkt2:
+        return True
+    return CRS.from_wkt(wkt1).equals(CRS.from_wkt(wkt2), ignore_axis_order=True)
+
+def is_same_projection(spatial_data1, spatial_data2):
+    '''
+    check two raster or vector files have the same projection
+    Args:
+        spatial_data1: the path of raster or vector data
+        spatial_data2: the path of raster or vector data
+
+    Returns: True if the same, False otherwise
+
+    '''
+    _, wkt1 = get_file_crs(spatial_data1)
+    _, wkt2 = get_file_crs(spatial_data2)
+    if wkt1 is None or wkt2 is None:
+        return wkt1 is None and wkt2 is None
+    return is_same_crs_wkt(wkt1, wkt2)
 
 def get_raster_or_vector_srs_info(spatial_data,format):
     """
     get SRS(Spatial Reference System) information from raster or vector data
     Args:
         spatial_data: the path of raster or vector data
-        format: Any of the usual GDAL/OGR forms(complete WKT, PROJ.4, EPSG:n or a file containing the SRS)
+        format: proj4, wkt (wkt1), wkt2, or epsg, the output format is the same as gdalsrsinfo
 
     Returns:the string of srs info in special format, False otherwise
 
     """
     if io_function.is_file_exist(spatial_data) is False:
         return False
-    CommandString = 'gdalsrsinfo -o  '+ format +' '+  spatial_data
-    result = basic.exec_command_string_output_string(CommandString)
-    if result.find('ERROR') >=0:
+    # read in the same process, instead of running gdalsrsinfo
+    try:
+        crs, _ = get_file_crs(spatial_data)
+    except Exception as e:
+        basic.outputlogMessage('failed to get the projection of %s: %s' % (spatial_data, str(e)))
+        return False
+    if crs is None:
         return False
-    if result.find('Confidence') >= 0:  # new GDAL, with
-        print(result)
-        tmp = result.split('\n')
-        for aa in tmp:
-            if aa.find('Confidence') >= 0:
-                continue
-            if len(aa) > 2:
-                result = aa
-                break
-    result = result.strip()
-
-    return result
+    return crs_to_string(crs, format)
 
 def get_raster_or_vector_srs_info_wkt(spatial_data):
     """
@@ -311,12 +396,6 @@ def meters_to_degrees_onEarth(distance):
 
 if __name__=='__main__':
 
-    # solve this by "conda install gdal -c conda-forge"
-    try:
-        from osgeo import ogr, osr, gdal
-    except:
-        raise IOError('ERROR: cannot find GDAL/OGR modules')
-
     length = len(sys.argv)
     if length == 6:
         rasterfile = sys.argv[1]
@@ -24,6 +24,7 @@ import cv2
 from basic_src.RSImage import RSImageclass
 import basic_src.basic as  basic
 import split_image
+import raster_io
 import rasterio
 import numpy as np
 import parameters
@@ -170,7 +171,8 @@ def read_patch(patch_obj):
     # window structure; expecting ((row_start, row_stop), (col_start, col_stop))
     boundary = patch_obj.boundary #(xoff,yoff ,xsize, ysize)
     window = ((boundary[1],boundary[1]+boundary[3])  ,  (boundary[0],boundary[0]+boundary[2]))
-    with rasterio.open(patch_obj.org_img) as img_obj:
+    # the image is opened once and kept in the pool, not opened for each patch
+    with raster_io.open_raster_pooled(patch_obj.org_img) as img_obj:
         # read the all bands
         indexes = img_obj.indexes
         data = img_obj.read(indexes,window=window)
@@ -489,6 +491,32 @@ def split_patches_into_batches(patches, batch_size):
     return batches
 
 
+def split_patches_into_batches_by_size(patches, batch_size):
+    """
+    split the patches of an image to many small group (batch). Different from split_patches_into_batches,
+    all the patches with the same width and height are grouped together (not only the neighbouring ones), so the
+    batches are full except the last one of each size, and the patches in each batch can be stacked.
+    :param patches: a 1-d list of patches
+    :param batch_size: batch_size, e.g., 4, or 5 depends on the GPU memory
+    :return: a 2D list, contains all the groups, each item is (index of the patch in the input list, patch)
+    """
+    assert batch_size > 0
+
+    # group patches based on size, each boundary is (xoff,yoff ,xsize, ysize)
+    patch_groups = {}
+    for idx, patch_obj in enumerate(patches):
+        wh_key = (patch_obj.boundary[2], patch_obj.boundary[3])
+        patch_groups.setdefault(wh_key, []).append((idx, patch_obj))
+
+    batches = []
+    for wh_key in patch_groups.keys():
+        patches_sameSize = patch_groups[wh_key]
+        for start in range(0, len(patches_sameSize), batch_size):
+            batches.append(patches_sameSize[start:start + batch_size])
+
+    return batches
+
+
 def check_input_image_and_label(image_path, label_path):
     """
     check the input image and label, they should have same width, height, and projection
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# Filename: detection_results.py
+"""
+introduction: save the detected objects (boxes) of all the patches of an image into one columnar file
+(a structured numpy array, .npy), instead of one json file per patch. Each row is an object, the columns are:
+patch_idx, class_id, name, xmin, ymin, xmax, ymax (pixel, in the entire image), and confidence.
+
+authors: Huang Lingcao
+email:huanglingcao@gmail.com
+add time: 18 October, 2026
+"""
+
+import os
+
+import numpy as np
+
+result_file_name = 'detections.npy'
+
+
+def get_detection_result_path(save_dir):
+    return os.path.join(save_dir, result_file_name)
+
+
+class DetectionBuffer(object):
+    """
+    collect the detected objects of patches in memory, then save them to a file once
+    """
+
+    def __init__(self, class_names):
+        """
+        :param class_names: a list of class names, the name of an object is class_names[class_id]
+        """
+        self.class_names = list(class_names)
+        self.patch_idx = []
+        self.class_id = []
+        self.bbox = []
+        self.confidence = []
+
+    def add(self, patch_idx, class_id_list, bbox_list, confidence_list):
+        '''
+        add the objects of a patch
+        :param patch_idx: the index of the patch
+        :param class_id_list: a list of class ids
+        :param bbox_list: a list of bbox: [xmin, ymin, xmax, ymax] (pixel, in the entire image)
+        :param confidence_list: a list of confidence
+        :return:
+        '''
+        if len(class_id_list) != len(bbox_list) or len(class_id_list) != len(confidence_list):
+            raise ValueError('the count of class ids (%d), boxes (%d), and confidences (%d) are different' %
+                             (len(class_id_list), len(bbox_list), len(confidence_list)))
+        self.patch_idx.extend([patch_idx] * len(class_id_list))
+        self.class_id.extend(class_id_list)
+        self.bbox.extend(bbox_list)
+        self.confidence.extend(confidence_list)
+
+    def __len__(self):
+        return len(self.class_id)
+
+    def to_array(self):
+        # to a structured array
+        name_len = max([len(item) for item in self.class_names] + [1])
+        dtype = [('patch_idx', np.int32), ('class_id', np.int32), ('name', 'U%d' % name_len),
+                 ('xmin', np.float64), ('ymin', np.float64), ('xmax', np.float64), ('ymax', np.float64),
+                 ('confidence', np.float32)]
+        res = np.zeros(len(self.class_id), dtype=dtype)
+        if len(self.class_id) < 1:
+            return res
+        bbox = np.asarray(self.bbox, dtype=np.float64).reshape(-1, 4)
+        res['patch_idx'] = self.patch_idx
+        res['class_id'] = self.class_id
+        res['name'] = np.array(self.class_names, dtype=object)[np.asarray(self.class_id, dtype=np.int64)]
+        res['xmin'], res['ymin'], res['xmax'], res['ymax'] = bbox[:, 0], bbox[:, 1], bbox[:, 2], bbox[:, 3]
+        res['confidence'] = self.confidence
+        return res
+
+    def save(self, save_path):
+        '''
+        save all the objects to a .npy file (written to a temporary file, then renamed)
+        :param save_path: the output path
+        :return: the count of objects
+        '''
+        res = self.to_array()
+        tmp_path = save_path + '.tmp.npy'
+        np.save(tmp_path, res)
+        os.replace(tmp_path, save_path)
+        print('saved %d detected objects to %s' % (len(res), save_path))
+        return len(res)
+
+
+def read_detection_results(res_path):
+    '''
+    read the detected objects saved by DetectionBuffer
+    :param res_path: the .npy file
+    :return: class_id (N,), name (N,), confidence (N,), boxes (N, 4) (xmin, ymin, xmax, ymax in pixel)
+    '''
+    res = np.load(res_path)
+    boxes = np.stack([res['xmin'], res['ymin'], res['xmax'], res['ymax']], axis=1).astype(np.float64)
+    return res['class_id'], res['name'].astype(object), res['confidence'].astype(np.float64), boxes
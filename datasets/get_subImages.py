@@ -42,18 +42,16 @@ from vector_gpd import get_poly_index_within_extent
 
 import shutil
 
-def get_image_tile_bound_boxes(image_tile_list):
+def get_image_tile_bound_boxes(image_tile_list, thread_num=16):
     '''
     get extent of all the images
     :param image_tile_list:  a list containing all the image path
+    :param thread_num: the number of threads for reading the metadata of images (if not cached)
     :return:  a list of boxes
     '''
-    boxes = []
-    for image_path in image_tile_list:
-        with rasterio.open(image_path) as src:
-            # the extent of the raster
-            raster_bounds = src.bounds
-            boxes.append(raster_bounds)
+    raster_io.prefetch_raster_metadata(image_tile_list, thread_num=thread_num)
+    # the extent of the raster
+    boxes = [raster_io.get_image_bound_box(image_path) for image_path in image_tile_list]
 
     return boxes
 
@@ -159,6 +157,14 @@ def get_projection_proj4(geo_file):
         raise ValueError('Failed to get the projection of %s'%geo_file)
     return proj4
 
+def is_same_projection(geo_file1, geo_file2):
+    '''
+    check two files (shape file or raster file) have the same projection, comparing the SRS objects
+    (the result is cached), not the proj4 strings
+    '''
+    import basic_src.map_projection as map_projection
+    return map_projection.is_same_projection(geo_file1, geo_file2)
+
 def get_bounds_of_polygons(polygons):
     '''
     Return a (left, bottom, right, top) bounding box for several polygons
@@ -646,7 +652,7 @@ def main(options, args):
                                'it will consider the one in input argument is the full set of training polygons')
         t_polygons_shp_all = t_polygons_shp
     else:
-        if get_projection_proj4(t_polygons_shp) != get_projection_proj4(t_polygons_shp_all):
+        if is_same_projection(t_polygons_shp, t_polygons_shp_all) is False:
             raise ValueError('error, projection insistence between %s and %s'%(t_polygons_shp, t_polygons_shp_all))
     assert io_function.is_file_exist(t_polygons_shp_all)
 
@@ -656,13 +662,16 @@ def main(options, args):
     if len(image_tile_list) < 1:
         raise IOError('error, failed to get image tiles in folder %s'%image_folder)
 
+    # read the metadata of all tiles once (in parallel), the following checks and sub-image extraction use the cache
+    raster_io.prefetch_raster_metadata(image_tile_list, thread_num=max(process_num, 16),
+                                       sidecar_json=options.raster_meta_json)
     check_projection_rasters(image_tile_list)   # it will raise errors if found problems
 
     # comment out on June 18, 2021,
     # check_1or3band_8bit(image_tile_list)  # it will raise errors if found problems
 
     #need to check: the shape file and raster should have the same projection.
-    if get_projection_proj4(t_polygons_shp) != get_projection_proj4(image_tile_list[0]):
+    if is_same_projection(t_polygons_shp, image_tile_list[0]) is False:
         raise ValueError('error, the input raster (e.g., %s) and vector (%s) files don\'t have the same projection'%(image_tile_list[0],t_polygons_shp))
 
     # check these are EPSG:4326 projection
@@ -731,6 +740,9 @@ if __name__ == "__main__":
     parser.add_option("-k", "--b_keep_grid_name",
                       action="store_true", dest="b_keep_grid_name",default=False,
                       help="if set, the file name of sub-images will contain grid info from orignal images")
+    parser.add_option("-j", "--raster_meta_json",
+                      action="store", dest="raster_meta_json",
+                      help="a json file for caching the metadata of image tiles, re-used in the next run")
 
 
     (options, args) = parser.parse_args()
@@ -167,7 +167,7 @@ def get_sub_images_pixel_json_files(polygons_shp,image_folder_or_path,image_patt
     get_subImages.check_1or3band_8bit(image_tile_list)  # it will raise errors if found problems
 
     # need to check: the shape file and raster should have the same projection.
-    if get_subImages.get_projection_proj4(polygons_shp) != get_subImages.get_projection_proj4(image_tile_list[0]):
+    if get_subImages.is_same_projection(polygons_shp, image_tile_list[0]) is False:
         raise ValueError('error, the input raster (e.g., %s) and vector (%s) files don\'t have the same projection' % (
         image_tile_list[0], polygons_shp))
 
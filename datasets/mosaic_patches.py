@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+# Filename: mosaic_patches.py
+"""
+introduction: write the prediction results of many patches into one full-scene raster,
+instead of saving each patch as a small file and merging them using gdal_merge.py
+
+authors: Huang Lingcao
+email:huanglingcao@gmail.com
+add time: 18 October, 2026
+"""
+
+import os
+import threading
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+# the overlap policies supported by PatchMosaic
+# linear and cosine: blend the logits (or class probabilities) of overlapping patches using linear or cosine weights
+blend_methods = ['linear', 'cosine']
+overlap_policies = ['centre_crop', 'max', 'vote'] + blend_methods
+
+
+def _get_core_cuts(offsets, sizes, image_len):
+    # the cuts between adjacent columns (or rows) of patches, and the column (or row) index of each patch
+    centre_x2 = offsets * 2 + sizes  # use two times of the centre to keep integers
+    unique_x2 = np.unique(centre_x2)
+    idx = np.searchsorted(unique_x2, centre_x2)
+    # the start and end of each column of patches
+    starts = np.full(unique_x2.size, np.iinfo(np.int64).max, dtype=np.int64)
+    ends = np.zeros(unique_x2.size, dtype=np.int64)
+    np.minimum.at(starts, idx, offsets)
+    np.maximum.at(ends, idx, offsets + sizes)
+    # cut in the middle of the centres, but inside the overlap of the two columns,
+    # otherwise the cores leave gaps when adjacent patches have different sizes
+    mid = (unique_x2[:-1] + unique_x2[1:]) // 4
+    cuts = np.minimum(np.maximum(mid, starts[1:]), ends[:-1])
+    cuts = np.maximum.accumulate(np.concatenate(([0], cuts, [image_len])))
+    return cuts, idx
+
+def get_patch_core_boundaries(patch_boundaries, image_width, image_height):
+    """
+    get the core (non-overlapping) region of each patch. The boundary between two adjacent patches is in the
+    middle of their centres (limited to their overlap), so the core regions of all the patches cover the
+    region of patches without overlap and gaps.
+    :param patch_boundaries: a list or (N,4) array of patch boundary (xoff,yoff ,xsize, ysize)
+    :param image_width: width of the entire image
+    :param image_height: height of the entire image
+    :return: (N,4) array of the core boundary (xoff,yoff ,xsize, ysize) of each patch
+    """
+    boundaries = np.asarray(patch_boundaries, dtype=np.int64).reshape(-1, 4)
+    if len(boundaries) < 1:
+        return boundaries.copy()
+    cut_x, col_idx = _get_core_cuts(boundaries[:, 0], boundaries[:, 2], image_width)
+    cut_y, row_idx = _get_core_cuts(boundaries[:, 1], boundaries[:, 3], image_height)
+
+    # make sure the core is inside the patch
+    core_x0 = np.maximum(cut_x[col_idx], boundaries[:, 0])
+    core_x1 = np.maximum(np.minimum(cut_x[col_idx + 1], boundaries[:, 0] + boundaries[:, 2]), core_x0)
+    core_y0 = np.maximum(cut_y[row_idx], boundaries[:, 1])
+    core_y1 = np.maximum(np.minimum(cut_y[row_idx + 1], boundaries[:, 1] + boundaries[:, 3]), core_y0)
+    cores = np.stack([core_x0, core_y0, core_x1 - core_x0, core_y1 - core_y0], axis=1)
+
+    if is_cores_tile_patches(boundaries, cores) is False:
+        raise ValueError('the core regions do not cover the patches exactly (gaps or overlaps)')
+    return cores
+
+def is_cores_tile_patches(patch_boundaries, core_boundaries):
+    """
+    check that the cores cover every pixel of the patches (the entire image if patches cover it) exactly once
+    :param patch_boundaries: (N,4) patch boundaries (xoff,yoff ,xsize, ysize)
+    :param core_boundaries: (N,4) core boundaries (xoff,yoff ,xsize, ysize)
+    :return: True or False
+    """
+    boundaries = np.unique(np.asarray(patch_boundaries, dtype=np.int64).reshape(-1, 4), axis=0)
+    # identical patches have identical cores, only count them once
+    cores = np.unique(np.asarray(core_boundaries, dtype=np.int64).reshape(-1, 4), axis=0)
+    cores = cores[(cores[:, 2] > 0) & (cores[:, 3] > 0)]
+    # check on the grid formed by all the edges of patches and cores
+    xs = np.unique(np.concatenate([boundaries[:, 0], boundaries[:, 0] + boundaries[:, 2],
+                                   cores[:, 0], cores[:, 0] + cores[:, 2]]))
+    ys = np.unique(np.concatenate([boundaries[:, 1], boundaries[:, 1] + boundaries[:, 3],
+                                   cores[:, 1], cores[:, 1] + cores[:, 3]]))
+    patch_cover = np.zeros((max(ys.size - 1, 0), max(xs.size - 1, 0)), dtype=bool)
+    core_count = np.zeros(patch_cover.shape, dtype=np.int32)
+    for (x0, y0, w, h), cover in [(item, None) for item in boundaries] + [(item, 1) for item in cores]:
+        c0, c1 = np.searchsorted(xs, [x0, x0 + w])
+        r0, r1 = np.searchsorted(ys, [y0, y0 + h])
+        if cover is None:
+            patch_cover[r0:r1, c0:c1] = True
+        else:
+            core_count[r0:r1, c0:c1] += 1
+    return bool(np.all(core_count == patch_cover.astype(np.int32)))
+
+
+def get_patch_core_dict(patch_boundaries, image_width, image_height):
+    """
+    get a dict for looking up the core boundary of a patch
+    :param patch_boundaries: a list or (N,4) array of patch boundary (xoff,yoff ,xsize, ysize)
+    :param image_width: width of the entire image
+    :param image_height: height of the entire image
+    :return: dict, key: tuple of patch boundary, value: tuple of the core boundary
+    """
+    core_boundaries = get_patch_core_boundaries(patch_boundaries, image_width, image_height)
+    core_dict = {}
+    for boundary, core in zip(patch_boundaries, core_boundaries):
+        core_dict[tuple(int(item) for item in boundary)] = tuple(int(item) for item in core)
+    return core_dict
+
+
+def crop_patches_to_core(batch_data, patch_boundaries, core_boundaries):
+    """
+    crop a batch of patches to their core regions
+    :param batch_data: a list or an array of patch data, the last two dimensions are height and width
+    :param patch_boundaries: (N,4) patch boundaries (xoff,yoff ,xsize, ysize)
+    :param core_boundaries: (N,4) core boundaries (xoff,yoff ,xsize, ysize)
+    :return: a list of the cropped data (views of the input, not copies)
+    """
+    boundaries = np.asarray(patch_boundaries, dtype=np.int64).reshape(-1, 4)
+    cores = np.asarray(core_boundaries, dtype=np.int64).reshape(-1, 4)
+    if len(batch_data) != len(boundaries) or len(cores) != len(boundaries):
+        raise ValueError('the count of patches (%d), patch boundaries (%d) and core boundaries (%d) are different'
+                         % (len(batch_data), len(boundaries), len(cores)))
+    # the offsets of the cores inside the patches
+    col_s = cores[:, 0] - boundaries[:, 0]
+    row_s = cores[:, 1] - boundaries[:, 1]
+    col_e = col_s + cores[:, 2]
+    row_e = row_s + cores[:, 3]
+    return [data[..., r0:r1, c0:c1] for data, r0, r1, c0, c1 in zip(batch_data, row_s, row_e, col_s, col_e)]
+
+
+def get_blending_weights(patch_boundaries, core_boundaries, method='cosine'):
+    """
+    get the weights for blending the overlapping patches. For a patch, the weight is 1 inside its core, and decreases
+    from the core to the patch edge touching other patches. Weights of two adjacent patches are equal at the boundary
+    between their cores. The patch edge at the image edge is not decreased.
+    :param patch_boundaries: (N,4) patch boundaries (xoff,yoff ,xsize, ysize)
+    :param core_boundaries: (N,4) core boundaries (xoff,yoff ,xsize, ysize)
+    :param method: linear or cosine
+    :return: (N, max_height, max_width) float32 array, the weight of patch i is weights[i, :ysize, :xsize]
+    """
+    if method not in blend_methods:
+        raise ValueError('unknown blending method: %s, should be one of %s' % (method, str(blend_methods)))
+    boundaries = np.asarray(patch_boundaries, dtype=np.int64).reshape(-1, 4)
+    cores = np.asarray(core_boundaries, dtype=np.int64).reshape(-1, 4)
+
+    def _weights_1d(offset, size, core_offset, core_size):
+        # the margins between the core and the patch edge
+        margin_s = (core_offset - offset)[:, None].astype(np.float32)
+        margin_e = ((offset + size) - (core_offset + core_size))[:, None].astype(np.float32)
+        pos = np.arange(size.max(), dtype=np.float32)[None, :] + 0.5
+        # the overlap width is about two times of the margin, weights reach 0.5 at the core boundary
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ramp_s = np.where(margin_s > 0, pos / (2 * margin_s), 1.0)
+            ramp_e = np.where(margin_e > 0, (size[:, None] - pos) / (2 * margin_e), 1.0)
+        ramp = np.clip(np.minimum(ramp_s, ramp_e), 0, 1)
+        if method == 'cosine':
+            ramp = 0.5 - 0.5 * np.cos(np.pi * ramp)
+        return ramp.astype(np.float32)
+
+    weight_x = _weights_1d(boundaries[:, 0], boundaries[:, 2], cores[:, 0], cores[:, 2])
+    weight_y = _weights_1d(boundaries[:, 1], boundaries[:, 3], cores[:, 1], cores[:, 3])
+    # avoid zero weights, which make pixels only covered by one patch invalid
+    return np.maximum(weight_y[:, :, None] * weight_x[:, None, :], 1e-6)
+
+
+def seg_maps_to_one_hot(seg_maps, num_classes):
+    """
+    convert class maps to one-hot (for blending if logits are not available)
+    :param seg_maps: (N, height, width) class maps
+    :param num_classes: class count, including background
+    :return: (N, num_classes, height, width) float32 array
+    """
+    seg_maps = np.asarray(seg_maps)
+    return (seg_maps[:, None, :, :] == np.arange(num_classes).reshape(1, -1, 1, 1)).astype(np.float32)
+
+
+class PatchMosaic(object):
+    """
+    write the prediction (one band, 8 bit) of patches into one full-scene raster (tiled and compressed GeoTIFF).
+    Patches are written into an uncompressed scratch raster opened once in "r+" mode, the mosaic is written from it
+    when closing. The overlap regions between patches are resolved by a policy:
+        centre_crop: only keep the core (non-overlapping) region of each patch
+        max: keep the maximum value of the overlapping patches
+        vote: keep the class predicted by most of the overlapping patches
+        linear, cosine: accumulate the logits of overlapping patches with linear or cosine weights, then take argmax
+    """
+
+    def __init__(self, ref_raster, save_path, patch_boundaries=None, policy='centre_crop', num_classes=2,
+                 nodata=0, compress='lzw', block_size=256):
+        if policy not in overlap_policies:
+            raise ValueError('unknown overlap policy: %s, should be one of %s' % (policy, str(overlap_policies)))
+        if (policy == 'centre_crop' or policy in blend_methods) and patch_boundaries is None:
+            raise ValueError('patch_boundaries is required for the %s policy' % policy)
+
+        self.save_path = save_path
+        self.policy = policy
+        self.num_classes = num_classes
+        self.nodata = nodata
+        self.lock = threading.Lock()
+
+        with rasterio.open(ref_raster) as src:
+            profile = src.profile
+            self.width = src.width
+            self.height = src.height
+        profile.update(driver='GTiff', count=1, dtype=rasterio.uint8, nodata=nodata, tiled=True,
+                       blockxsize=block_size, blockysize=block_size, compress=compress, bigtiff='IF_SAFER')
+        # remove the setting of the reference raster which does not fit one band 8 bit raster
+        for key in ['photometric', 'interleave']:
+            profile.pop(key, None)
+
+        self.core_dict = {}
+        if patch_boundaries is not None:
+            self.core_dict = get_patch_core_dict(patch_boundaries, self.width, self.height)
+
+        # patches are written into an uncompressed scratch raster (opened in "r+" mode), rewriting blocks of a
+        # compressed GeoTIFF appends new blocks and the file keeps growing.
+        # for centre_crop and max, save the class of each pixel,
+        # for voting, save the count of each class, for blending, save the weighted sum of logits of each class
+        # and the sum of weights (last band)
+        self.profile = profile
+        scratch_profile = profile.copy()
+        scratch_profile.pop('compress', None)
+        self.scratch_path = save_path + '.scratch.tmp'
+        if policy == 'vote':
+            scratch_profile.update(count=num_classes, nodata=None)
+        elif policy in blend_methods:
+            scratch_profile.update(count=num_classes + 1, dtype=rasterio.float32, nodata=None)
+        # temporary files (not match I0_*.tif, not merged by postProcess.py), the mosaic is written to save_path
+        # when closing, then an interrupted mosaic is not used as the result
+        with rasterio.open(self.scratch_path, 'w', **scratch_profile):
+            pass
+        self.scratch_dst = rasterio.open(self.scratch_path, 'r+')
+        self.tmp_path = save_path + '.tmp'
+
+    def write_patch(self, boundary, seg_map):
+        """
+        write the prediction of a patch into the mosaic
+        :param boundary: the patch boundary (xoff,yoff ,xsize, ysize)
+        :param seg_map: 2D array, the prediction of the patch (or 3D logits for the linear and cosine policies)
+        :return: True
+        """
+        if self.policy in blend_methods:
+            return self.write_batch([boundary], seg_map[None, ...])
+        if seg_map.shape != (boundary[3], boundary[2]):
+            raise ValueError("Error, the Size of the saved numpy array is different from the original patch,"
+                             " expected (%d, %d), but get (%d, %d)" % (boundary[2], boundary[3],
+                                                                       seg_map.shape[1], seg_map.shape[0]))
+        seg_map = seg_map.astype(np.uint8)
+        with self.lock:
+            if self.policy == 'centre_crop':
+                key = tuple(int(item) for item in boundary)
+                if key not in self.core_dict:
+                    raise ValueError('the patch %s is not in the patch list of this mosaic' % str(boundary))
+                core = self.core_dict[key]
+                col_s = core[0] - boundary[0]
+                row_s = core[1] - boundary[1]
+                core_data = seg_map[row_s:row_s + core[3], col_s:col_s + core[2]]
+                self.scratch_dst.write(core_data, 1, window=Window(core[0], core[1], core[2], core[3]))
+            elif self.policy == 'max':
+                window = Window(boundary[0], boundary[1], boundary[2], boundary[3])
+                exist_data = self.scratch_dst.read(1, window=window)
+                self.scratch_dst.write(np.maximum(exist_data, seg_map), 1, window=window)
+            else:
+                window = Window(boundary[0], boundary[1], boundary[2], boundary[3])
+                counts = self.scratch_dst.read(window=window)
+                for c_idx in range(self.num_classes):
+                    counts[c_idx][seg_map == c_idx] += 1
+                self.scratch_dst.write(counts, window=window)
+        return True
+
+    def write_batch(self, boundaries, batch_data):
+        """
+        write the predictions of a batch of patches into the mosaic
+        :param boundaries: the boundaries (xoff,yoff ,xsize, ysize) of the patches
+        :param batch_data: class maps (N, height, width), or for the linear and cosine policies, could also be
+        logits or class probabilities (N, num_classes, height, width). Patches in a batch should have the same size
+        if it is an array, otherwise, give a list.
+        :return: True
+        """
+        if self.policy not in blend_methods:
+            for boundary, seg_map in zip(boundaries, batch_data):
+                self.write_patch(boundary, seg_map)
+            return True
+
+        keys = [tuple(int(item) for item in boundary) for boundary in boundaries]
+        for key in keys:
+            if key not in self.core_dict:
+                raise ValueError('the patch %s is not in the patch list of this mosaic' % str(key))
+        weights = get_blending_weights(keys, [self.core_dict[key] for key in keys], method=self.policy)
+
+        if isinstance(batch_data, np.ndarray):
+            if batch_data.ndim == 3:
+                batch_data = seg_maps_to_one_hot(batch_data, self.num_classes)
+            # patches in the array have the same size, weight them together
+            height, width = batch_data.shape[2:]
+            weights = weights[:, :height, :width]
+            weighted = batch_data.astype(np.float32) * weights[:, None, :, :]
+        else:
+            weighted = []
+            for data, key, weight in zip(batch_data, keys, weights):
+                if data.ndim == 2:
+                    data = seg_maps_to_one_hot(data[None, :, :], self.num_classes)[0]
+                weight = weight[:key[3], :key[2]]
+                weighted.append(data.astype(np.float32) * weight[None, :, :])
+            weights = [weights[idx, :key[3], :key[2]] for idx, key in enumerate(keys)]
+
+        with self.lock:
+            for key, data, weight in zip(keys, weighted, weights):
+                if data.shape != (self.num_classes, key[3], key[2]):
+                    raise ValueError('the shape of logits %s is different from the expected (%d, %d, %d)'
+                                     % (str(data.shape), self.num_classes, key[3], key[2]))
+                window = Window(key[0], key[1], key[2], key[3])
+                acc = self.scratch_dst.read(window=window)
+                acc[:-1] += data
+                acc[-1] += weight
+                self.scratch_dst.write(acc, window=window)
+        return True
+
+    def close(self, b_complete=True):
+        """
+        close the mosaic, write the result (for voting and blending, the class with the most votes or the largest
+        weighted logits) block by block from the scratch raster into the compressed mosaic.
+        :param b_complete: if False (e.g., the prediction failed), remove the temporary files, no mosaic is saved
+        :return: the path of the mosaic, None if not complete
+        """
+        with self.lock:
+            if self.scratch_dst is None:
+                return self.save_path
+            if b_complete:
+                with rasterio.open(self.tmp_path, 'w', **self.profile) as dst:
+                    for _, window in dst.block_windows(1):
+                        data = self.scratch_dst.read(window=window)
+                        if self.policy in blend_methods:
+                            result = np.argmax(data[:-1], axis=0).astype(np.uint8)
+                            result[data[-1] == 0] = self.nodata
+                        elif self.policy == 'vote':
+                            result = np.argmax(data, axis=0).astype(np.uint8)
+                            result[np.sum(data, axis=0) == 0] = self.nodata
+                        else:
+                            result = data[0]
+                        dst.write(result, 1, window=window)
+            self.scratch_dst.close()
+            self.scratch_dst = None
+            os.remove(self.scratch_path)
+            if b_complete is False:
+                return None
+            os.replace(self.tmp_path, self.save_path)
+        return self.save_path
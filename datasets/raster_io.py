@@ -19,14 +19,279 @@ from rasterio.mask import mask
 from rasterio.features import rasterize
 from rasterio.features import shapes
 
-import skimage.measure
 import time
+import threading
+import atexit
+import json
+from multiprocessing.pool import ThreadPool
+from affine import Affine
+import rasterio.crs
+from contextlib import contextmanager
+from collections import OrderedDict
 #Color interpretation https://rasterio.readthedocs.io/en/latest/topics/color.html
 from rasterio.enums import ColorInterp
+from rasterio.windows import Window
 
 import basic_src.basic as basic
 import basic_src.io_function as io_function
 
+class RasterDatasetPool(object):
+    """
+    a process-local pool of opened rasterio datasets (read mode), avoid opening the same file again and again
+    (e.g., reading many patches or getting metadata of the same image), which is slow on network file systems.
+    A dataset is used by one thread at a time: open() takes an idle dataset of the file (or opens a new one), then
+    puts it back to the pool after using. Datasets are keyed by path, modified time, and size, so a changed file is
+    opened again. The least recently used datasets are closed when there are more than max_open idle datasets.
+    After forking, the child process does not use the datasets opened by the parent process.
+    """
+
+    def __init__(self, max_open=64):
+        """
+        :param max_open: the maximum number of idle (opened) datasets kept in the pool
+        """
+        self.max_open = max_open
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.idle = OrderedDict()  # key: a list of datasets, from the least to the most recently used key
+        self.idle_count = 0
+
+    def reset_after_fork(self):
+        # datasets of the parent process are not closed here, just forget them
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.idle = OrderedDict()
+        self.idle_count = 0
+
+    def _get_key(self, raster_path):
+        try:
+            stat = os.stat(raster_path)
+        except (OSError, TypeError):
+            # not a local file, e.g., /vsicurl/
+            return None
+        return os.path.abspath(raster_path), stat.st_mtime_ns, stat.st_size
+
+    def _pop_idle(self, key):
+        # return an idle dataset of the key (or None), and the datasets of old versions of the file
+        stale = []
+        with self.lock:
+            if self.pid != os.getpid():
+                self.reset_after_fork()
+            srcs = self.idle.get(key)
+            if srcs is None:
+                for old_key in [item for item in self.idle.keys() if item[0] == key[0]]:
+                    stale.extend(self.idle.pop(old_key))
+                self.idle_count -= len(stale)
+                return None, stale
+            src = srcs.pop()
+            self.idle_count -= 1
+            if len(srcs) < 1:
+                del self.idle[key]
+            return src, stale
+
+    def _put_idle(self, key, src):
+        to_close = []
+        with self.lock:
+            if self.pid != os.getpid() or src.closed:
+                to_close.append(src)
+            else:
+                self.idle.setdefault(key, []).append(src)
+                self.idle.move_to_end(key)
+                self.idle_count += 1
+                while self.idle_count > self.max_open:
+                    old_key = next(iter(self.idle))
+                    old_srcs = self.idle[old_key]
+                    to_close.append(old_srcs.pop(0))
+                    self.idle_count -= 1
+                    if len(old_srcs) < 1:
+                        del self.idle[old_key]
+        for item in to_close:
+            item.close()
+
+    @contextmanager
+    def open(self, raster_path):
+        '''
+        get an opened dataset (read mode), use it as: with pool.open(path) as src:
+        don't close the dataset or use it after the with block
+        :param raster_path: the raster path
+        :return: a rasterio dataset
+        '''
+        key = self._get_key(raster_path)
+        if key is None:
+            with rasterio.open(raster_path) as src:
+                yield src
+            return
+        src, stale = self._pop_idle(key)
+        for item in stale:
+            item.close()
+        if src is None:
+            src = rasterio.open(raster_path)
+        try:
+            yield src
+        except BaseException:
+            src.close()
+            raise
+        self._put_idle(key, src)
+
+    def close(self, raster_path=None):
+        '''
+        close the idle datasets of a file, or all of them
+        :param raster_path: the raster path, None for all
+        :return:
+        '''
+        abs_path = None if raster_path is None else os.path.abspath(raster_path)
+        to_close = []
+        with self.lock:
+            if self.pid != os.getpid():
+                self.reset_after_fork()
+                return
+            for key in [item for item in self.idle.keys() if abs_path is None or item[0] == abs_path]:
+                to_close.extend(self.idle.pop(key))
+            self.idle_count -= len(to_close)
+        for item in to_close:
+            item.close()
+
+
+raster_pool = RasterDatasetPool()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=raster_pool.reset_after_fork)
+atexit.register(raster_pool.close)
+
+def open_raster_pooled(raster_path):
+    # use it as: with open_raster_pooled(path) as src:
+    return raster_pool.open(raster_path)
+
+def close_raster_pool(raster_path=None):
+    # close the pooled datasets of a file (e.g., before modifying it), or all of them
+    raster_pool.close(raster_path)
+    if raster_path is not None:
+        # the file will be modified, its header may change but keep the mtime (coarse mtime on NFS) and size
+        meta_registry.remove(raster_path)
+
+def read_raster_metadata(raster_path):
+    # read the header information of a raster, return a dict can be saved to json
+    with open_raster_pooled(raster_path) as src:
+        crs = src.crs
+        return {'driver': src.driver,
+                'height': src.height, 'width': src.width, 'count': src.count, 'dtype': src.dtypes[0],
+                'res': list(src.res), 'transform': list(src.transform)[:6], 'bounds': list(src.bounds),
+                'nodata': src.nodata,
+                'crs_wkt': None if crs is None else crs.to_wkt(),
+                'crs_proj4': None if crs is None else crs.to_proj4()}
+
+
+class RasterMetadataRegistry(object):
+    """
+    cache the header information (size, resolution, transform, bounds, nodata, projection) of rasters in memory,
+    then getting them again does not need to open the files. An entry is read again if the modified time or
+    size of the file is changed. Entries can be saved to a json file (sidecar) and loaded in other runs.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}   # absolute path: metadata dict (including mtime_ns and size of the file)
+        self.crs_objs = {}  # wkt: rasterio CRS
+
+    def get(self, raster_path):
+        '''
+        get the metadata of a raster
+        :param raster_path: the raster path
+        :return: a dict (see read_raster_metadata), don't modify it
+        '''
+        try:
+            stat = os.stat(raster_path)
+        except (OSError, TypeError):
+            # not a local file, e.g., /vsicurl/, not cached
+            return read_raster_metadata(raster_path)
+        abs_path = os.path.abspath(raster_path)
+        with self.lock:
+            meta = self.entries.get(abs_path)
+        if meta is not None and meta['mtime_ns'] == stat.st_mtime_ns and meta['size'] == stat.st_size:
+            return meta
+        meta = read_raster_metadata(raster_path)
+        meta['mtime_ns'] = stat.st_mtime_ns
+        meta['size'] = stat.st_size
+        with self.lock:
+            self.entries[abs_path] = meta
+        return meta
+
+    def get_crs(self, meta):
+        # get the rasterio CRS object of a metadata dict
+        if meta['crs_wkt'] is None:
+            return None
+        with self.lock:
+            crs = self.crs_objs.get(meta['crs_wkt'])
+        if crs is None:
+            crs = rasterio.crs.CRS.from_wkt(meta['crs_wkt'])
+            with self.lock:
+                self.crs_objs[meta['crs_wkt']] = crs
+        return crs
+
+    def prefetch(self, raster_paths, thread_num=16):
+        '''
+        read the metadata of many rasters in parallel (threads), skip those already in the cache
+        :param raster_paths: a list of raster paths
+        :param thread_num: the number of threads
+        :return:
+        '''
+        if len(raster_paths) < 1:
+            return
+        with ThreadPool(max(1, min(thread_num, len(raster_paths)))) as pool:
+            pool.map(self.get, raster_paths)
+
+    def load(self, json_path):
+        # load entries from a json file, entries of changed files are read again when used
+        if os.path.isfile(json_path) is False:
+            return 0
+        try:
+            entries = io_function.read_dict_from_txt_json(json_path)
+        except ValueError:
+            basic.outputlogMessage('warning, failed to read raster metadata from %s, ignore it' % json_path)
+            return 0
+        if entries is None:
+            return 0
+        with self.lock:
+            for key, meta in entries.items():
+                if key not in self.entries:
+                    self.entries[key] = meta
+        return len(entries)
+
+    def remove(self, raster_path):
+        # remove the entry of a file, it will be read again when used
+        with self.lock:
+            self.entries.pop(os.path.abspath(raster_path), None)
+
+    def save(self, json_path):
+        # save all entries to a json file (written to a temporary file, then renamed)
+        with self.lock:
+            entries = dict(self.entries)
+        tmp_path = json_path + '.tmp%d' % os.getpid()
+        with open(tmp_path, 'w') as f_obj:
+            json.dump(entries, f_obj)
+        os.replace(tmp_path, json_path)
+
+
+meta_registry = RasterMetadataRegistry()
+
+def get_raster_metadata(file_path):
+    return meta_registry.get(file_path)
+
+def prefetch_raster_metadata(file_list, thread_num=16, sidecar_json=None):
+    '''
+    read the metadata of many rasters (e.g., image tiles) once, then the getters (get_xres_yres_file,
+    get_projection, get_image_bound_box, ...) don't need to open the files
+    :param file_list: a list of raster paths
+    :param thread_num: the number of threads for reading
+    :param sidecar_json: a json file for saving the metadata, loaded first if exists, None for not using it
+    :return:
+    '''
+    t0 = time.time()
+    if sidecar_json is not None:
+        meta_registry.load(sidecar_json)
+    meta_registry.prefetch(file_list, thread_num=thread_num)
+    if sidecar_json is not None:
+        meta_registry.save(sidecar_json)
+    basic.outputlogMessage('read metadata of %d rasters, cost %.2f seconds' % (len(file_list), time.time() - t0))
+
 def open_raster_read(raster_path):
     src = rasterio.open(raster_path)
     return src
@@ -38,122 +303,280 @@ def get_width_heigth_bandnum(opened_src):
 #     return opened_src.height,  opened_src.width,  opened_src.count
 
 def get_driver_format(file_path):
-    with rasterio.open(file_path) as src:
-        return src.driver
+    return get_raster_metadata(file_path)['driver']
 
 def get_projection(file_path, format=None):
     # https://rasterio.readthedocs.io/en/latest/api/rasterio.crs.html
     # convert the different type, to epsg, proj4, and wkt
-    with rasterio.open(file_path) as src:
-        if format is not None:
-            if format == 'proj4':
-                return src.crs.to_proj4() # string like '+init=epsg:32608', differnt from GDAL output
-            elif format == 'wkt':
-                return src.crs.to_wkt()     # string,  # its OGC WKT representation
-            elif format == 'epsg':
-                return src.crs.to_epsg()    # to epsg code, iint
-            else:
-                raise ValueError('Unknown format: %s'%str(format))
-        return src.crs
+    # use the cached metadata (meta_registry), only open the file once
+    meta = get_raster_metadata(file_path)
+    if format is not None:
+        if format not in ['proj4', 'wkt', 'epsg']:
+            raise ValueError('Unknown format: %s'%str(format))
+        if meta['crs_wkt'] is None:
+            return None
+        if format == 'proj4':
+            return meta['crs_proj4'] # string like '+init=epsg:32608', differnt from GDAL output
+        elif format == 'wkt':
+            return meta['crs_wkt']     # string,  # its OGC WKT representation
+        else:
+            if 'crs_epsg' not in meta:
+                meta['crs_epsg'] = meta_registry.get_crs(meta).to_epsg()
+            return meta['crs_epsg']    # to epsg code, iint
+    return meta_registry.get_crs(meta)
 
 def get_xres_yres_file(file_path):
-    with rasterio.open(file_path) as src:
-        xres, yres  = src.res       # Returns the (width, height) of pixels in the units of its coordinate reference system.
-        return xres, yres
+    xres, yres = get_raster_metadata(file_path)['res']  # the (width, height) of pixels in the units of its coordinate reference system.
+    return xres, yres
 
 def get_height_width_bandnum_dtype(file_path):
-    with rasterio.open(file_path) as src:
-        return src.height, src.width, src.count, src.dtypes[0]
+    meta = get_raster_metadata(file_path)
+    return meta['height'], meta['width'], meta['count'], meta['dtype']
 
 def get_transform_from_file(file_path):
-    with rasterio.open(file_path) as src:
-        return src.transform
+    return Affine(*get_raster_metadata(file_path)['transform'])
 
 def get_nodata(file_path):
-    with rasterio.open(file_path) as src:
-        return src.nodata
+    return get_raster_metadata(file_path)['nodata']
 
 def get_area_image_box(file_path):
     # get the area of an image coverage (including nodata area)
-    with rasterio.open(file_path) as src:
-        # the extent of the raster
-        raster_bounds = src.bounds  # (left, bottom, right, top)
-        height = raster_bounds.top - raster_bounds.bottom
-        width = raster_bounds.right - raster_bounds.left
-        return height*width
+    # the extent of the raster
+    raster_bounds = BoundingBox(*get_raster_metadata(file_path)['bounds'])  # (left, bottom, right, top)
+    height = raster_bounds.top - raster_bounds.bottom
+    width = raster_bounds.right - raster_bounds.left
+    return height*width
 
 def get_image_bound_box(file_path, buffer=None):
     # get the bounding box: (left, bottom, right, top)
-    with rasterio.open(file_path) as src:
-        # the extent of the raster
-        raster_bounds = src.bounds
-        if buffer is not None:
-            # Create new instance of BoundingBox(left, bottom, right, top)
-            new_box_obj = BoundingBox(raster_bounds.left-buffer, raster_bounds.bottom-buffer,
-                       raster_bounds.right+buffer, raster_bounds.top+ buffer)
-            # print(raster_bounds, new_box_obj)
-            return new_box_obj
-        return raster_bounds
-
-def get_valid_pixel_count(image_path):
+    # the extent of the raster
+    raster_bounds = BoundingBox(*get_raster_metadata(file_path)['bounds'])
+    if buffer is not None:
+        # Create new instance of BoundingBox(left, bottom, right, top)
+        new_box_obj = BoundingBox(raster_bounds.left-buffer, raster_bounds.bottom-buffer,
+                   raster_bounds.right+buffer, raster_bounds.top+ buffer)
+        # print(raster_bounds, new_box_obj)
+        return new_box_obj
+    return raster_bounds
+
+def get_valid_pixel_index(image_path, cell_size=64, band=1):
+    """
+    get the count of valid pixels (exclude no_data pixel) in each cell (cell_size by cell_size) of the image,
+    by reading the image block by block (as get_valid_pixel_count), so the entire image is not in memory.
+    Args:
+        image_path: path
+        cell_size: the size (in pixel) of the cells
+        band: the band for checking nodata
+
+    Returns: a 2D array (row and column of cells) of valid pixel count, None if nodata is not set
+
+    """
+    with open_raster_pooled(image_path) as src:
+        nodata = src.nodata
+        if nodata is None:
+            basic.outputlogMessage('nodata is not set in %s, cannot build the index of valid pixels' % image_path)
+            return None
+        cell_rows = (src.height + cell_size - 1) // cell_size
+        cell_cols = (src.width + cell_size - 1) // cell_size
+        valid_index = np.zeros(cell_rows * cell_cols, dtype=np.int64)
+        for ji, window in src.block_windows(band):
+            band_block_data = src.read(band, window=window)
+            valid_mask = band_block_data != nodata
+            if band_block_data.dtype.kind == 'f':
+                valid_mask = np.logical_and(valid_mask, ~np.isnan(band_block_data))
+            # the blocks may be tiles or strips, so count the valid pixels of each cell covered by the block
+            row_cell = (int(window.row_off) + np.arange(valid_mask.shape[0])) // cell_size
+            col_cell = (int(window.col_off) + np.arange(valid_mask.shape[1])) // cell_size
+            cell_idx = row_cell[:, None] * cell_cols + col_cell[None, :]
+            valid_index += np.bincount(cell_idx.ravel(), weights=valid_mask.ravel(),
+                                       minlength=valid_index.size).astype(np.int64)
+    return valid_index.reshape(cell_rows, cell_cols)
+
+def get_valid_patches(image_path, patch_boundaries, cell_size=64, band=1, min_valid_count=1):
+    """
+    remove the patches without valid pixels before reading them, using the index of valid pixels
+    Args:
+        image_path: path
+        patch_boundaries: a list of patch boundary (xoff,yoff ,xsize, ysize)
+        cell_size: the size (in pixel) of the cells in the index
+        band: the band for checking nodata
+        min_valid_count: the minimum valid pixel count, a patch is kept if its touched cells have these valid pixels
+
+    Returns: a list of the kept patch boundaries (in the original order), all the patches if nodata is not set,
+        if patch_boundaries is a (N,4) array, return an array
+
+    """
+    b_array = isinstance(patch_boundaries, np.ndarray)
+    if b_array is False:
+        patch_boundaries = list(patch_boundaries)
+    if len(patch_boundaries) < 1:
+        return patch_boundaries
+    valid_index = get_valid_pixel_index(image_path, cell_size=cell_size, band=band)
+    if valid_index is None:
+        return patch_boundaries
+
+    # summed-area table, then get the valid count of the cells touched by each patch at once
+    sum_table = np.zeros((valid_index.shape[0] + 1, valid_index.shape[1] + 1), dtype=np.int64)
+    sum_table[1:, 1:] = valid_index.cumsum(axis=0).cumsum(axis=1)
+    boundaries = np.asarray(patch_boundaries, dtype=np.int64).reshape(-1, 4)
+    c0 = boundaries[:, 0] // cell_size
+    r0 = boundaries[:, 1] // cell_size
+    c1 = (boundaries[:, 0] + boundaries[:, 2] + cell_size - 1) // cell_size
+    r1 = (boundaries[:, 1] + boundaries[:, 3] + cell_size - 1) // cell_size
+    valid_counts = sum_table[r1, c1] - sum_table[r0, c1] - sum_table[r1, c0] + sum_table[r0, c0]
+
+    if b_array:
+        keep_patches = patch_boundaries[valid_counts >= min_valid_count]
+    else:
+        keep_patches = [patch for patch, count in zip(patch_boundaries, valid_counts) if count >= min_valid_count]
+    basic.outputlogMessage('%d of %d patches in %s have no valid pixels, skip them' %
+                           (len(patch_boundaries) - len(keep_patches), len(patch_boundaries),
+                            os.path.basename(image_path)))
+    return keep_patches
+
+def get_block_windows(image_path, band=1):
+    # the block windows (tiles or strips) of a band
+    with open_raster_pooled(image_path) as src:
+        return [window for _, window in src.block_windows(band)]
+
+def reduce_raster_blocks(image_path, block_func, merge_func, band=1, thread_num=4):
+    """
+    read a band block by block (in parallel by threads, GDAL releases the GIL when reading), apply block_func to
+    each block, then merge the results of blocks, so only a few blocks are in memory.
+    Args:
+        image_path: path
+        block_func: function(block_data, nodata), return the result of a block
+        merge_func: function(result1, result2), return the merged result
+        band: band index
+        thread_num: the number of threads, each thread uses its own opened dataset
+
+    Returns: the merged result of all blocks, None if no blocks
+
+    """
+    windows = get_block_windows(image_path, band=band)
+    if len(windows) < 1:
+        return None
+    thread_num = max(1, min(thread_num, len(windows)))
+
+    def _reduce_windows(sub_windows):
+        res = None
+        with open_raster_pooled(image_path) as src:
+            nodata = src.nodata
+            for window in sub_windows:
+                block_res = block_func(src.read(band, window=window), nodata)
+                res = block_res if res is None else merge_func(res, block_res)
+        return res
+
+    if thread_num == 1:
+        return _reduce_windows(windows)
+    # each thread processes every thread_num-th blocks
+    with ThreadPool(thread_num) as pool:
+        results = pool.map(_reduce_windows, [windows[idx::thread_num] for idx in range(thread_num)])
+    res = None
+    for item in results:
+        if item is not None:
+            res = item if res is None else merge_func(res, item)
+    return res
+
+def get_valid_mask(block_data, nodata):
+    # valid pixels: not nodata and not nan
+    valid_mask = np.ones(block_data.shape, dtype=bool) if nodata is None else block_data != nodata
+    if block_data.dtype.kind == 'f':
+        valid_mask &= ~np.isnan(block_data)
+    return valid_mask
+
+def is_dense_count_dtype(dtype):
+    # 8 and 16 bit integers, the count of every possible value can be kept in a small array
+    dtype = np.dtype(dtype)
+    return dtype.kind in 'ui' and dtype.itemsize <= 2
+
+def get_block_value_counts(block_data):
+    """
+    get the count of each value in a block of 8 or 16 bit integers
+    Returns: (offset, counts), counts is the dense count array of all possible values, offset is the minimum value
+
+    """
+    if is_dense_count_dtype(block_data.dtype) is False:
+        raise ValueError('only support 8 and 16 bit integers for counting values, but get %s' % str(block_data.dtype))
+    offset = int(np.iinfo(block_data.dtype).min)
+    size = int(np.iinfo(block_data.dtype).max) - offset + 1
+    counts = np.bincount((block_data.ravel().astype(np.int64) - offset), minlength=size)
+    return offset, counts
+
+def merge_value_counts(counts1, counts2):
+    return counts1[0], counts1[1] + counts2[1]
+
+def value_counts_to_histogram(value_counts):
+    # to (values, counts) of the values appear in the image
+    offset, counts = value_counts
+    nonzero = np.nonzero(counts)[0]
+    return nonzero + offset, counts[nonzero]
+
+def get_band_value_counts(image_path, band=1, thread_num=4, bin_count=65536):
+    """
+    get the histogram (count of each value) of a band by reading blocks in parallel.
+    For 8 and 16 bit integers, it is exact, for other types (float, 32 bit integers), it is approximate:
+    a histogram of bin_count bins between the min and max of the band (one more pass to get them)
+    Args:
+        image_path: path
+        band: band index
+        thread_num: the number of threads
+        bin_count: bin_count of the histogram for types other than 8 and 16 bit integers
+
+    Returns: (values, counts), values appear in the band (including nodata) and their counts,
+    for the approximate one, values are the left edges of bins
+
+    """
+    with open_raster_pooled(image_path) as src:
+        dtype = src.dtypes[band - 1]
+    if is_dense_count_dtype(dtype) is False:
+        hist, bin_edges = get_band_histogram(image_path, bin_count, band=band, nodata=None, thread_num=thread_num)
+        nonzero = np.nonzero(hist)[0]
+        return bin_edges[nonzero], hist[nonzero]
+    res = reduce_raster_blocks(image_path, lambda data, nodata: get_block_value_counts(data), merge_value_counts,
+                               band=band, thread_num=thread_num)
+    if res is None:
+        return np.zeros(0), np.zeros(0, dtype=np.int64)
+    return value_counts_to_histogram(res)
+
+def get_entropy_from_counts(counts, log_base=10):
+    # shannon entropy from the counts of values, the same as skimage.measure.shannon_entropy
+    counts = np.asarray(counts, dtype=np.float64)
+    counts = counts[counts > 0]
+    if counts.size < 1:
+        return 0.0
+    prob = counts / counts.sum()
+    return float(-np.sum(prob * np.log(prob)) / np.log(log_base))
+
+def get_valid_pixel_count(image_path, thread_num=4):
     """
     get the count of valid pixels (exclude no_data pixel)
     assume that the nodata value already be set
     Args:
         image_path: path
+        thread_num: the number of threads for reading blocks
 
     Returns: the count
 
     """
-
-    t0 = time.time()
-    band = 1
     # count the pixel block by block,  quicker than read the entire image
     # https://rasterio.readthedocs.io/en/latest/topics/windowed-rw.html?highlight=block_shapes#blocks
-    valid_pixel_count = 0
-    total_count = 0
-    with rasterio.open(image_path) as src:
+    band = 1
+    with open_raster_pooled(image_path) as src:
         assert len(set(src.block_shapes)) == 1   # check have identically blocked bands
-        # for i, shape in enumerate(src.block_shapes,start=1):    # output shape
-        #     print((i, shape))
         nodata = src.nodata
-        # print(nodata)
-        if nodata is None:
-            raise ValueError('nodata is not set in %s, cannot tell valid pixel' % image_path)
-        for ji, window in src.block_windows(band):     # 1 mean for band one
-            # print((ji, window))
-            band_block_data = src.read(band, window=window) # it seems that src convert nodata to nan automatically
-            # print(band_block_data.shape)
-            # print(band_block_data)
-            valid_loc = np.where(band_block_data != nodata)
-            # if band_block_data.dtype == 'float32':
-            # always check nan
-            nan_loc = np.where(np.isnan(band_block_data))
-            valid_pixel_count -=  nan_loc[0].size
-
-            valid_pixel_count += valid_loc[0].size
-            total_count += band_block_data.size
-            # break
-        src.close()     # when call this function many time (> 10), the script frozen, try to manually close it.
-                        # on uist, has this problem, but on tesia, don't have this problem # 2021-3-10 hlc
-    # total_count = src.width*src.height
-    # print('valid_pixel_count, total_count, time cost',valid_pixel_count, total_count,time.time() - t0)
-    return valid_pixel_count, total_count
+    if nodata is None:
+        raise ValueError('nodata is not set in %s, cannot tell valid pixel' % image_path)
 
-    # # read the entire image, then calculate
-    # oneband_data, nodata = read_raster_one_band_np(image_path, band=1)
-    # if nodata is None:
-    #     raise ValueError('nodata is not set in %s, cannot tell valid pixel'%image_path)
-    #
-    # valid_loc = np.where(oneband_data != nodata)
-    # valid_pixel_count = valid_loc[0].size
-    # if oneband_data.dtype == 'float32':
-    #     nan_loc = np.where(np.isnan(oneband_data))
-    #     valid_pixel_count -=  nan_loc[0].size
-    #
-    # # return valid count and total count
-    # print('valid_pixel_count, total_count, time cost', valid_pixel_count, oneband_data.size, time.time() - t0)
-    # return valid_pixel_count, oneband_data.size
+    def _count_block(data, nodata):
+        return int(np.count_nonzero(get_valid_mask(data, nodata))), data.size
+
+    res = reduce_raster_blocks(image_path, _count_block, lambda a, b: (a[0] + b[0], a[1] + b[1]),
+                               band=band, thread_num=thread_num)
+    if res is None:
+        return 0, 0
+    valid_pixel_count, total_count = res
+    return valid_pixel_count, total_count
 
 def get_valid_pixel_percentage(image_path,total_pixel_num=None, progress=None):
     """
@@ -178,22 +601,94 @@ def get_valid_pixel_percentage(image_path,total_pixel_num=None, progress=None):
         print(progress, 'Done')
     return valid_per
 
-def get_valid_percent_shannon_entropy(image_path,log_base=10,nodata_input=0):
-    oneband_data, nodata = read_raster_one_band_np(image_path, band=1)
+def get_valid_percent_shannon_entropy(image_path,log_base=10,nodata_input=0, thread_num=4, bin_count=65536):
+    """
+    get the valid pixel percentage and shannon entropy (of all pixels, the same as skimage.measure.shannon_entropy)
+    of the first band, by reading blocks in parallel and merging the histograms of blocks.
+    For 8 and 16 bit integers, the entropy is exact. For other types (float, 32 bit integers), counting every
+    distinct value needs memory growing with the pixel count, so the entropy is approximate: it is from a histogram
+    of bin_count bins between the min and max of the band (nan pixels are ignored), and one more pass is needed.
+    Args:
+        image_path: path
+        log_base: the log base of entropy
+        nodata_input: the nodata if it is not set in the image
+        thread_num: the number of threads for reading blocks
+        bin_count: bin_count of the histogram for types other than 8 and 16 bit integers
+
+    Returns: valid_per (%), entropy
+
+    """
+    nodata = get_nodata(image_path)
     if nodata is None:
         # raise ValueError('nodata is not set in %s, cannot tell valid pixel'%image_path)
         print('warning, nodata is not set in %s, will use %s'%(image_path, str(nodata_input)))
         nodata = nodata_input
 
-    valid_loc = np.where(oneband_data != nodata)
-    valid_pixel_count = valid_loc[0].size
-    total_count = oneband_data.size
+    with open_raster_pooled(image_path) as src:
+        b_dense = is_dense_count_dtype(src.dtypes[0])
+
+    if b_dense:
+        def _block_stat(data, _):
+            return int(np.count_nonzero(get_valid_mask(data, nodata))), data.size, get_block_value_counts(data)
+
+        def _merge_stat(a, b):
+            return a[0] + b[0], a[1] + b[1], merge_value_counts(a[2], b[2])
+    else:
+        # valid count, and the min and max (of all pixels, not nan) for the histogram
+        def _block_stat(data, _):
+            values = data[get_valid_mask(data, None)]
+            min_max = (float(values.min()), float(values.max())) if values.size > 0 else (np.inf, -np.inf)
+            return int(np.count_nonzero(get_valid_mask(data, nodata))), data.size, min_max
+
+        def _merge_stat(a, b):
+            return a[0] + b[0], a[1] + b[1], (min(a[2][0], b[2][0]), max(a[2][1], b[2][1]))
+
+    res = reduce_raster_blocks(image_path, _block_stat, _merge_stat, band=1, thread_num=thread_num)
+    if res is None:
+        return 0.0, 0.0
+    valid_pixel_count, total_count, stat = res
 
     valid_per = 100.0 * valid_pixel_count / total_count
-    entropy = skimage.measure.shannon_entropy(oneband_data, base=log_base)
+    if b_dense:
+        counts = value_counts_to_histogram(stat)[1]
+    elif stat[0] > stat[1]:
+        counts = np.zeros(0)
+    else:
+        counts = get_band_histogram(image_path, bin_count, band=1, nodata=None, hist_range=stat,
+                                    thread_num=thread_num)[0]
+    entropy = get_entropy_from_counts(counts, log_base=log_base)
 
     return valid_per, entropy
 
+def get_valid_percent_entropy_list(image_paths, log_base=10, nodata_input=0, thread_num=8):
+    """
+    get the valid pixel percentage and shannon entropy of many images (e.g., tiles), images are processed in parallel
+    by threads, each thread reads an image block by block, so only thread_num blocks are in memory
+    Args:
+        image_paths: a list of image paths
+        log_base: the log base of entropy
+        nodata_input: the nodata if it is not set in an image
+        thread_num: the number of threads
+
+    Returns: a list of valid_per, a list of entropy (in the order of image_paths)
+
+    """
+    img_count = len(image_paths)
+    def _get_one(idx):
+        if idx % 100 == 0:
+            print('%d/%d' % (idx + 1, img_count))
+        return get_valid_percent_shannon_entropy(image_paths[idx], log_base=log_base, nodata_input=nodata_input,
+                                                 thread_num=1)
+
+    if thread_num <= 1 or img_count < 2:
+        results = [_get_one(idx) for idx in range(img_count)]
+    else:
+        with ThreadPool(min(thread_num, img_count)) as pool:
+            results = pool.map(_get_one, range(img_count))
+    valid_per_list = [item[0] for item in results]
+    entropy_list = [item[1] for item in results]
+    return valid_per_list, entropy_list
+
 def get_max_min_histogram_percent_oneband(data, bin_count, min_percent=0.01, max_percent=0.99, nodata=None,
                                           hist_range=None):
     '''
@@ -215,34 +710,84 @@ def get_max_min_histogram_percent_oneband(data, bin_count, min_percent=0.01, max
     data_1d = data_1d[~np.isnan(data_1d)]   # remove nan value
     hist, bin_edges = np.histogram(data_1d, bins=bin_count, density=False, range=hist_range)
 
-    # get the min and max based on percent cut.
+    found_min, found_max = get_percent_cut_from_histogram(hist, bin_edges, min_percent=min_percent,
+                                                          max_percent=max_percent)
+    return found_min, found_max, hist, bin_edges
+
+def get_percent_cut_from_histogram(hist, bin_edges, min_percent=0.01, max_percent=0.99):
+    '''
+    get the min and max from a histogram when cut of % top and bottom pixel values
+    :param hist: the count of each bin
+    :param bin_edges: the edges of bins (len(hist) + 1)
+    :param min_percent: percent
+    :param max_percent: percent
+    :return: min, max value (the left edge of bins)
+    '''
     if min_percent >= max_percent:
         raise ValueError('min_percent >= max_percent')
     found_min = 0
     found_max = 0
+    total = np.sum(hist)
+    if total <= 0:
+        return found_min, found_max
+
+    # accumulate from the bottom
+    idx = np.nonzero(np.cumsum(hist) / total >= min_percent)[0]
+    if idx.size > 0:
+        found_min = bin_edges[idx[0]]
+    # accumulate from the top (not include the first bin)
+    idx = np.nonzero(np.cumsum(hist[::-1])[::-1][1:] / total >= (1 - max_percent))[0]
+    if idx.size > 0:
+        found_max = bin_edges[idx[-1] + 1]
+
+    return found_min, found_max
+
+def get_band_min_max(image_path, band=1, nodata=None, thread_num=4):
+    # the min and max of valid pixels (not nodata and not nan) of a band, read block by block
+    def _min_max(data, _):
+        valid = data[get_valid_mask(data, nodata)]
+        if valid.size < 1:
+            return np.inf, -np.inf
+        return float(valid.min()), float(valid.max())
+
+    res = reduce_raster_blocks(image_path, _min_max, lambda a, b: (min(a[0], b[0]), max(a[1], b[1])), band=band,
+                               thread_num=thread_num)
+    return (np.inf, -np.inf) if res is None else res
+
+def get_band_histogram(image_path, bin_count, band=1, nodata=None, hist_range=None, thread_num=4, b_clip=False):
+    '''
+    get the histogram of valid pixels of a band, read block by block, the same as np.histogram of the entire band
+    :param image_path: path
+    :param bin_count: bin_count of calculating the histogram
+    :param band: band index
+    :param nodata: nodata
+    :param hist_range: [min, max] for calculating the histogram, if None, get the min and max of the band first
+    :param thread_num: the number of threads for reading blocks
+    :param b_clip: if True, count values outside hist_range in the first or last bin, instead of ignoring them
+    :return: hist, bin_edges
+    '''
+    if hist_range is None:
+        band_min, band_max = get_band_min_max(image_path, band=band, nodata=nodata, thread_num=thread_num)
+        hist_range = (0, 1) if band_min > band_max else (band_min, band_max)
+    # the same bin edges as np.histogram (if min == max, it expands the range)
+    bin_edges = np.histogram_bin_edges(np.zeros(0), bins=bin_count, range=hist_range)
+    edge_range = (bin_edges[0], bin_edges[-1])
 
-    count = hist.size
-    sum = np.sum(hist)
-    accumulate_sum = 0
-    for ii in range(count):
-        accumulate_sum += hist[ii]
-        if accumulate_sum/sum >= min_percent:
-            found_min = bin_edges[ii]
-            break
-
-    accumulate_sum = 0
-    for ii in range(count-1,0,-1):
-        # print(ii)
-        accumulate_sum += hist[ii]
-        if accumulate_sum / sum >= (1 - max_percent):
-            found_max = bin_edges[ii]
-            break
+    def _hist(data, _):
+        values = data[get_valid_mask(data, nodata)]
+        if b_clip:
+            values = np.clip(values, edge_range[0], edge_range[1])
+        return np.histogram(values, bins=bin_count, range=edge_range)[0]
 
-    return found_min, found_max, hist, bin_edges
+    hist = reduce_raster_blocks(image_path, _hist, lambda a, b: a + b, band=band, thread_num=thread_num)
+    if hist is None:
+        hist = np.zeros(bin_count, dtype=np.int64)
+    return hist, bin_edges
 
 
 def set_nodata_to_raster_metadata(raster_path, nodata):
     # modifiy the nodata value in the metadata
+    close_raster_pool(raster_path)
     cmd_str = 'gdal_edit.py -a_nodata %s  %s' % (str(nodata), raster_path)
     print(cmd_str)
     res = os.system(cmd_str)
@@ -253,6 +798,7 @@ def set_nodata_to_raster_metadata(raster_path, nodata):
 
 def remove_nodata_from_raster_metadata(raster_path):
     # modifiy the nodata value in the metadata
+    close_raster_pool(raster_path)
     cmd_str = 'gdal_edit.py -unsetnodata %s' % ( raster_path)
     print(cmd_str)
     res = os.system(cmd_str)
@@ -279,7 +825,7 @@ def read_oneband_image_to_1dArray(image_path,nodata=None, ignore_small=None):
     if os.path.isfile(image_path) is False:
         raise IOError("error, file not exist: " + image_path)
 
-    with rasterio.open(image_path) as img_obj:
+    with open_raster_pooled(image_path) as img_obj:
         # read the all bands (only have one band)
         indexes = img_obj.indexes
         if len(indexes) != 1:
@@ -316,7 +862,7 @@ def read_raster_in_polygons_mask(raster_path, polygons, nodata=None, all_touched
     else:
         polygon_list = polygons
 
-    with rasterio.open(raster_path) as src:
+    with open_raster_pooled(raster_path) as src:
         # crop image and saved to disk
         out_image, out_transform = mask(src, polygon_list, nodata=nodata, all_touched=all_touched, crop=crop,
                                         indexes=bands)
@@ -348,7 +894,7 @@ def read_raster_in_polygons_mask(raster_path, polygons, nodata=None, all_touched
 def read_raster_all_bands_np(raster_path, boundary=None):
     # boundary: (xoff,yoff ,xsize, ysize)
 
-    with rasterio.open(raster_path) as src:
+    with open_raster_pooled(raster_path) as src:
         indexes = src.indexes
         
         if boundary is not None:
@@ -363,9 +909,76 @@ def read_raster_all_bands_np(raster_path, boundary=None):
 
         return data, src.nodata
 
+class RasterStripReader(object):
+    """
+    read an image on demand in row strips (aligned to the blocks of the GeoTIFF), keep a few recent strips in memory,
+    so the memory is bounded no matter how large the image is. It can be sliced like the entire image data
+    in opencv format (height, width, band_num), e.g., reader[row_s:row_e, col_s:col_e, :]
+    """
+    def __init__(self, raster_path, min_rows=256, max_strips=2, b_bgr=False):
+        """
+        :param raster_path: the image path
+        :param min_rows: the minimum rows of a strip, set it as the maximum height of patches,
+        then a patch covers at most two strips
+        :param max_strips: the number of strips kept in memory
+        :param b_bgr: if True, convert RGB to BGR
+        """
+        self.raster_path = raster_path
+        self.src = rasterio.open(raster_path)
+        self.shape = (self.src.height, self.src.width, self.src.count)
+        self.nodata = self.src.nodata
+        self.dtype = self.src.dtypes[0]
+        block_rows = self.src.block_shapes[0][0]
+        self.strip_rows = int(math.ceil(max(min_rows, 1) / float(block_rows))) * block_rows
+        self.max_strips = max(max_strips, 2)
+        self.b_bgr = b_bgr
+        self.strips = OrderedDict()
+
+    def _get_strip(self, strip_idx):
+        if strip_idx in self.strips:
+            self.strips.move_to_end(strip_idx)
+            return self.strips[strip_idx]
+        row_s = strip_idx * self.strip_rows
+        row_e = min(row_s + self.strip_rows, self.shape[0])
+        data = self.src.read(self.src.indexes, window=((row_s, row_e), (0, self.shape[1])))
+        data = data.transpose(1, 2, 0)  # to opencv format
+        if self.b_bgr:
+            data = data[..., ::-1]
+        data = np.ascontiguousarray(data)
+        self.strips[strip_idx] = data
+        while len(self.strips) > self.max_strips:
+            self.strips.popitem(last=False)
+        return data
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        row_slice = key[0]
+        other_slices = key[1:]
+        row_s, row_e, step = row_slice.indices(self.shape[0])
+        if step != 1:
+            raise ValueError('only support step of 1 for rows')
+        if row_e <= row_s:
+            return np.zeros((0,) + self.shape[1:], dtype=self.dtype)[(slice(None),) + other_slices]
+        pieces = []
+        for strip_idx in range(row_s // self.strip_rows, (row_e - 1) // self.strip_rows + 1):
+            strip = self._get_strip(strip_idx)
+            strip_s = strip_idx * self.strip_rows
+            s0 = max(row_s, strip_s) - strip_s
+            s1 = min(row_e, strip_s + strip.shape[0]) - strip_s
+            pieces.append(strip[(slice(s0, s1),) + other_slices])
+        if len(pieces) == 1:
+            return pieces[0]
+        return np.concatenate(pieces, axis=0)
+
+    def close(self):
+        self.strips.clear()
+        self.src.close()
+
+
 def read_raster_one_band_np(raster_path,band=1,boundary=None):
     # boundary: (xoff,yoff ,xsize, ysize)
-    with rasterio.open(raster_path) as src:
+    with open_raster_pooled(raster_path) as src:
 
         if boundary is not None:
             data = src.read(band, window=boundary_to_window(boundary))
@@ -438,6 +1051,7 @@ def save_numpy_array_to_rasterfile(numpy_array, save_path, ref_raster, format='G
         colorinterp = [src.colorinterp[idx] for idx in range(src.count)]
         # print(colorinterp)
 
+        close_raster_pool(save_path)
         with rasterio.open(save_path, "w", **out_meta) as dest:
             dest.write(numpy_array)
             # Get/set raster band color interpretation: https://github.com/mapbox/rasterio/issues/100
@@ -534,8 +1148,8 @@ def image_numpy_allBands_to_8bit(img_np_allbands, scales, src_nodata=None, dst_n
         scr_max = float(scale[1])
         dst_min = float(scale[2])
         dst_max = float(scale[3])
-        img_oneband[img_oneband > scr_max] = scr_max
-        img_oneband[img_oneband < src_min] = src_min
+        # clip a copy, not modify the input
+        img_oneband = np.clip(img_oneband.astype(np.float64), src_min, scr_max)
 
         # scale the grey values to dst_min - dst_max
         k = (dst_max - dst_min) * 1.0 / (scr_max - src_min)
@@ -565,16 +1179,21 @@ def image_numpy_to_8bit(img_np, max_value, min_value, src_nodata=None, dst_nodat
 
     '''
     print('Convert to 8bit, original max, min: %.4f, %.4f'%(max_value, min_value))
-    nan_loc = np.where(np.isnan(img_np))
-    if nan_loc[0].size > 0:
+    return linear_stretch_to_8bit(img_np, max_value, min_value, src_nodata=src_nodata, dst_nodata=dst_nodata)
+
+def linear_stretch_to_8bit(img_np, max_value, min_value, src_nodata=None, dst_nodata=None):
+    # the same as image_numpy_to_8bit, but not print and not modify img_np
+    nan_mask = np.isnan(img_np) if img_np.dtype.kind == 'f' else None
+    if nan_mask is not None and nan_mask.any():
         img_np = np.nan_to_num(img_np)
+    else:
+        nan_mask = None
 
-    nodata_loc = None
+    nodata_mask = None
     if src_nodata is not None:
-        nodata_loc = np.where(img_np==src_nodata)
+        nodata_mask = img_np == src_nodata
 
-    img_np[img_np > max_value] = max_value
-    img_np[img_np < min_value] = min_value
+    data = np.clip(img_np.astype(np.float64), min_value, max_value)
 
     if dst_nodata == 0:
         n_max, n_min = 255, 1
@@ -585,24 +1204,139 @@ def image_numpy_to_8bit(img_np, max_value, min_value, src_nodata=None, dst_nodat
 
     # scale the grey values to 0 - 255 for better display
     k = (n_max - n_min)*1.0/(max_value - min_value)
-    new_img_np = (img_np - min_value) * k + n_min
-    new_img_np = new_img_np.astype(np.uint8)
+    new_img_np = ((data - min_value) * k + n_min).astype(np.uint8)
 
     # replace nan data as nodata
-    if nan_loc[0].size > 0:
-        if dst_nodata is not None:
-            new_img_np[nan_loc] = dst_nodata
-        else:
-            new_img_np[nan_loc] = n_min
+    if nan_mask is not None:
+        new_img_np[nan_mask] = dst_nodata if dst_nodata is not None else n_min
     # replace nodata
-    if nodata_loc is not None and nodata_loc[0].size >0:
-        if dst_nodata is not None:
-            new_img_np[nodata_loc] = dst_nodata
-        else:
-            new_img_np[nodata_loc] = src_nodata
+    if nodata_mask is not None and nodata_mask.any():
+        new_img_np[nodata_mask] = dst_nodata if dst_nodata is not None else src_nodata
 
     return new_img_np
 
+def get_8bit_lookup_table(dtype, max_value, min_value, src_nodata=None, dst_nodata=None):
+    # for 8 or 16 bit integers, the 8bit value of each possible value, index it by (value - the minimum of dtype)
+    info = np.iinfo(dtype)
+    values = np.arange(int(info.min), int(info.max) + 1, dtype=np.int64)
+    return linear_stretch_to_8bit(values, max_value, min_value, src_nodata=src_nodata, dst_nodata=dst_nodata)
+
+def get_band_converter_to_8bit(dtype, max_value, min_value, src_nodata=None, dst_nodata=None):
+    # return a function converting a block of a band to 8 bit
+    dtype = np.dtype(dtype)
+    if min_value == max_value:
+        const_value = np.array(dst_nodata if dst_nodata is not None else min_value).astype(np.uint8)
+        return lambda data: np.full(data.shape, const_value, dtype=np.uint8)
+    if dtype.kind in 'ui' and dtype.itemsize <= 2:
+        lut = get_8bit_lookup_table(dtype, max_value, min_value, src_nodata=src_nodata, dst_nodata=dst_nodata)
+        offset = int(np.iinfo(dtype).min)
+        if offset == 0:
+            return lambda data: lut[data]
+        return lambda data: lut[data.astype(np.int32) - offset]
+    return lambda data: linear_stretch_to_8bit(data, max_value, min_value, src_nodata=src_nodata, dst_nodata=dst_nodata)
+
+def convert_raster_to_8bit_hist(image_path, save_path, min_max_values=None, per_min=0.01, per_max=0.99,
+                                bin_count=10000, src_nodata=None, dst_nodata=None, overview_factor=None,
+                                thread_num=4, block_size=512, compress='lzw', bigtiff='IF_SAFER'):
+    """
+    convert a raster (e.g., 16 bit or float) to 8 bit by the percent cut of histograms, the same as
+    image_numpy_allBands_to_8bit_hist, but the entire image is not read into memory.
+    pass one: the histogram of each band is accumulated block by block (or from a decimated read, using overviews
+    if available), to get the min and max;
+    pass two: convert the image tile by tile (lookup tables for 8 or 16 bit integers, linear stretch for others),
+    and write to a tiled GeoTIFF.
+    Args:
+        image_path: the input raster
+        save_path: the output 8 bit raster
+        min_max_values: one or multiple (min, max), the min and max from histograms are limited to them,
+            they are also the range of histograms (values outside are counted in the first or last bin),
+            then no pass for getting the min and max of bands
+        per_min: percent cut at the bottom
+        per_max: percent cut at the top
+        bin_count: bin_count of calculating the histogram
+        src_nodata: the nodata of input, if None, use the one in the raster
+        dst_nodata: the nodata of output
+        overview_factor: if set (e.g., 8), calculate histograms from the image decimated by this factor
+        thread_num: the number of threads for reading and converting blocks
+        block_size: the tile size of the output
+        compress: compression of the output
+        bigtiff: bigtiff option of the output
+
+    Returns: a list of (min, max) of bands used for converting
+
+    """
+    with open_raster_pooled(image_path) as src:
+        band_count, height, width = src.count, src.height, src.width
+        dtype = np.dtype(src.dtypes[0])
+        profile = src.profile.copy()
+        colorinterp = src.colorinterp
+        if src_nodata is None:
+            src_nodata = src.nodata
+
+    if min_max_values is not None:
+        # if we input multiple scales, it should has the same size the band count
+        if len(min_max_values) > 1 and len(min_max_values) != band_count:
+            raise ValueError('The number of min_max_value is not the same with band account')
+        # if only input one scale, then duplicate for multiple band account.
+        if len(min_max_values) == 1 and len(min_max_values) != band_count:
+            min_max_values = min_max_values * band_count
+
+    # pass one: get min, max from histograms
+    band_min_max = []
+    for band in range(1, band_count + 1):
+        if overview_factor is not None and overview_factor > 1:
+            with open_raster_pooled(image_path) as src:
+                data = src.read(band, out_shape=(max(1, height // overview_factor), max(1, width // overview_factor)))
+            found_min, found_max, _, _ = get_max_min_histogram_percent_oneband(data, bin_count, min_percent=per_min,
+                                                                              max_percent=per_max, nodata=src_nodata)
+        else:
+            # use min_max_values as the range of the histogram, skip the pass of getting min and max
+            hist_range = None if min_max_values is None else min_max_values[band - 1]
+            hist, bin_edges = get_band_histogram(image_path, bin_count, band=band, nodata=src_nodata,
+                                                 hist_range=hist_range, thread_num=thread_num,
+                                                 b_clip=hist_range is not None)
+            found_min, found_max = get_percent_cut_from_histogram(hist, bin_edges, min_percent=per_min,
+                                                                  max_percent=per_max)
+        print('band %d, min and max value from histogram (percent cut):' % band, found_min, found_max)
+        if min_max_values is not None:
+            if found_min < min_max_values[band - 1][0]:
+                found_min = min_max_values[band - 1][0]
+                print('reset the min value to %s' % found_min)
+            if found_max > min_max_values[band - 1][1]:
+                found_max = min_max_values[band - 1][1]
+                print('reset the max value to %s' % found_max)
+        if found_min == found_max:
+            print('warning, found_min == find_max, set the output as nodata or found_min')
+        band_min_max.append((found_min, found_max))
+
+    # pass two: convert tile by tile
+    converters = [get_band_converter_to_8bit(dtype, found_max, found_min, src_nodata=src_nodata, dst_nodata=dst_nodata)
+                  for found_min, found_max in band_min_max]
+    windows = [Window(col, row, min(block_size, width - col), min(block_size, height - row))
+               for row in range(0, height, block_size) for col in range(0, width, block_size)]
+
+    def _convert_window(window):
+        with open_raster_pooled(image_path) as src:
+            data = src.read(window=window)
+        return window, np.stack([converters[idx](data[idx]) for idx in range(band_count)])
+
+    profile.pop('photometric', None)
+    profile.update(driver='GTiff', dtype='uint8', count=band_count, nodata=dst_nodata, tiled=True,
+                   blockxsize=block_size, blockysize=block_size, compress=compress, bigtiff=bigtiff)
+    close_raster_pool(save_path)
+    thread_num = max(1, thread_num)
+    with rasterio.open(save_path, 'w', **profile) as dest:
+        with ThreadPool(thread_num) as pool:
+            # convert a few tiles at a time, keep the memory bounded
+            chunk = thread_num * 4
+            for idx in range(0, len(windows), chunk):
+                for window, out_data in pool.imap(_convert_window, windows[idx:idx + chunk]):
+                    dest.write(out_data, window=window)
+        dest.colorinterp = colorinterp
+
+    print('save to %s' % save_path)
+    return band_min_max
+
 
 def pixel_xy_to_geo_xy(x0,y0, transform):
     # pixel to geo XY
@@ -662,6 +1396,7 @@ def burn_polygons_to_a_existing_raster(input_raster,polygons,burn_value=0):
         image_data[:, loc[0], loc[1]] = burn_value
         kwargs = src.meta
 
+    close_raster_pool(input_raster)
     with rasterio.open(input_raster, 'w', **kwargs) as dst:
         dst.write(image_data)
     print('burn %s into %s'%(str(burn_value), input_raster))
@@ -865,6 +1600,7 @@ def write_colormaps(raster_path, color_map_dict):
     '''
 
     # update the raster file
+    close_raster_pool(raster_path)
     with rasterio.open(raster_path,mode='r+') as src:
 
         band_count = src.count
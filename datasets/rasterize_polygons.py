@@ -27,7 +27,7 @@ import numpy as np
 from rasterio.features import rasterize
 
 sys.path.insert(0, os.path.join(code_dir,'datasets'))
-from get_subImages import get_projection_proj4
+from get_subImages import is_same_projection
 
 def find_corresponding_geojson_SpaceNet(tif_path, geojson_list, geojson_name_list):
     img_name = os.path.basename(tif_path)
@@ -124,7 +124,7 @@ def rasterize_polygons_to_ref_raster(ref_raster, poly_path, burn_value, attribut
 
     # need to check the projection
     # need to check: the shape file and raster should have the same projection.
-    if get_projection_proj4(ref_raster) != get_projection_proj4(poly_path):
+    if is_same_projection(ref_raster, poly_path) is False:
         raise ValueError('error, the input raster (e.g., %s) and vector (%s) files don\'t have the same projection'%(ref_raster, poly_path))
 
     # read polygons (can read geojson file directly)
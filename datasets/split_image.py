@@ -9,12 +9,46 @@ add time: 15 July, 2017
 """
 import sys,os,subprocess
 from optparse import OptionParser
+import numpy as np
 
 from multiprocessing import Pool
 
-def sliding_window(image_width,image_height, patch_w,patch_h,adj_overlay_x=0,adj_overlay_y=0):
+def get_window_ranges(image_len, patch_len, adj_overlay=0):
     """
-    get the subset windows of each patch
+    get the offset and size of patches in one direction (x or y), duplicated ones are removed (keep the first one)
+    Args:
+        image_len: width (or height) of input image
+        patch_len: the width (or height) of the expected patch
+        adj_overlay: the extended distance (in pixel) to adjacent patch
+
+    Returns: (count, 2) int array, each row is (offset, size)
+
+    """
+    count = int(image_len/patch_len)
+    left = int(image_len)%int(patch_len)
+    if left < patch_len/3 and count > 0:
+        # the last patch is larger
+        left = patch_len + left
+    else:
+        count = count + 1
+
+    starts = np.arange(count, dtype=np.int64) * patch_len
+    lengths = np.full(count, patch_len, dtype=np.int64)
+    lengths[-1] = left
+    # extend the patch
+    offsets = np.maximum(starts - adj_overlay, 0)
+    sizes = np.minimum(starts + lengths + adj_overlay, image_len) - offsets
+    ranges = np.stack([offsets, sizes], axis=1)
+
+    # remove duplicated ranges (e.g., the overlay is larger than the patch size), keep the order
+    _, first_idx = np.unique(ranges, axis=0, return_index=True)
+    return ranges[np.sort(first_idx)]
+
+def sliding_window_array(image_width,image_height, patch_w,patch_h,adj_overlay_x=0,adj_overlay_y=0):
+    """
+    get the subset windows of each patch, as an int array.
+    The order is fixed (column by column, from the top to the bottom in each column), so the index of a patch
+    is the same for different runs. Duplicated patches are removed.
     Args:
         image_width: width of input image
         image_height: height of input image
@@ -22,67 +56,53 @@ def sliding_window(image_width,image_height, patch_w,patch_h,adj_overlay_x=0,adj
         patch_h: the height of the expected patch
         adj_overlay_x: the extended distance (in pixel of x direction) to adjacent patch, make each patch has overlay with adjacent patch
         adj_overlay_y: the extended distance (in pixel of y direction) to adjacent patch, make each patch has overlay with ad
-    Returns: The list of boundary of each patch
+    Returns: (N, 4) int array, each row is the boundary (xoff,yoff ,xsize, ysize) of a patch
 
     """
+    x_ranges = get_window_ranges(image_width, patch_w, adj_overlay_x)
+    y_ranges = get_window_ranges(image_height, patch_h, adj_overlay_y)
+    # unique x ranges and unique y ranges, so all their combinations are unique
+    x_idx = np.repeat(np.arange(len(x_ranges)), len(y_ranges))
+    y_idx = np.tile(np.arange(len(y_ranges)), len(x_ranges))
+    return np.stack([x_ranges[x_idx, 0], y_ranges[y_idx, 0], x_ranges[x_idx, 1], y_ranges[y_idx, 1]], axis=1)
+
+def iter_sliding_window(image_width,image_height, patch_w,patch_h,adj_overlay_x=0,adj_overlay_y=0):
+    """
+    the same as sliding_window_array (same order), but yield the boundary of patches one by one,
+    for very large images
+    Returns: a generator of the boundary (xoff,yoff ,xsize, ysize) of each patch
 
-    count_x = int(image_width/patch_w)
-    count_y = int(image_height/patch_h)
+    """
+    x_ranges = get_window_ranges(image_width, patch_w, adj_overlay_x).tolist()
+    y_ranges = get_window_ranges(image_height, patch_h, adj_overlay_y).tolist()
+    for xoff, xsize in x_ranges:
+        for yoff, ysize in y_ranges:
+            yield (xoff, yoff, xsize, ysize)
 
-    leftW = int(image_width)%int(patch_w)
-    leftH = int(image_height)%int(patch_h)
-    if leftW < patch_w/3 and count_x > 0:
-        # count_x = count_x - 1
-        leftW = patch_w + leftW
-    else:
-        count_x = count_x + 1
-    if leftH < patch_h/3 and count_y > 0:
-        # count_y = count_y - 1
-        leftH = patch_h + leftH
-    else:
-        count_y = count_y + 1
-
-    # output split information
-    # f_obj = open('split_image_info.txt','w')
-    # f_obj.writelines('### This file is created by split_image.py. mosaic_patches.py need it. Do not edit it\n')
-    # f_obj.writelines('image_width:%d\n' % image_width)
-    # f_obj.writelines('image_height:%d\n' % image_height)
-    # f_obj.writelines('expected patch_w:%d\n' % patch_w)
-    # f_obj.writelines('expected patch_h:%d\n'%patch_h)
-    # f_obj.writelines('adj_overlay_x:%d\n' % adj_overlay_x)
-    # f_obj.writelines('adj_overlay_y:%d\n' % adj_overlay_y)
-
-    patch_boundary = []
-    for i in range(0,count_x):
-        # f_obj.write('column %d:'%i)
-        for j in range(0,count_y):
-            w = patch_w
-            h = patch_h
-            if i==count_x -1:
-                w = leftW
-            if j == count_y - 1:
-                h = leftH
-
-            # f_obj.write('%d ' % (i*count_y + j))
-
-            # extend the patch
-            xoff = max(i*patch_w - adj_overlay_x,0)  # i*patch_w
-            yoff = max(j*patch_h - adj_overlay_y, 0) # j*patch_h
-            xsize = min(i*patch_w + w + adj_overlay_x,image_width) - xoff   #w
-            ysize = min(j*patch_h + h + adj_overlay_y, image_height) - yoff #h
-
-            new_patch = (xoff,yoff ,xsize, ysize)
-            patch_boundary.append(new_patch)
-
-        # f_obj.write('\n')
+def sort_boundary_array_by_rows(boundaries):
+    # sort the (N, 4) boundary array row by row (by yoff, then xoff)
+    boundaries = np.asarray(boundaries).reshape(-1, 4)
+    return boundaries[np.lexsort((boundaries[:, 0], boundaries[:, 1]))]
 
-    # f_obj.close()
-    # remove duplicated patches
-    patch_boundary_unique = set(patch_boundary)
-    if len(patch_boundary_unique) != len(patch_boundary):
-        patch_boundary = patch_boundary_unique
+def boundary_array_to_list(boundaries):
+    # (N, 4) array to a list of tuples (python int)
+    return [tuple(item) for item in np.asarray(boundaries).reshape(-1, 4).tolist()]
+
+def sliding_window(image_width,image_height, patch_w,patch_h,adj_overlay_x=0,adj_overlay_y=0):
+    """
+    get the subset windows of each patch
+    Args:
+        image_width: width of input image
+        image_height: height of input image
+        patch_w: the width of the expected patch
+        patch_h: the height of the expected patch
+        adj_overlay_x: the extended distance (in pixel of x direction) to adjacent patch, make each patch has overlay with adjacent patch
+        adj_overlay_y: the extended distance (in pixel of y direction) to adjacent patch, make each patch has overlay with ad
+    Returns: The list of boundary of each patch, in the order of sliding_window_array
 
-    return patch_boundary
+    """
+    return boundary_array_to_list(sliding_window_array(image_width, image_height, patch_w, patch_h,
+                                                       adj_overlay_x=adj_overlay_x, adj_overlay_y=adj_overlay_y))
 
 def get_one_patch(input, index, patch,output_dir,out_format,extension,pre_name):
     # print information
@@ -121,15 +141,9 @@ def split_image(input,output_dir,patch_w=1024,patch_h=1024,adj_overlay_x=0,adj_o
 
     print('input Width %d  Height %d'%(img_witdh,img_height))
     # print(('patch Width %d  Height %d'%(patch_w,patch_h)))
+    # duplicated patches are removed in sliding_window
     patch_boundary = sliding_window(img_witdh,img_height,patch_w,patch_h,adj_overlay_x,adj_overlay_y)
 
-    # remove duplicated patches
-    patch_boundary_unique = set(patch_boundary)
-    if len(patch_boundary_unique) != len(patch_boundary):
-        print('remove %d duplicated patches of images %s'%(len(patch_boundary)-len(patch_boundary_unique),
-              os.path.basename(input)))
-        patch_boundary = patch_boundary_unique
-
     index = 0
     if pre_name is None:
         pre_name = os.path.splitext(os.path.basename(input))[0]
@@ -694,19 +694,23 @@ def save_shapefile_subset_as(data_poly_indices, org_shp, save_path,format='ESRI
 
     return True
 
-def save_polygons_to_files(data_frame, geometry_name, wkt_string, save_path,format='ESRI Shapefile'):
+def save_polygons_to_files(data_frame, geometry_name, wkt_string, save_path,format='ESRI Shapefile', b_append=False):
     '''
     :param data_frame: include polygon list and the corresponding attributes
     :param geometry_name: dict key for the polgyon in the DataFrame
     :param wkt_string: wkt string (projection)
     :param save_path: save path
     :param format: use ESRI Shapefile or "GPKG" (GeoPackage)
+    :param b_append: if True and save_path exists, append the polygons to it (should have the same attributes)
     :return:
     '''
     # data_frame[geometry_name] = data_frame[geometry_name].apply(wkt.loads)
     poly_df = gpd.GeoDataFrame(data_frame, geometry=geometry_name)
     poly_df.crs = wkt_string # or poly_df.crs = {'init' :'epsg:4326'}
-    poly_df.to_file(save_path, driver=format)
+    if b_append and os.path.isfile(save_path):
+        poly_df.to_file(save_path, driver=format, mode='a')
+    else:
+        poly_df.to_file(save_path, driver=format)
 
     return True
 
@@ -983,6 +987,14 @@ def convert_image_bound_to_shapely_polygon(img_bound_box):
     polygon = Polygon([letftop1, righttop1,rightbottom1,leftbottom1])
     return polygon
 
+def convert_bounds_array_to_polygons(bounds_array):
+    # convert many bounding boxes (N, 4) array: (left, bottom, right, top) to a list of shapely polygons
+    bounds_array = np.asarray(bounds_array, dtype=np.float64).reshape(-1, 4)
+    if version.parse(shapely.__version__) >= version.parse('2.0.0'):
+        # create all polygons at once
+        return list(shapely.box(bounds_array[:, 0], bounds_array[:, 1], bounds_array[:, 2], bounds_array[:, 3]))
+    return [convert_image_bound_to_shapely_polygon(item) for item in bounds_array]
+
 def convert_bounds_to_polygon(bounds):
     # bounding box: (left, bottom, right, top)
     letftop1 = (bounds[0],bounds[3])
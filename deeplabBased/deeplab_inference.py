@@ -28,6 +28,9 @@ import numpy as np
 import multiprocessing
 from multiprocessing import Pool
 
+import threading
+import queue
+
 
 # set GPU on Cryo06, it seem this code not works
 #os.system("export CUDA_VISIBLE_DEVICES=0")
@@ -71,6 +74,14 @@ tf.app.flags.DEFINE_string(
     './export/frozen_inference_graph.pb',
     'File path of frozen inference graph')
 
+tf.app.flags.DEFINE_bool(
+    'inf_worker_mode',
+    False,
+    'keep the model loaded and read jobs (inf_list_file and inf_output_dir, separated by a tab) from stdin')
+
+# the prefix of the line written to stdout after a job is done in the worker mode (see parallel_prediction.py)
+worker_done_prefix = 'INF_WORKER_DONE:'
+
 
 
 # ## Select and download models
@@ -239,6 +250,162 @@ def inference_one_patch(img_idx,idx,org_img_path,boundary,model):
 
     return True
 
+def save_patch_result(img_patch, seg_map, save_path, mosaic=None, core_dict=None):
+    """
+    save the segmentation result of a patch, to a separate file or into the mosaic of the entire image
+    :param img_patch: the patch (patchclass)
+    :param seg_map: the segmentation result of the patch
+    :param save_path: the path for saving the patch result to a separate file
+    :param mosaic: a PatchMosaic of the entire image, if it is not None, write the result into it.
+    :param core_dict: if it is not None, only save the core (non-overlapping) region of the patch to the file
+    :return: False if unsuccessful
+    """
+    if mosaic is not None:
+        return mosaic.write_patch(img_patch.boundary, seg_map)
+    if core_dict is not None:
+        core = core_dict[tuple(int(item) for item in img_patch.boundary)]
+        seg_map = mosaic_patches.crop_patches_to_core([seg_map], [img_patch.boundary], [core])[0]
+        img_patch = build_RS_data.patchclass(img_patch.org_img, core)
+    return build_RS_data.save_patch_oneband_8bit(img_patch, seg_map.astype(np.uint8), save_path)
+
+def read_a_batch_of_patches(img_idx, a_batch_of_patches, entire_img_data=None):
+    """
+    read the image data of a batch of patches, ignore the patches that are all black or white
+    :param img_idx: index of the image
+    :param a_batch_of_patches: a list of (patch index on the image, patch (patchclass))
+    :param entire_img_data: the entire image data if it has been read into memory, otherwise, None
+    :return: a list of (patch index, patch, image data)
+    """
+    patch_data_list = []
+    for idx, img_patch in a_batch_of_patches:
+        if entire_img_data is not None:
+            img_data = copy_one_patch_image_data(img_patch.boundary, entire_img_data)
+        else:
+            img_data = build_RS_data.read_patch(img_patch)
+        ## ignore image patch are all black or white
+        if np.std(img_data[0]) < 0.0001:
+            print('Image (1st band):%d patch:%4d is black or white, ignore' % (img_idx, idx))
+            continue
+        patch_data_list.append((idx, img_patch, img_data))
+    return patch_data_list
+
+def run_a_batch_of_patches(model, multi_image_data, batch_size):
+    """
+    run the model on a batch of patches with the same size
+    :param model: trained model
+    :param multi_image_data: a list of image data of patches, count <= batch_size
+    :param batch_size: the batch size, the frozen graph requires a constant batch size
+    :return: the segmentation results of the input patches
+    """
+    org_patch_num = len(multi_image_data)
+    if org_patch_num > batch_size:
+        raise ValueError('the count of patches (%d) is larger than the batch size (%d)' % (org_patch_num, batch_size))
+    # Since it required a constant of batch size for the frozen graph, we copy (duplicate) the first patch
+    multi_image_data = list(multi_image_data)
+    while len(multi_image_data) < batch_size:
+        multi_image_data.append(multi_image_data[0])
+    multi_images = np.stack(multi_image_data, axis=0)
+    a_batch_seg_map = model.run_rsImg_multi_patches(multi_images)
+    # ignore the duplicated ones
+    return a_batch_seg_map[:org_patch_num]
+
+def inf_remoteSensing_image_pipeline(model, img_idx, aImage_patches, batch_size, entire_img_data=None,
+                                     read_thread_num=2, write_thread_num=2, queue_size=8, mosaic=None,
+                                     core_dict=None):
+    """
+    inference patches of an image in a pipeline: reading patches (in reader threads), running the model
+    (in the main thread), and saving results (in writer threads) are overlapped and connected by bounded queues,
+    so the session does not need to wait for reading and writing.
+    :param model: trained model
+    :param img_idx: index of the image
+    :param aImage_patches: all patches (patchclass) of the image
+    :param batch_size: the batch size, the frozen graph requires a constant batch size
+    :param entire_img_data: the entire image data if it has been read into memory, otherwise, None
+    :param read_thread_num: the number of threads for reading patches
+    :param write_thread_num: the number of threads for saving results
+    :param queue_size: the maximum number of batches waiting in the queues
+    :param mosaic: a PatchMosaic of the entire image, if it is not None, write results into it.
+    :param core_dict: if it is not None, only save the core (non-overlapping) region of each patch
+    :return: True if successful, False otherwise
+    """
+    patch_num = len(aImage_patches)
+    # the file name of each patch (I{img_idx}_{idx}) is based on its index on the image
+    patch_batches = build_RS_data.split_patches_into_batches_by_size(aImage_patches, batch_size)
+
+    batch_task_queue = queue.Queue()
+    for b_idx, a_batch_of_patches in enumerate(patch_batches):
+        batch_task_queue.put((b_idx, a_batch_of_patches))
+
+    read_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size*batch_size)
+    thread_errors = []
+
+    def read_worker():
+        while True:
+            try:
+                b_idx, a_batch_of_patches = batch_task_queue.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                patch_data_list = read_a_batch_of_patches(img_idx, a_batch_of_patches,
+                                                          entire_img_data=entire_img_data)
+            except Exception as e:
+                thread_errors.append(e)
+                patch_data_list = []
+            # always put something, the main thread counts the batches
+            read_queue.put((b_idx, patch_data_list))
+
+    def write_worker():
+        while True:
+            item = write_queue.get()
+            if item is None:
+                break
+            img_patch, seg_map, save_path = item
+            try:
+                save_patch_result(img_patch, seg_map, save_path, mosaic=mosaic, core_dict=core_dict)
+            except Exception as e:
+                thread_errors.append(e)
+
+    readers = [threading.Thread(target=read_worker) for _ in range(read_thread_num)]
+    writers = [threading.Thread(target=write_worker) for _ in range(write_thread_num)]
+    for thr in readers + writers:
+        thr.daemon = True
+        thr.start()
+
+    for _ in range(len(patch_batches)):
+        b_idx, patch_data_list = read_queue.get()
+        # ignore image patch are all black or white
+        if len(patch_data_list) < 1:
+            continue
+        try:
+            a_batch_seg_map = run_a_batch_of_patches(model, [item[2] for item in patch_data_list], batch_size)
+        except Exception as e:
+            print('\nPrediction Error for patches %s of Image %d, error: %s\n\n' %
+                  (str([item[0] for item in patch_data_list]), img_idx, str(e)))
+            # keep consuming the read queue, so the reader threads can finish, then return False
+            thread_errors.append(e)
+            continue
+
+        for (idx, img_patch, _), seg_map in zip(patch_data_list, a_batch_seg_map):
+            print(datetime.now(), 'Save segmentation result of Image:%d patch:%5d (total:%d), shape:(%d,%d)' %
+                  (img_idx, idx, patch_num, seg_map.shape[0], seg_map.shape[1]))
+            # short the file name to avoid  error of " Argument list too long", hlc 2018-Oct-29
+            file_name = "I%d_%d" % (img_idx, idx)
+            save_path = os.path.join(FLAGS.inf_output_dir, file_name + '.tif')
+            write_queue.put((img_patch, seg_map, save_path))
+
+    # tell the writers to stop after saving all the results
+    for _ in writers:
+        write_queue.put(None)
+    for thr in readers + writers:
+        thr.join()
+
+    if len(thread_errors) > 0:
+        print('Error, %d errors occurred when reading or saving patches of Image %d, the first one: %s' %
+              (len(thread_errors), img_idx, str(thread_errors[0])))
+        return False
+    return True
+
 def inf_remoteSensing_image(model,image_path=None):
     '''
     input a remote sensing image, then split to many small patches, inference each patch and merge than at last
@@ -258,6 +425,30 @@ def inf_remoteSensing_image(model,image_path=None):
     overlay_y = parameters.get_digit_parameters(FLAGS.inf_para_file, "inf_pixel_overlay_y", 'int')
 
     b_use_memory = parameters.get_bool_parameters_None_if_absence(FLAGS.inf_para_file,'b_inf_memory_buffer')
+    # overlap reading patches, running the model, and saving results
+    b_pipeline = parameters.get_bool_parameters_None_if_absence(FLAGS.inf_para_file,'b_inf_pipeline')
+    read_thread_num = parameters.get_digit_parameters_None_if_absence(FLAGS.inf_para_file,'inf_read_thread_num','int')
+    if read_thread_num is None:
+        read_thread_num = 2
+    write_thread_num = parameters.get_digit_parameters_None_if_absence(FLAGS.inf_para_file,'inf_write_thread_num','int')
+    if write_thread_num is None:
+        write_thread_num = 2
+    # save results of patches to separate files (patches) or one file of the entire image (mosaic)
+    output_mode = parameters.get_string_parameters_None_if_absence(FLAGS.inf_para_file,'inf_output_mode')
+    if output_mode is None:
+        output_mode = 'patches'
+    if output_mode not in ['patches', 'mosaic']:
+        raise ValueError('unknown inf_output_mode: %s, should be patches or mosaic'%output_mode)
+    overlap_policy = parameters.get_string_parameters_None_if_absence(FLAGS.inf_para_file,'inf_mosaic_overlap_policy')
+    if overlap_policy is None:
+        overlap_policy = 'centre_crop'
+    # in the patches mode, only save the core (non-overlapping) region of each patch,
+    # then the merged results do not depend on the order of merging patches
+    b_save_patch_core = parameters.get_bool_parameters_None_if_absence(FLAGS.inf_para_file,'b_inf_save_patch_core')
+    # skip the patches without valid pixels (nodata) before reading them
+    b_skip_invalid = parameters.get_bool_parameters_None_if_absence(FLAGS.inf_para_file,'b_inf_skip_invalid_patches')
+    num_classes_noBG = parameters.get_digit_parameters_None_if_absence(FLAGS.inf_para_file,'NUM_CLASSES_noBG','int')
+    num_classes = 2 if num_classes_noBG is None else num_classes_noBG + 1
 
     if image_path is not None:
         with open('saved_inf_list.txt','w') as f_obj:
@@ -280,6 +471,14 @@ def inf_remoteSensing_image(model,image_path=None):
     for img_idx, aImage_patches in enumerate(data_patches_2d):
 
         print('start inference on Image  %d' % img_idx)
+        if b_skip_invalid and len(aImage_patches) > 0:
+            valid_boundaries = raster_io.get_valid_patches(aImage_patches[0].org_img,
+                                                           [item.boundary for item in aImage_patches])
+            valid_boundaries = set(tuple(item) for item in valid_boundaries)
+            aImage_patches = [item for item in aImage_patches if tuple(item.boundary) in valid_boundaries]
+            if len(aImage_patches) < 1:
+                print('no valid patches on Image %d, skip' % img_idx)
+                continue
         patch_num = len(aImage_patches)
 
         entire_img_data = None
@@ -293,6 +492,30 @@ def inf_remoteSensing_image(model,image_path=None):
             entire_height, entire_width, band_num = entire_img_data.shape
             print("entire_height, entire_width, band_num", entire_height, entire_width, band_num)
 
+        mosaic = None
+        if output_mode == 'mosaic':
+            # write all the results into one file, no need to merge patches using gdal_merge.py later
+            mosaic_path = os.path.join(FLAGS.inf_output_dir, "I%d_mosaic.tif" % img_idx)
+            mosaic = mosaic_patches.PatchMosaic(aImage_patches[0].org_img, mosaic_path,
+                                                patch_boundaries=[item.boundary for item in aImage_patches],
+                                                policy=overlap_policy, num_classes=num_classes)
+        core_dict = None
+        if mosaic is None and b_save_patch_core:
+            img_height, img_width, _, _ = raster_io.get_height_width_bandnum_dtype(aImage_patches[0].org_img)
+            core_dict = mosaic_patches.get_patch_core_dict([item.boundary for item in aImage_patches],
+                                                           img_width, img_height)
+
+        if b_pipeline:
+            res = inf_remoteSensing_image_pipeline(model, img_idx, aImage_patches, FLAGS.inf_batch_size,
+                                                   entire_img_data=entire_img_data, read_thread_num=read_thread_num,
+                                                   write_thread_num=write_thread_num, mosaic=mosaic,
+                                                   core_dict=core_dict)
+            if mosaic is not None:
+                mosaic.close(b_complete=res is not False)
+            if res is False:
+                return False
+            continue
+
         # ## parallel inference patches
         # # but it turns out not work due to the Pickle.PicklingError
         # # use multiple thread
@@ -308,81 +531,68 @@ def inf_remoteSensing_image(model,image_path=None):
         # inference patches batch by batch, but it turns out that the frozen graph only accept one patch each time
         # Oct 30,2018
         # split to many batches (groups)
-        idx = 0     #index of all patches on this image
-        patch_batches = build_RS_data.split_patches_into_batches(aImage_patches,FLAGS.inf_batch_size)
+        # group patches with the same size into batches, then np.stack works on each batch and no patches are
+        # lost. Each patch is (index on the image, patch), the index is used in the file name.
+        patch_batches = build_RS_data.split_patches_into_batches_by_size(aImage_patches,FLAGS.inf_batch_size)
         save_one_patch_to_disk = False
 
         for a_batch_of_patches in patch_batches:
 
-            # Since it required a constant of batch size for the frozen graph, we copy (duplicate) the first patch
-            org_patch_num = len(a_batch_of_patches)
-            while len(a_batch_of_patches) < FLAGS.inf_batch_size:
-                a_batch_of_patches.append(a_batch_of_patches[0])
-
-            # read image data and stack at 0 dimension
-            multi_image_data = []
-            for img_patch in a_batch_of_patches:
-                if b_use_memory:
-                    img_data = copy_one_patch_image_data(img_patch.boundary,entire_img_data)
-                else:
-                    img_data = build_RS_data.read_patch(img_patch)
-                ## ignore image patch are all black or white
-                if np.std(img_data[0]) < 0.0001:
-                    print('Image (1st band):%d patch:%4d is black or white, ignore' %(img_idx, idx))
-                    idx += 1
-                    continue
-
-                multi_image_data.append(img_data)
-            # ignore image patch are all black or white
-            if len(multi_image_data) < 1:
+            # read image data, ignore image patch are all black or white
+            patch_data_list = read_a_batch_of_patches(img_idx, a_batch_of_patches, entire_img_data=entire_img_data)
+            if len(patch_data_list) < 1:
                 continue
-            multi_images = np.stack(multi_image_data, axis=0)
 
             # inference them
             try:
-                a_batch_seg_map = model.run_rsImg_multi_patches(multi_images)
-
-                #save
-                for num,(seg_map,img_patch) in enumerate(zip(a_batch_seg_map,a_batch_of_patches)):
-
-                    # ignore the duplicated ones
-                    if num >= org_patch_num:
-                        break
-
-                    print(datetime.now(),'Save segmentation result of Image:%d patch:%5d (total:%d), shape:(%d,%d)' %
-                          (img_idx, idx, patch_num, seg_map.shape[0], seg_map.shape[1]))
-
-                    # short the file name to avoid  error of " Argument list too long", hlc 2018-Oct-29
-                    file_name = "I%d_%d" % (img_idx, idx)
-
-                    save_path = os.path.join(FLAGS.inf_output_dir, file_name + '.tif')
-                    # if os.path.isfile(save_path):
-                    #     print('already exist, skip')
-                    #     idx += 1
-                    #     continue
-                    if b_use_memory:
-                        save_img_patch_list.append(img_patch)
-                        save_segmap_list.append(seg_map)
-                        save_path_list.append(save_path)
-                        # save one patch to disk, indicate the prediction has started and GPUs is occupied.
-                        if save_one_patch_to_disk is False:
-                            build_RS_data.save_patch_oneband_8bit(img_patch, seg_map.astype(np.uint8), save_path)
-                            save_one_patch_to_disk = True
-                    else:
-                        if build_RS_data.save_patch_oneband_8bit(img_patch,seg_map.astype(np.uint8),save_path) is False:
-                            return False
-
-                    idx += 1
-            except:
-                print('\nPrediction Error for multi_images with shape:%s \n\n'% str(multi_images.shape))
+                a_batch_seg_map = run_a_batch_of_patches(model, [item[2] for item in patch_data_list],
+                                                         FLAGS.inf_batch_size)
+            except Exception as e:
+                print('\nPrediction Error for patches %s of Image %d, error: %s \n\n' %
+                      (str([item[0] for item in patch_data_list]), img_idx, str(e)))
+                return False
+
+            #save
+            mosaic_boundaries = []
+            mosaic_seg_maps = []
+            for (idx, img_patch, _), seg_map in zip(patch_data_list, a_batch_seg_map):
+
+                print(datetime.now(),'Save segmentation result of Image:%d patch:%5d (total:%d), shape:(%d,%d)' %
+                      (img_idx, idx, patch_num, seg_map.shape[0], seg_map.shape[1]))
+
+                # short the file name to avoid  error of " Argument list too long", hlc 2018-Oct-29
+                file_name = "I%d_%d" % (img_idx, idx)
+
+                save_path = os.path.join(FLAGS.inf_output_dir, file_name + '.tif')
+                if mosaic is not None:
+                    # write into the mosaic batch by batch
+                    mosaic_boundaries.append(img_patch.boundary)
+                    mosaic_seg_maps.append(seg_map)
+                elif b_use_memory:
+                    save_img_patch_list.append(img_patch)
+                    save_segmap_list.append(seg_map)
+                    save_path_list.append(save_path)
+                    # save one patch to disk, indicate the prediction has started and GPUs is occupied.
+                    if save_one_patch_to_disk is False:
+                        save_patch_result(img_patch, seg_map, save_path, core_dict=core_dict)
+                        save_one_patch_to_disk = True
+                else:
+                    if save_patch_result(img_patch, seg_map, save_path, core_dict=core_dict) is False:
+                        return False
+
+            if len(mosaic_boundaries) > 0:
+                mosaic.write_batch(mosaic_boundaries, np.stack(mosaic_seg_maps, axis=0))
 
         if b_use_memory:
             # save predict patches to disk
             for idx, (img_patch,seg_map,save_path) in enumerate(zip(save_img_patch_list,save_segmap_list,save_path_list)):
                 print('Saving %d patch to disk, %d in total'%(idx, len(save_img_patch_list)))
-                if build_RS_data.save_patch_oneband_8bit(img_patch, seg_map.astype(np.uint8), save_path) is False:
+                if save_patch_result(img_patch, seg_map, save_path, core_dict=core_dict) is False:
                     return False
 
+        if mosaic is not None:
+            mosaic.close()
+
         # # inference patches one by one, but it is too slow
         # # Oct 30,2018
         # for (idx,img_patch) in enumerate(aImage_patches):
@@ -415,6 +625,34 @@ def inf_remoteSensing_image(model,image_path=None):
 
 
 
+def run_inference_worker(model):
+    """
+    run as a long-lived worker: the model is loaded once, then read jobs from stdin line by line, each line is
+    inf_list_file and inf_output_dir separated by a tab. After a job, write a line starting with
+    worker_done_prefix and the status (success or failed) to stdout. Stop at the end of stdin or the line "exit".
+    :param model: trained model
+    :return:
+    """
+    for line in sys.stdin:
+        line = line.strip()
+        if len(line) < 1:
+            continue
+        if line == 'exit':
+            break
+        inf_list_file, inf_output_dir = line.split('\t')
+        FLAGS.inf_list_file = inf_list_file
+        FLAGS.inf_output_dir = inf_output_dir
+        if os.path.isdir(inf_output_dir) is False:
+            os.makedirs(inf_output_dir)
+        try:
+            res = inf_remoteSensing_image(model)
+        except Exception as e:
+            print('Error, inference of %s failed: %s' % (inf_list_file, str(e)))
+            res = False
+        status = 'failed' if res is False else 'success'
+        print('%s%s\t%s' % (worker_done_prefix, status, inf_list_file))
+        sys.stdout.flush()
+
 def main(unused_argv):
 
     # model = DeepLabModel(download_path) # this input a tarball
@@ -427,14 +665,21 @@ def main(unused_argv):
     # for image in image_name:
     #     run_demo_image(model,image)
 
+    if FLAGS.inf_worker_mode:
+        run_inference_worker(model)
+        return
+
     os.system('mkdir -p ' + FLAGS.inf_output_dir)
-    inf_remoteSensing_image(model)
+    if inf_remoteSensing_image(model) is False:
+        sys.exit(1)
 
 if __name__ == '__main__':
     code_dir = os.path.join(os.path.dirname(sys.argv[0]), '..')
     sys.path.insert(0, code_dir)
     import parameters
     import datasets.build_RS_data as build_RS_data
+    import datasets.mosaic_patches as mosaic_patches
+    import datasets.raster_io as raster_io
 
     tf.app.run()
 
@@ -15,6 +15,7 @@ from torch.utils.data.dataset import Dataset
 import numpy as np
 from PIL import Image
 import re
+from multiprocessing.pool import ThreadPool
 
 code_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
 sys.path.insert(0, code_dir)
@@ -51,6 +52,108 @@ class RSPatchDataset(Dataset):
     def __len__(self):
         return len(self.img_list)
 
+def read_resize_one_patch(image_path, patch_size):
+    # read an image and resize it as the CLIP preprocess: resize the shorter side (bicubic), then centre crop
+    im = Image.open(image_path).convert('RGB')
+    width, height = im.size
+    scale = patch_size / float(min(width, height))
+    new_w, new_h = max(patch_size, int(round(width * scale))), max(patch_size, int(round(height * scale)))
+    im = im.resize((new_w, new_h), Image.BICUBIC)
+    left, top = (new_w - patch_size) // 2, (new_h - patch_size) // 2
+    im = im.crop((left, top, left + patch_size, top + patch_size))
+    return np.asarray(im, dtype=np.uint8)
+
+def pack_patches_to_memmap(image_path_list, save_prefix, patch_size=224, process_num=8):
+    '''
+    read and resize all the patches, then save them into one uint8 array (N, patch_size, patch_size, 3) (.npy),
+    the path of patches (in the order of the array) are saved in an index file.
+    If the packed files exist, have the same patches, and no patch is modified after packing, then use them.
+    :param image_path_list: the path of image patches
+    :param save_prefix: the prefix of the output files: save_prefix.npy and save_prefix_index.txt
+    :param patch_size: the width and height of patches after resizing (the input resolution of the model)
+    :param process_num: the number of threads for reading patches
+    :return: the path of the .npy file
+    '''
+    save_npy = save_prefix + '.npy'
+    save_index = save_prefix + '_index.txt'
+    if os.path.isfile(save_npy) and os.path.isfile(save_index):
+        packed = np.load(save_npy, mmap_mode='r')
+        if io_function.read_list_from_txt(save_index) == list(image_path_list) and packed.shape[1:3] == (patch_size, patch_size):
+            # patches re-generated at the same paths are newer than the packed file
+            pack_mtime = os.path.getmtime(save_npy)
+            newest_mtime = max([os.path.getmtime(item) for item in image_path_list] + [0])
+            if newest_mtime <= pack_mtime:
+                print('%s already exist and has the same %d patches, skip packing' % (save_npy, len(image_path_list)))
+                return save_npy
+            print('some patches are modified after packing %s, pack them again' % save_npy)
+        del packed
+
+    # write to a temporary file, then rename, an interrupted packing would not be used
+    tmp_npy = save_prefix + '_tmp.npy'
+    out = np.lib.format.open_memmap(tmp_npy, mode='w+', dtype=np.uint8,
+                                    shape=(len(image_path_list), patch_size, patch_size, 3))
+    def _pack_one(idx):
+        out[idx] = read_resize_one_patch(image_path_list[idx], patch_size)
+
+    with ThreadPool(max(process_num, 1)) as pool:
+        pool.map(_pack_one, range(len(image_path_list)))
+    out.flush()
+    del out
+    os.replace(tmp_npy, save_npy)
+    io_function.save_list_to_txt(save_index, list(image_path_list))
+    print('packed %d patches into %s' % (len(image_path_list), save_npy))
+    return save_npy
+
+class RSPackedPatchDataset(Dataset):
+    """
+    the same as RSPatchDataset, but read patches from the packed array (pack_patches_to_memmap),
+    avoiding opening many small files
+    """
+    def __init__(self, packed_npy, image_path_list, image_labels, label_txt = 'label.txt', transform=None, test=False):
+        self.packed_npy = packed_npy
+        self.data = None    # open in each worker of the data loader
+        self.img_list = image_path_list
+        self.labels = image_labels
+
+        label_list = [[item.split(',')[0], int(item.split(',')[1])] for item in io_function.read_list_from_txt(label_txt)]
+        label_list = np.array(label_list).T.tolist()    # switch the row and column
+        self.transform = transform
+        self.test = test
+
+        self.classes = label_list[0]
+
+    def __getitem__(self, index):
+        if self.data is None:
+            self.data = np.load(self.packed_npy, mmap_mode='r')
+        im_path = self.img_list[index]
+        label = self.labels[index]
+        im = self.data[index]
+        if self.transform is not None:
+            # the patch is already resized, the resize and crop in the transform do nothing
+            im = self.transform(Image.fromarray(im))
+
+        return im, label, im_path
+
+    def __len__(self):
+        return len(self.img_list)
+
+def create_patch_dataset(image_path_list, image_labels, label_txt='label.txt', transform=None, test=False,
+                         packed_prefix=None, patch_size=224, process_num=8):
+    # if packed_prefix is set, pack the patches into one array, then read them from it
+    if packed_prefix is None:
+        return RSPatchDataset(image_path_list, image_labels, label_txt=label_txt, transform=transform, test=test)
+    packed_npy = pack_patches_to_memmap(image_path_list, packed_prefix, patch_size=patch_size, process_num=process_num)
+    return RSPackedPatchDataset(packed_npy, image_path_list, image_labels, label_txt=label_txt, transform=transform,
+                                test=test)
+
+def get_packed_patch_settings(para_file):
+    # if b_pack_patches is Yes, return the patch size for packing, otherwise, None
+    b_pack_patches = parameters.get_bool_parameters_None_if_absence(para_file, 'b_pack_patches')
+    if b_pack_patches is not True:
+        return None
+    patch_size = parameters.get_digit_parameters_None_if_absence(para_file, 'packed_patch_size', 'int')
+    return 224 if patch_size is None else patch_size
+
 def get_class_labels_from_vector_file(img_path_list, vector_path):
     # the img_path_list are those subImages, generated by "get_subImages.py", using the "vector_path"
     if vector_gpd.is_field_name_in_shp(vector_path,'class_int') is False:
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# Filename: clip_feature_store.py
+"""
+introduction: save CLIP image features (the output of encode_image) of image patches and text features of prompts on disk,
+then running zero-shot classification with different prompts or thresholds on the same patches only needs
+matrix multiplications, no need to encode images again.
+
+For a model (model type + trained model), image features are in a binary file (float32, read by np.memmap),
+the row, modified time, size, and path of each patch are in an index file (one patch per line).
+A file lock is used when reading or writing them, so processes can share a store.
+
+authors: Huang Lingcao
+email:huanglingcao@gmail.com
+add time: 18 October, 2026
+"""
+
+import os, sys
+import json
+import hashlib
+import fcntl
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+import clip
+from tqdm import tqdm
+
+code_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, code_dir)
+import basic_src.basic as basic
+
+# save features as float32, the same as computing them without the store, so the store does not change results
+feature_dtype = np.float32
+
+
+def get_model_key(model_type, trained_model=None):
+    '''
+    get the key of a model, features of different models are saved in different files
+    :param model_type: CLIP model type, e.g., ViT-B/32
+    :param trained_model: the trained (fine-tuned) model, its path, size, and modified time are used
+    :return: a hex string
+    '''
+    key_dict = {'model_type': model_type}
+    if trained_model is not None and os.path.isfile(trained_model):
+        key_dict['trained_model'] = os.path.abspath(trained_model)
+        key_dict['size'] = os.path.getsize(trained_model)
+        key_dict['mtime'] = os.path.getmtime(trained_model)
+    key_str = json.dumps(key_dict, sort_keys=True)
+    return hashlib.sha1(key_str.encode('utf-8')).hexdigest()[:16]
+
+
+class ClipFeatureStore(object):
+    """
+    image features of patches (one row for one patch) and text features of prompts, for a model
+    """
+
+    def __init__(self, store_dir, model_key):
+        """
+        :param store_dir: the folder for saving features
+        :param model_key: the key from get_model_key
+        """
+        if os.path.isdir(store_dir) is False:
+            os.makedirs(store_dir, exist_ok=True)
+        self.store_dir = store_dir
+        self.model_key = model_key
+        # features saved in other types (e.g., float16 in old stores) or L2-normalised (old stores) are not used
+        file_pre = os.path.join(store_dir, 'image_features_%s_%s_raw' % (model_key, np.dtype(feature_dtype).name))
+        self.feature_path = file_pre + '.bin'
+        self.index_path = file_pre + '_index.txt'
+        self.meta_path = file_pre + '.json'
+        # processes (e.g., regions predicted in parallel) may share the store, lock it when reading or writing
+        self.lock_path = file_pre + '.lock'
+
+        self.dim = None
+        self.row_dict = {}  # image path: (row, mtime_ns, size)
+        self.features = None  # np.memmap, opened when needed
+        with self._lock():
+            self._load_index()
+
+    @contextmanager
+    def _lock(self):
+        with open(self.lock_path, 'a') as f_obj:
+            fcntl.flock(f_obj, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f_obj, fcntl.LOCK_UN)
+
+    def _load_index(self):
+        # read the index (with the lock), remove rows without features and features without rows (e.g., interrupted)
+        if self.dim is None and os.path.isfile(self.meta_path):
+            with open(self.meta_path) as f_obj:
+                self.dim = json.load(f_obj)['dim']
+        row_count = self._get_feature_row_count()
+        lines = []
+        if os.path.isfile(self.index_path):
+            with open(self.index_path) as f_obj:
+                lines = f_obj.read().splitlines()
+
+        row_dict = {}
+        valid_lines = []
+        max_row = -1
+        for line in lines:
+            # each line: row mtime_ns size path
+            tmp = line.split(' ', 3)
+            if len(tmp) != 4 or not (tmp[0].isdigit() and tmp[1].isdigit() and tmp[2].isdigit()):
+                continue
+            row = int(tmp[0])
+            if row >= row_count:
+                continue
+            # the later one is newer if a path was added more than once
+            row_dict[tmp[3]] = (row, int(tmp[1]), int(tmp[2]))
+            valid_lines.append(line)
+            max_row = max(max_row, row)
+
+        if len(valid_lines) != len(lines):
+            basic.outputlogMessage('warning, %d lines in the index of %s are invalid or have no features, remove them'
+                                   % (len(lines) - len(valid_lines), self.model_key))
+            with open(self.index_path, 'w') as f_obj:
+                f_obj.writelines([line + '\n' for line in valid_lines])
+        if row_count > max_row + 1:
+            basic.outputlogMessage('warning, %d rows of features of %s are not in the index, remove them'
+                                   % (row_count - max_row - 1, self.model_key))
+            self.features = None
+            with open(self.feature_path, 'r+b') as f_obj:
+                f_obj.truncate((max_row + 1) * self.dim * np.dtype(feature_dtype).itemsize)
+        self.row_dict = row_dict
+
+    def _get_feature_row_count(self):
+        if self.dim is None or os.path.isfile(self.feature_path) is False:
+            return 0
+        return os.path.getsize(self.feature_path) // (self.dim * np.dtype(feature_dtype).itemsize)
+
+    def _open_features(self):
+        row_count = self._get_feature_row_count()
+        if self.features is None or self.features.shape[0] != row_count:
+            if row_count < 1:
+                self.features = np.zeros((0, 0 if self.dim is None else self.dim), dtype=feature_dtype)
+            else:
+                self.features = np.memmap(self.feature_path, dtype=feature_dtype, mode='r', shape=(row_count, self.dim))
+        return self.features
+
+    def _get_row(self, image_path):
+        # the row of an image, None if not in the store or the image is modified after adding
+        item = self.row_dict.get(os.path.abspath(image_path))
+        if item is None:
+            return None
+        stat = os.stat(image_path)
+        if item[1] != stat.st_mtime_ns or item[2] != stat.st_size:
+            return None
+        return item[0]
+
+    def get_missing_paths(self, image_paths):
+        # the images without features in the store (or modified after adding), read the index again,
+        # features added by other processes are used
+        with self._lock():
+            self._load_index()
+        return [item for item in image_paths if self._get_row(item) is None]
+
+    def add_image_features(self, image_paths, features):
+        '''
+        add image features
+        :param image_paths: a list of image paths
+        :param features: (N, dim) array, image features (the output of encode_image)
+        :return:
+        '''
+        features = np.asarray(features, dtype=feature_dtype)
+        if features.ndim != 2 or features.shape[0] != len(image_paths):
+            raise ValueError('the shape of features %s does not match the count of images (%d)'
+                             % (str(features.shape), len(image_paths)))
+        with self._lock():
+            if self.dim is None and os.path.isfile(self.meta_path):
+                with open(self.meta_path) as f_obj:
+                    self.dim = json.load(f_obj)['dim']
+            if self.dim is None:
+                self.dim = int(features.shape[1])
+                with open(self.meta_path, 'w') as f_obj:
+                    json.dump({'dim': self.dim, 'dtype': np.dtype(feature_dtype).name}, f_obj)
+            elif features.shape[1] != self.dim:
+                raise ValueError('the dimension of features (%d) is different from the store (%d)'
+                                 % (features.shape[1], self.dim))
+            row = self._get_feature_row_count()
+            # write features first, then the index (with the row numbers), a row in the index always has features
+            with open(self.feature_path, 'ab') as f_obj:
+                f_obj.write(np.ascontiguousarray(features).tobytes())
+            lines = []
+            for path in image_paths:
+                path = os.path.abspath(path)
+                stat = os.stat(path)
+                lines.append('%d %d %d %s\n' % (row, stat.st_mtime_ns, stat.st_size, path))
+                self.row_dict[path] = (row, stat.st_mtime_ns, stat.st_size)
+                row += 1
+            with open(self.index_path, 'a') as f_obj:
+                f_obj.writelines(lines)
+
+    def get_image_features(self, image_paths):
+        '''
+        get image features
+        :param image_paths: a list of image paths, all of them should be in the store
+        :return: (N, dim) float32 array
+        '''
+        rows = [self._get_row(item) for item in image_paths]
+        missing = [path for path, row in zip(image_paths, rows) if row is None]
+        if len(missing) > 0:
+            raise ValueError('%d images are not in the store (or modified), e.g., %s' % (len(missing), missing[0]))
+        features = self._open_features()
+        return np.asarray(features[rows], dtype=np.float32)
+
+    def get_text_features(self, model, prompt, classes, device):
+        '''
+        get the L2-normalised text features of the prompt for classes, encode and save them if not in the store
+        :param model: CLIP model
+        :param prompt: the prompt template, e.g., "a photo of {}"
+        :param classes: a list of class names
+        :param device: device
+        :return: (class_count, dim) tensor on the device
+        '''
+        text_descriptions = [prompt.format(label) for label in classes]
+        text_key = hashlib.sha1(json.dumps(text_descriptions).encode('utf-8')).hexdigest()[:16]
+        save_path = os.path.join(self.store_dir, 'text_features_%s_%s.npy' % (self.model_key, text_key))
+        if os.path.isfile(save_path):
+            text_features = np.load(save_path)
+        else:
+            text_tokens = clip.tokenize(text_descriptions).to(device)
+            with torch.no_grad():
+                text_features = model.encode_text(text_tokens).float()
+            text_features /= text_features.norm(dim=-1, keepdim=True)
+            text_features = text_features.cpu().numpy()
+            np.save(save_path, text_features)
+        return torch.from_numpy(text_features).float().to(device)
+
+
+def get_dataset_image_features(model, data_loader, device, feature_store):
+    '''
+    get the image features (not normalised, the same as run_prediction) of all images in a data loader (RSPatchDataset),
+    only the images not in the store are encoded
+    :param model: CLIP model
+    :param data_loader: data loader
+    :param device: device
+    :param feature_store: ClipFeatureStore
+    :return: (N, dim) float32 array of features, (N,) array of labels, in the order of the dataset
+    '''
+    dataset = data_loader.dataset
+    missing_paths = set(feature_store.get_missing_paths(dataset.img_list))
+    basic.outputlogMessage('%d of %d images have features in the store, encoding the others'
+                           % (len(dataset.img_list) - len(missing_paths), len(dataset.img_list)))
+    if len(missing_paths) > 0:
+        missing_idx = [idx for idx, path in enumerate(dataset.img_list) if path in missing_paths]
+        missing_loader = torch.utils.data.DataLoader(
+            torch.utils.data.Subset(dataset, missing_idx),
+            batch_size=data_loader.batch_size, shuffle=False,
+            num_workers=data_loader.num_workers, pin_memory=True)
+        with torch.no_grad():
+            for images, _, im_paths in tqdm(missing_loader):
+                image_features = model.encode_image(images.to(device)).float()
+                feature_store.add_image_features(list(im_paths), image_features.cpu().numpy())
+
+    features = feature_store.get_image_features(dataset.img_list)
+    labels = np.array(dataset.labels)
+    return features, labels
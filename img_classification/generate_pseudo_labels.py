@@ -18,16 +18,16 @@ import basic_src.io_function as io_function
 import parameters
 
 import class_utils
-from prediction_clip import prepare_dataset, run_prediction, calculate_top_k_accuracy
+from prediction_clip import prepare_dataset, run_prediction, calculate_top_k_accuracy, get_clip_feature_store
 from train_clip import prepare_training_data, log_string
 
 import torch
 import clip
 
 def generate_pseudo_labels(dataset, data_loader, save_dir, device, model, clip_prompt,
-                          probs_thr=0.6, topk=10, version=1):
+                          probs_thr=0.6, topk=10, version=1, feature_store=None):
     # run prediction
-    predict_probs, ground_truths = run_prediction(model,data_loader, clip_prompt, device)
+    predict_probs, ground_truths = run_prediction(model,data_loader, clip_prompt, device, feature_store=feature_store)
 
     # save the results, as training data
     classes = dataset.classes
@@ -86,8 +86,10 @@ def generate_pseudo_labels_main(para_file, trained_model = None, v_num=1, topk=1
 
     # get pseudo labels
     clip_prompt = parameters.get_string_parameters(para_file, 'clip_prompt')
+    feature_store = get_clip_feature_store(para_file, model_type, trained_model=trained_model)
     training_samples_txt = generate_pseudo_labels(dataset, data_loader, train_save_dir, device, model, clip_prompt,
-                                                      probs_thr=probability_threshold, topk=topk, version=v_num)
+                                                      probs_thr=probability_threshold, topk=topk, version=v_num,
+                                                      feature_store=feature_store)
 
     log_string('saved pseudo labels to %s'%training_samples_txt)
 
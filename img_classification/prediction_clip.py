@@ -33,7 +33,8 @@ import basic_src.timeTools as timeTools
 from multiprocessing import Process
 # import torch.multiprocessing as Process
 
-from class_utils import RSPatchDataset, get_accuracy_log_path
+from class_utils import get_accuracy_log_path, create_patch_dataset, get_packed_patch_settings
+from clip_feature_store import ClipFeatureStore, get_model_key, get_dataset_image_features
 from get_organize_training_data import extract_sub_image_labels_one_region, read_sub_image_labels_one_region, read_label_ids_local
 from postProcess_classify import select_sample_for_manu_check
 
@@ -187,21 +188,59 @@ def prepare_dataset(para_file, area_ini, area_save_dir, image_dir, image_or_patt
 
     if area_data_type == 'image_patch':
         image_path_list, image_labels, _ =  read_sub_image_labels_one_region(extract_img_dir,para_file,area_ini,b_training= not test)
-        input_data = RSPatchDataset(image_path_list, image_labels, label_txt=class_labels, transform=transform, test = test)
-
     elif area_data_type == 'image_vector':
         image_path_list, image_labels, _ = extract_sub_image_labels_one_region(extract_img_dir,para_file,area_ini,b_training= not test)
-        input_data = RSPatchDataset(image_path_list, image_labels, label_txt=class_labels, transform=transform, test = test)
     else:
         raise ValueError('Unknown area data type: %s, only accept: image_patch and image_vector'%area_data_type)
 
+    # pack the resized patches into one file, avoid opening many small files
+    packed_patch_size = get_packed_patch_settings(para_file)
+    packed_prefix = None
+    process_num = 8
+    if packed_patch_size is not None and len(image_path_list) > 0:
+        packed_prefix = os.path.join(extract_img_dir, 'packed_patches_%d' % packed_patch_size)
+        # the number of threads for packing, only needed when packing patches
+        pack_process_num = parameters.get_digit_parameters_None_if_absence(para_file, 'process_num', 'int')
+        if pack_process_num is not None:
+            process_num = pack_process_num
+    input_data = create_patch_dataset(image_path_list, image_labels, label_txt=class_labels, transform=transform,
+                                      test=test, packed_prefix=packed_prefix, patch_size=packed_patch_size,
+                                      process_num=process_num)
+
     basic.outputlogMessage('read %d images for prediction'%len(input_data))
     return input_data
 
-def run_prediction(model, test_loader,prompt, device):
+def get_clip_feature_store(para_file, model_type, trained_model=None):
+    # the store of image and text features, None if clip_feature_store_dir is not set
+    store_dir = parameters.get_directory_None_if_absence(para_file, 'clip_feature_store_dir')
+    if store_dir is None:
+        return None
+    model_key = get_model_key(model_type, trained_model=trained_model)
+    basic.outputlogMessage('use CLIP features in %s (model key: %s)' % (store_dir, model_key))
+    return ClipFeatureStore(store_dir, model_key)
+
+def run_prediction_with_store(model, test_loader, prompt, device, feature_store):
+    # run zero-shot prediction using the image and text features in the store (encode those not in it)
+    text_features = feature_store.get_text_features(model, prompt, test_loader.dataset.classes, device)
+    image_features, labels = get_dataset_image_features(model, test_loader, device, feature_store)
+    # skip the batches with only one image, as run_prediction (targets.ndim == 0 after squeeze)
+    keep = np.ones(len(labels), dtype=bool)
+    batch_size = test_loader.batch_size
+    for start in range(0, len(labels), batch_size):
+        if min(batch_size, len(labels) - start) == 1:
+            basic.outputlogMessage(f"error: targets.ndim == 0, batch starting at {start} has one image, skip it")
+            keep[start:start + batch_size] = False
+    image_features = torch.from_numpy(image_features[keep]).to(device)
+    pre_probs = (100.0 * image_features @ text_features.T).softmax(dim=-1)
+    gts = torch.from_numpy(labels[keep]).to(device)
+    return pre_probs, gts
+
+def run_prediction(model, test_loader,prompt, device, feature_store=None):
 
     model.eval()
     model.float()
+    if feature_store is not None:
+        return run_prediction_with_store(model, test_loader, prompt, device, feature_store)
     text_descriptions = [prompt.format(label) for label in test_loader.dataset.classes]
     # text_tokens = clip.tokenize(text_descriptions).cuda()
     text_tokens = clip.tokenize(text_descriptions).to(device)
@@ -275,7 +314,9 @@ def predict_remoteSensing_data(para_file, area_idx, area_ini, area_save_dir,mode
         batch_size=batch_size, shuffle=False,
         num_workers=num_workers, pin_memory=True)
 
-    pre_probs, ground_truths = run_prediction(model, test_loader, clip_prompt, device)
+    # if the image features are in the store, no need to encode the images again
+    feature_store = get_clip_feature_store(para_file, model_type, trained_model=trained_model)
+    pre_probs, ground_truths = run_prediction(model, test_loader, clip_prompt, device, feature_store=feature_store)
 
     save_path = os.path.join(area_save_dir, os.path.basename(area_save_dir)+'-classify_results.json' )
     save_k = min(5, len(in_dataset.classes))
@@ -72,8 +72,19 @@ def create_training_data_from_txt(para_file, train_data_txt, preprocess, test=Fa
     image_path_labels = [item.split() for item in io_function.read_list_from_txt(train_data_txt)]
     image_path_list = [item[0] for item in image_path_labels]  # it's already absolute path
     image_labels = [int(item[1]) for item in image_path_labels]
-    train_dataset = class_utils.RSPatchDataset(image_path_list, image_labels, label_txt=class_labels,
-                                               transform=preprocess, test=test)
+    # pack the resized patches into one file, avoid opening many small files
+    packed_patch_size = class_utils.get_packed_patch_settings(para_file)
+    packed_prefix = None
+    process_num = 8
+    if packed_patch_size is not None and len(image_path_list) > 0:
+        packed_prefix = os.path.splitext(train_data_txt)[0] + '_packed_%d' % packed_patch_size
+        # the number of threads for packing, only needed when packing patches
+        pack_process_num = parameters.get_digit_parameters_None_if_absence(para_file, 'process_num', 'int')
+        if pack_process_num is not None:
+            process_num = pack_process_num
+    train_dataset = class_utils.create_patch_dataset(image_path_list, image_labels, label_txt=class_labels,
+                                                     transform=preprocess, test=test, packed_prefix=packed_prefix,
+                                                     patch_size=packed_patch_size, process_num=process_num)
     return train_dataset
 
 def prepare_training_data(WORK_DIR, para_file, transform, test=False):
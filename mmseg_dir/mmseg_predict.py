@@ -13,7 +13,9 @@ import os.path as osp
 from optparse import OptionParser
 from datetime import datetime
 import time
-import GPUtil
+import multiprocessing
+import threading
+import queue
 # from multiprocessing import Process
 
 code_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
@@ -22,10 +24,13 @@ import parameters
 import basic_src.io_function as io_function
 import basic_src.basic as basic
 import datasets.raster_io as raster_io
+import datasets.split_image as split_image
+import datasets.mosaic_patches as mosaic_patches
+import workflow.gpu_scheduler as gpu_scheduler
 
 import mmcv
 import torch
-from torch.multiprocessing import Process,set_start_method
+from torch.multiprocessing import set_start_method
 try:
      set_start_method('spawn')
 except RuntimeError:
@@ -43,7 +48,6 @@ print('mmseg_path:',mmseg.__path__)
 from mmseg.apis import multi_gpu_test, single_gpu_test
 from mmseg.datasets import build_dataloader, build_dataset
 from mmseg.models import build_segmentor
-from mmcv.image import tensor2imgs
 
 import numpy as np
 
@@ -63,11 +67,19 @@ def is_file_exist_in_folder(folder):
         return True
 
 
-def single_gpu_prediction_rsImage(model,data_loader,out_dir=None):
+def single_gpu_prediction_rsImage(model,data_loader,out_dir=None, core_dict=None, mosaic=None, write_thread_num=2):
+    '''
+    run prediction of the patches in a data loader, the results are saved by writer threads
+    :param model: the model
+    :param data_loader: the data loader of an image
+    :param out_dir: the folder for saving results of patches
+    :param core_dict: a dict of patch boundary: core boundary, if set, only save the core of each patch
+    :param mosaic: a PatchMosaic of the entire image, if it is not None, write results into it
+    :param write_thread_num: the number of threads for saving results
+    :return: True
+    '''
     model.eval()
-    # results = []
     dataset = data_loader.dataset
-    # prog_bar = mmcv.ProgressBar(len(dataset))
     # The pipeline about how the data_loader retrieval samples from dataset:
     # sampler -> batch_sampler -> indices
     # The indices are passed to dataset_fetcher to get data from dataset.
@@ -76,45 +88,69 @@ def single_gpu_prediction_rsImage(model,data_loader,out_dir=None):
     loader_indices = data_loader.batch_sampler
     patch_count = len(dataset)
 
-    for batch_indices, data in zip(loader_indices, data_loader):
-        with torch.no_grad():
-            result = model(return_loss=False, **data)
-
-        img_tensor = data['img'][0]
-        img_metas = data['img_metas'][0].data[0]
-        imgs = tensor2imgs(img_tensor, **img_metas[0]['img_norm_cfg'])
-        assert len(imgs) == len(img_metas)
-
-        for img, img_meta, res in zip(imgs, img_metas,result):
-            # h, w, _ = img_meta['img_shape']
-            # img_show = img[:h, :w, :]
-            #
-            # ori_h, ori_w = img_meta['ori_shape'][:-1]
-            # img_show = mmcv.imresize(img_show, (ori_w, ori_h))
-
-            save_path = osp.join(out_dir,img_meta['filename'])
-            org_img = img_meta['ori_filename']
-            boundary = img_meta['boundary']
-            # save the patch
-            print('saving patch:%s results of %s, total: %d'%(img_meta['filename'],osp.basename(org_img),patch_count))
-            res_8bit = res.astype(dtype=np.uint8)
-            raster_io.save_numpy_array_to_rasterfile(res_8bit,save_path,org_img,boundary=boundary,verbose=False)
-
-        # results.extend(result)
-
-        # batch_size = len(result)
-        # for _ in range(batch_size):
-        #     prog_bar.update()
-
-    # return results
+    # save results in other threads, the GPU doesn't need to wait for writing files
+    write_queue = queue.Queue(maxsize=write_thread_num*4)
+    write_errors = []
+
+    def write_worker():
+        while True:
+            item = write_queue.get()
+            if item is None:
+                break
+            save_path, org_img, boundary, res_8bit = item
+            try:
+                if mosaic is not None:
+                    mosaic.write_patch(boundary, res_8bit)
+                    continue
+                # only save the core (non-overlapping) region of the patch
+                if core_dict is not None and tuple(int(v) for v in boundary) in core_dict:
+                    core = core_dict[tuple(int(v) for v in boundary)]
+                    res_8bit = mosaic_patches.crop_patches_to_core([res_8bit], [boundary], [core])[0]
+                    boundary = core
+                raster_io.save_numpy_array_to_rasterfile(res_8bit,save_path,org_img,boundary=boundary,verbose=False)
+            except Exception as e:
+                write_errors.append(e)
+
+    writers = [threading.Thread(target=write_worker) for _ in range(write_thread_num)]
+    for w in writers:
+        w.start()
+
+    try:
+        for batch_indices, data in zip(loader_indices, data_loader):
+            if len(write_errors) > 0:
+                break
+            with torch.no_grad():
+                result = model(return_loss=False, **data)
+
+            # only the metas are needed for saving, no need to convert the tensor back to images (tensor2imgs)
+            img_metas = data['img_metas'][0].data[0]
+            assert len(result) == len(img_metas)
+
+            for img_meta, res in zip(img_metas,result):
+                save_path = osp.join(out_dir,img_meta['filename'])
+                org_img = img_meta['ori_filename']
+                boundary = img_meta['boundary']
+                print('saving patch:%s results of %s, total: %d'%(img_meta['filename'],osp.basename(org_img),patch_count))
+                write_queue.put((save_path, org_img, boundary, res.astype(dtype=np.uint8)))
+    finally:
+        for _ in writers:
+            write_queue.put(None)
+        for w in writers:
+            w.join()
+
+    if len(write_errors) > 0:
+        raise write_errors[0]
     return True
 
-def predict_rsImage_mmseg(config_file,trained_model,image_path, img_save_dir,batch_size=1,gpuid=0,
-                          tile_width=480, tile_height=480, overlay_x=160, overlay_y=160):
+def load_mmseg_config(config_file):
     cfg = mmcv.Config.fromfile(config_file)
     if cfg.get('cudnn_benchmark', False):
         torch.backends.cudnn.benchmark = True
     cfg.data.test.test_mode = True
+    return cfg
+
+def build_rsImage_dataloader(cfg, image_path, batch_size=1, tile_width=480, tile_height=480, overlay_x=160, overlay_y=160):
+    # build the dataset and data loader of an image, the model can be reused for different images
     distributed = False
 
     # test_mode=False,rsimage='',rsImg_id=0,tile_width=480,tile_height=480,
@@ -129,7 +165,17 @@ def predict_rsImage_mmseg(config_file,trained_model,image_path, img_save_dir,bat
         workers_per_gpu=cfg.data.workers_per_gpu,
         dist=distributed,
         shuffle=False)
-
+    return data_loader
+
+def build_mmseg_model(cfg, trained_model, dataset, gpuid=0):
+    '''
+    build the segmentor and load the checkpoint, then it can be used for many images
+    :param cfg: the config
+    :param trained_model: the checkpoint
+    :param dataset: a dataset, for getting CLASSES and PALETTE if they are not in the checkpoint
+    :param gpuid: GPU id
+    :return: the model (MMDataParallel)
+    '''
     cfg.model.train_cfg = None
     model = build_segmentor(cfg.model, test_cfg=cfg.get('test_cfg'))
     fp16_cfg = cfg.get('fp16', None)
@@ -152,14 +198,57 @@ def predict_rsImage_mmseg(config_file,trained_model,image_path, img_save_dir,bat
 
     # no distributed
     model = MMDataParallel(model, device_ids=[gpuid])
-    single_gpu_prediction_rsImage(model,data_loader, img_save_dir)
+    return model
+
+def predict_rsImage_with_model(cfg, model, image_path, img_save_dir, batch_size=1, tile_width=480, tile_height=480,
+                               overlay_x=160, overlay_y=160, b_save_patch_core=False, data_loader=None,
+                               output_mode='patches', overlap_policy='centre_crop', num_classes=2, write_thread_num=2):
+    # run prediction of an image using a built model
+    if data_loader is None:
+        data_loader = build_rsImage_dataloader(cfg, image_path, batch_size=batch_size, tile_width=tile_width,
+                                               tile_height=tile_height, overlay_x=overlay_x, overlay_y=overlay_y)
+    core_dict = None
+    mosaic = None
+    if b_save_patch_core or output_mode == 'mosaic':
+        # the dataset splits the image using the same sliding window
+        height, width, _, _ = raster_io.get_height_width_bandnum_dtype(image_path)
+        patch_boundaries = split_image.sliding_window_array(width, height, tile_width, tile_height,
+                                                            adj_overlay_x=overlay_x, adj_overlay_y=overlay_y)
+        if output_mode == 'mosaic':
+            # write all the results into one file, postProcess.py uses it instead of merging patches
+            mosaic = mosaic_patches.PatchMosaic(image_path, osp.join(img_save_dir, 'I0_mosaic.tif'),
+                                                patch_boundaries=patch_boundaries, policy=overlap_policy,
+                                                num_classes=num_classes)
+        else:
+            core_dict = mosaic_patches.get_patch_core_dict(patch_boundaries, width, height)
+    res = False
+    try:
+        res = single_gpu_prediction_rsImage(model,data_loader, img_save_dir, core_dict=core_dict, mosaic=mosaic,
+                                            write_thread_num=write_thread_num)
+    finally:
+        if mosaic is not None:
+            # a failed or interrupted mosaic is removed, not used as the result
+            mosaic.close(b_complete=res is not False)
+    return res
+
+def predict_rsImage_mmseg(config_file,trained_model,image_path, img_save_dir,batch_size=1,gpuid=0,
+                          tile_width=480, tile_height=480, overlay_x=160, overlay_y=160, b_save_patch_core=False,
+                          output_mode='patches', overlap_policy='centre_crop', num_classes=2, write_thread_num=2):
+    cfg = load_mmseg_config(config_file)
+    data_loader = build_rsImage_dataloader(cfg, image_path, batch_size=batch_size, tile_width=tile_width,
+                                           tile_height=tile_height, overlay_x=overlay_x, overlay_y=overlay_y)
+    model = build_mmseg_model(cfg, trained_model, data_loader.dataset, gpuid=gpuid)
+    predict_rsImage_with_model(cfg, model, image_path, img_save_dir, batch_size=batch_size, tile_width=tile_width,
+                               tile_height=tile_height, overlay_x=overlay_x, overlay_y=overlay_y,
+                               b_save_patch_core=b_save_patch_core, data_loader=data_loader,
+                               output_mode=output_mode, overlap_policy=overlap_policy, num_classes=num_classes,
+                               write_thread_num=write_thread_num)
 
 
 
 
-def predict_one_image_mmseg(para_file, image_path, img_save_dir, inf_list_file, gpuid,trained_model):
-    """ run prediction of one image
-    """
+def get_inference_settings(para_file):
+    # get the config file and the settings of inference from parameter files
     expr_name = parameters.get_string_parameters(para_file, 'expr_name')
     network_ini = parameters.get_string_parameters(para_file, 'network_setting_ini')
     base_config_file = parameters.get_string_parameters(network_ini, 'base_config')
@@ -171,6 +260,29 @@ def predict_one_image_mmseg(para_file, image_path, img_save_dir, inf_list_file,
     patch_height = parameters.get_digit_parameters(para_file,'inf_patch_height','int')
     adj_overlay_x = parameters.get_digit_parameters(para_file,'inf_pixel_overlay_x','int')
     adj_overlay_y = parameters.get_digit_parameters(para_file,'inf_pixel_overlay_y','int')
+    b_save_patch_core = parameters.get_bool_parameters_None_if_absence(para_file,'b_inf_save_patch_core')
+    # save results of patches to separate files (patches) or one file of the entire image (mosaic)
+    output_mode = parameters.get_string_parameters_None_if_absence(para_file,'inf_output_mode')
+    if output_mode is None:
+        output_mode = 'patches'
+    if output_mode not in ['patches', 'mosaic']:
+        raise ValueError('unknown inf_output_mode: %s, should be patches or mosaic'%output_mode)
+    overlap_policy = parameters.get_string_parameters_None_if_absence(para_file,'inf_mosaic_overlap_policy')
+    if overlap_policy is None:
+        overlap_policy = 'centre_crop'
+    num_classes_noBG = parameters.get_digit_parameters_None_if_absence(para_file,'NUM_CLASSES_noBG','int')
+    write_thread_num = parameters.get_digit_parameters_None_if_absence(para_file,'inf_write_thread_num','int')
+    settings = {'batch_size': inf_batch_size, 'tile_width': patch_width, 'tile_height': patch_height,
+                'overlay_x': adj_overlay_x, 'overlay_y': adj_overlay_y, 'b_save_patch_core': b_save_patch_core is True,
+                'output_mode': output_mode, 'overlap_policy': overlap_policy,
+                'num_classes': 2 if num_classes_noBG is None else num_classes_noBG + 1,
+                'write_thread_num': 2 if write_thread_num is None else write_thread_num}
+    return config_file, settings
+
+def predict_one_image_mmseg(para_file, image_path, img_save_dir, inf_list_file, gpuid,trained_model):
+    """ run prediction of one image
+    """
+    config_file, settings = get_inference_settings(para_file)
 
     done_indicator = '%s_done'%inf_list_file
     if os.path.isfile(done_indicator):
@@ -183,8 +295,7 @@ def predict_one_image_mmseg(para_file, image_path, img_save_dir, inf_list_file,
     if gpuid is None:
         gpuid = 0
 
-    predict_rsImage_mmseg(config_file, trained_model, image_path, img_save_dir, batch_size=inf_batch_size,gpuid=gpuid,
-                          tile_width=patch_width, tile_height=patch_height, overlay_x=adj_overlay_x, overlay_y=adj_overlay_y)
+    predict_rsImage_mmseg(config_file, trained_model, image_path, img_save_dir, gpuid=gpuid, **settings)
 
     duration = time.time() - time0
     os.system('echo "$(date): time cost of inference for image in %s: %.2f seconds">>"time_cost.txt"' % (inf_list_file, duration))
@@ -193,6 +304,42 @@ def predict_one_image_mmseg(para_file, image_path, img_save_dir, inf_list_file,
 
     return
 
+def predict_images_mmseg(para_file, image_queue, gpuid, trained_model):
+    """ run prediction of many images, the model is built once, then a data loader is built for each image.
+    :param image_queue: a queue of (image_path, img_save_dir, inf_list_file), stop when getting None
+    """
+    config_file, settings = get_inference_settings(para_file)
+    if gpuid is None:
+        gpuid = 0
+    cfg = load_mmseg_config(config_file)
+    model = None
+
+    while True:
+        job = image_queue.get()
+        if job is None:
+            break
+        image_path, img_save_dir, inf_list_file = job
+        done_indicator = '%s_done' % inf_list_file
+        if os.path.isfile(done_indicator):
+            basic.outputlogMessage('warning, %s exist, skip prediction' % done_indicator)
+            continue
+        if os.path.isdir(img_save_dir) is False:
+            io_function.mkdir(img_save_dir)
+        time0 = time.time()
+
+        data_loader = build_rsImage_dataloader(cfg, image_path, batch_size=settings['batch_size'],
+                                               tile_width=settings['tile_width'], tile_height=settings['tile_height'],
+                                               overlay_x=settings['overlay_x'], overlay_y=settings['overlay_y'])
+        if model is None:
+            # the dataset of the first image is used if CLASSES or PALETTE not in the checkpoint
+            model = build_mmseg_model(cfg, trained_model, data_loader.dataset, gpuid=gpuid)
+        predict_rsImage_with_model(cfg, model, image_path, img_save_dir, data_loader=data_loader, **settings)
+
+        duration = time.time() - time0
+        os.system('echo "$(date): time cost of inference for image in %s: %.2f seconds">>"time_cost.txt"' % (inf_list_file, duration))
+        # write a file to indicate that the prediction has done.
+        os.system('echo %s > %s_done' % (inf_list_file, inf_list_file))
+
 
 def mmseg_parallel_predict_main(para_file,trained_model):
 
@@ -229,9 +376,17 @@ def mmseg_parallel_predict_main(para_file,trained_model):
     # get name of inference areas
     multi_inf_regions = parameters.get_string_list_parameters(para_file, 'inference_regions')
     b_use_multiGPUs = parameters.get_bool_parameters(para_file, 'b_use_multiGPUs')
+    # keep the model on each GPU for all the images, instead of building the model for each image
+    b_persistent_worker = parameters.get_bool_parameters_None_if_absence(para_file, 'b_inf_persistent_worker')
 
+    # the number of images running on a GPU at the same time
+    jobs_per_gpu = parameters.get_digit_parameters_None_if_absence(para_file, 'inf_jobs_per_gpu', 'int')
+    if jobs_per_gpu is None:
+        jobs_per_gpu = 1
+
+    # (image path, save_dir, inf_list_file) of all the images in all the regions
+    all_images = []
     # loop each inference regions
-    sub_tasks = []
     for area_idx, area_ini in enumerate(multi_inf_regions):
 
         area_name = parameters.get_string_parameters(area_ini, 'area_name')
@@ -251,98 +406,49 @@ def mmseg_parallel_predict_main(para_file,trained_model):
         area_save_dir = os.path.join(outdir, area_name + '_' + area_remark + '_' + area_time)
         io_function.mkdir(area_save_dir)
 
-        # parallel inference images for this area
-        CUDA_VISIBLE_DEVICES = []
-        if 'CUDA_VISIBLE_DEVICES' in os.environ.keys():
-            CUDA_VISIBLE_DEVICES = [int(item.strip()) for item in os.environ['CUDA_VISIBLE_DEVICES'].split(',')]
-        idx = 0
-        while idx < img_count:
-
-            if b_use_multiGPUs:
-                # get available GPUs  # https://github.com/anderskm/gputil
-                # memory: orders the available GPU device ids by ascending memory usage
-                deviceIDs = GPUtil.getAvailable(order='memory', limit=100, maxLoad=0.5,
-                                                maxMemory=0.5, includeNan=False, excludeID=[], excludeUUID=[])
-                # only use the one in CUDA_VISIBLE_DEVICES
-                if len(CUDA_VISIBLE_DEVICES) > 0:
-                    deviceIDs = [item for item in deviceIDs if item in CUDA_VISIBLE_DEVICES]
-                    basic.outputlogMessage('on ' + machine_name + ', available GPUs:' + str(deviceIDs) +
-                                           ', among visible ones:' + str(CUDA_VISIBLE_DEVICES))
-                else:
-                    basic.outputlogMessage('on ' + machine_name + ', available GPUs:' + str(deviceIDs))
-
-                if len(deviceIDs) < 1:
-                    time.sleep(60)  # wait 60 seconds (mmseg need longer time to load models) , then check the available GPUs again
-                    continue
-                # set only the first available visible
-                gpuid = deviceIDs[0]
-                basic.outputlogMessage('%d: predict image %s on GPU %d of %s' % (idx, inf_img_list[idx], gpuid, machine_name))
-            else:
-                gpuid = None
-                basic.outputlogMessage('%d: predict image %s on %s' % (idx, inf_img_list[idx], machine_name))
-
-            # run inference
+        for idx in range(img_count):
             img_save_dir = os.path.join(area_save_dir, 'I%d' % idx)
             inf_list_file = os.path.join(area_save_dir, '%d.txt' % idx)
 
             done_indicator = '%s_done' % inf_list_file
             if os.path.isfile(done_indicator):
                 basic.outputlogMessage('warning, %s exist, skip prediction' % done_indicator)
-                idx += 1
                 continue
 
             # if it already exist, then skip
             if os.path.isdir(img_save_dir) and is_file_exist_in_folder(img_save_dir):
                 basic.outputlogMessage('folder of %dth image (%s) already exist, '
                                        'it has been predicted or is being predicted' % (idx, inf_img_list[idx]))
-                idx += 1
                 continue
 
             with open(inf_list_file, 'w') as inf_obj:
                 inf_obj.writelines(inf_img_list[idx] + '\n')
+            basic.outputlogMessage('%d: predict image %s on %s' % (idx, inf_img_list[idx], machine_name))
+            all_images.append((inf_img_list[idx], img_save_dir, inf_list_file))
+
+    # predict the largest images first, then the small ones fill the gaps on GPUs at the end
+    all_images = gpu_scheduler.sort_jobs_by_pixel_count(all_images, [item[0] for item in all_images])
+
+    if len(all_images) > 0:
+        scheduler = gpu_scheduler.GPUScheduler(gpu_scheduler.get_scheduler_gpus(b_use_multiGPUs, order='memory'),
+                                               jobs_per_gpu=jobs_per_gpu)
+        if b_persistent_worker:
+            # one job for each GPU slot, it builds the model once and gets images from the queue
+            worker_count = min(len(scheduler.gpu_ids) * jobs_per_gpu, len(all_images))
+            image_queue = multiprocessing.Queue()
+            for item in all_images:
+                image_queue.put(item)
+            for _ in range(worker_count):
+                image_queue.put(None)
+            jobs = [(predict_images_mmseg, (para_file, image_queue), {'trained_model': trained_model})
+                    for _ in range(worker_count)]
+        else:
+            jobs = [(predict_one_image_mmseg, (para_file, image_path, img_save_dir, inf_list_file),
+                     {'trained_model': trained_model}) for image_path, img_save_dir, inf_list_file in all_images]
+        # start the next job as soon as a GPU slot is free
+        if len(scheduler.run(jobs)) > 0:
+            sys.exit(1)
 
-            sub_process = Process(target=predict_one_image_mmseg,
-                                  args=(para_file,inf_img_list[idx], img_save_dir, inf_list_file,
-                                        gpuid, trained_model))
-            sub_process.start()
-            sub_tasks.append(sub_process)
-
-            if b_use_multiGPUs is False:
-                # wait until previous one finished
-                while sub_process.is_alive():
-                    time.sleep(1)
-
-            idx += 1
-
-            # wait until predicted image patches exist or exceed 20 minutes
-            time0 = time.time()
-            elapsed_time = time.time() - time0
-            while elapsed_time < 20 * 60:
-                elapsed_time = time.time() - time0
-                file_exist = os.path.isdir(img_save_dir) and is_file_exist_in_folder(img_save_dir)
-                if file_exist is True or sub_process.is_alive() is False:
-                    break
-                else:
-                    time.sleep(1)
-
-            if sub_process.exitcode is not None and sub_process.exitcode != 0:
-                sys.exit(1)
-
-            basic.close_remove_completed_process(sub_tasks)
-            # if 'chpc' in machine_name:
-            #     time.sleep(60)  # wait 60 second on ITSC services
-            # else:
-            #     time.sleep(10)
-
-    # check all the tasks already finished
-    wait_all_finish = 0
-    while basic.b_all_process_finish(sub_tasks) is False:
-        if wait_all_finish % 100 == 0:
-            basic.outputlogMessage('wait all tasks to finish')
-        time.sleep(1)
-        wait_all_finish += 1
-
-    basic.close_remove_completed_process(sub_tasks)
     end_time = datetime.now()
 
     diff_time = end_time - start_time
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# Filename: sam_embedding_cache.py
+"""
+introduction: an on-disk cache of SAM image embeddings (the output of the image encoder) for image patches.
+Embeddings are saved as float16 .npy files and read back by memory mapping, the least recently used ones are
+removed when the cache is larger than the size limit. Then running SAM with new prompts on the same patches only
+needs the prompt encoder and the mask decoder.
+
+authors: Huang Lingcao
+email:huanglingcao@gmail.com
+add time: 18 October, 2026
+"""
+
+import os, sys
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+code_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, code_dir)
+import basic_src.basic as basic
+
+
+def get_embedding_key(image_path, boundary, checkpoint, finetune_m=None, preprocess=None):
+    '''
+    get the key of an embedding
+    :param image_path: the image path, its size and modified time are also used, so a changed image is a new key
+    :param boundary: the patch boundary (xoff,yoff ,xsize, ysize)
+    :param checkpoint: the SAM checkpoint
+    :param finetune_m: the fine-tuned model, None if not used
+    :param preprocess: a dict of preprocessing settings (image format, input size, pixel mean and std, ...)
+    :return: a hex string
+    '''
+    image_path = os.path.abspath(image_path)
+    key_dict = {'image': image_path,
+                'image_size': os.path.getsize(image_path),
+                'image_mtime': os.path.getmtime(image_path),
+                'boundary': [int(item) for item in boundary],
+                'checkpoint': os.path.abspath(checkpoint),
+                'finetune_m': None if finetune_m is None else os.path.abspath(finetune_m),
+                'preprocess': preprocess}
+    key_str = json.dumps(key_dict, sort_keys=True, default=str)
+    return hashlib.sha1(key_str.encode('utf-8')).hexdigest()
+
+
+class SamEmbeddingCache(object):
+    """
+    the cache of SAM image embeddings, each embedding has a .npy (float16) and a .json (image sizes) file.
+    The cache folder can be shared by many processes: files are written to a temporary name then renamed,
+    a file removed by another process is a cache miss.
+    """
+
+    def __init__(self, cache_dir, max_size_gb=20):
+        """
+        :param cache_dir: the folder for saving embeddings
+        :param max_size_gb: the maximum size (GB) of the cache
+        """
+        if os.path.isdir(cache_dir) is False:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_gb * 1024 ** 3)
+        self.lock = threading.Lock()
+        self.hit_count = 0
+        self.miss_count = 0
+
+        # key: size in bytes, from the least to the most recently used
+        self.entries = OrderedDict()
+        npy_files = [os.path.join(cache_dir, item) for item in os.listdir(cache_dir) if item.endswith('.npy')]
+        npy_files = sorted(npy_files, key=lambda item: os.path.getmtime(item))
+        for npy in npy_files:
+            key = os.path.splitext(os.path.basename(npy))[0]
+            self.entries[key] = os.path.getsize(npy)
+        self.total_size = sum(self.entries.values())
+
+    def _get_paths(self, key):
+        return os.path.join(self.cache_dir, key + '.npy'), os.path.join(self.cache_dir, key + '.json')
+
+    def get(self, key):
+        '''
+        get an embedding
+        :param key: the key from get_embedding_key
+        :return: (embedding (memory-mapped float16 array), original_size, input_size), or None if not in the cache
+        '''
+        npy_path, json_path = self._get_paths(key)
+        try:
+            with open(json_path) as f_obj:
+                sizes = json.load(f_obj)
+            embedding = np.load(npy_path, mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            # not exist, removed by other processes, or not completely written
+            with self.lock:
+                self.miss_count += 1
+            return None
+        with self.lock:
+            self.hit_count += 1
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            else:
+                self.entries[key] = embedding.nbytes
+                self.total_size += embedding.nbytes
+        # update the modified time, then the order is kept when the cache is loaded next time
+        try:
+            os.utime(npy_path, None)
+        except OSError:
+            pass
+        return embedding, tuple(sizes['original_size']), tuple(sizes['input_size'])
+
+    def put(self, key, embedding, original_size, input_size):
+        '''
+        save an embedding
+        :param key: the key from get_embedding_key
+        :param embedding: a numpy array of the embedding, saved as float16
+        :param original_size: the size of the patch (height, width)
+        :param input_size: the size of the image after resizing (height, width)
+        :return:
+        '''
+        npy_path, json_path = self._get_paths(key)
+        tmp_tail = '.tmp%d' % os.getpid()
+        out = np.lib.format.open_memmap(npy_path + tmp_tail, mode='w+', dtype=np.float16, shape=embedding.shape)
+        out[:] = embedding
+        out.flush()
+        del out
+        with open(json_path + tmp_tail, 'w') as f_obj:
+            json.dump({'original_size': [int(item) for item in original_size],
+                       'input_size': [int(item) for item in input_size]}, f_obj)
+        # write json first, a npy file without json is a cache miss
+        os.replace(json_path + tmp_tail, json_path)
+        os.replace(npy_path + tmp_tail, npy_path)
+
+        with self.lock:
+            nbytes = os.path.getsize(npy_path)
+            if key in self.entries:
+                self.total_size -= self.entries[key]
+            self.entries[key] = nbytes
+            self.total_size += nbytes
+            self._evict()
+
+    def _evict(self):
+        # remove the least recently used embeddings until the cache is smaller than the limit
+        while self.total_size > self.max_size and len(self.entries) > 1:
+            key, nbytes = self.entries.popitem(last=False)
+            self.total_size -= nbytes
+            for path in self._get_paths(key):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def print_statistics(self):
+        basic.outputlogMessage('SAM embedding cache: %d hits, %d misses, %d embeddings (%.2f GB) in %s' %
+                               (self.hit_count, self.miss_count, len(self.entries), self.total_size / 1024.0 ** 3,
+                                self.cache_dir))
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# Filename: sam_mask_nms.py
+"""
+introduction: remove duplicated SAM masks (polygons) from overlapping patches, using IoU-based non-maximum
+suppression (NMS) in map coordinates, then save all the polygons of an image into one vector file.
+Patches are processed row by row, polygons which cannot overlap the coming patches are moved out of the
+spatial index and appended to the vector file, so only polygons of the recent patch rows are kept in memory.
+
+authors: Huang Lingcao
+email:huanglingcao@gmail.com
+add time: 18 October, 2026
+"""
+
+import os, sys
+import math
+
+import pandas as pd
+
+code_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, code_dir)
+import basic_src.basic as basic
+import datasets.vector_gpd as vector_gpd
+
+
+class StreamingMaskNMS(object):
+    """
+    add polygons patch by patch (patches sorted by rows), a polygon is removed if its IoU with a polygon
+    having a higher score is larger than the threshold.
+    """
+
+    def __init__(self, save_path, wkt_str, cell_size, iou_thr=0.5, min_area=None, max_area=None):
+        """
+        :param save_path: the output vector file (GPKG)
+        :param wkt_str: the projection (wkt) of polygons
+        :param cell_size: the cell size (in map units) of the grid index, usually the size of a patch
+        :param iou_thr: IoU threshold, two polygons with IoU larger than this are duplicated
+        :param min_area: minimum area (in map units), smaller polygons are removed, None for not checking
+        :param max_area: maximum area (in map units), larger polygons are removed, None for not checking
+        """
+        if cell_size <= 0:
+            raise ValueError('cell_size should be larger than 0, but get %s' % str(cell_size))
+        self.save_path = save_path
+        self.wkt_str = wkt_str
+        self.cell_size = float(cell_size)
+        self.iou_thr = iou_thr
+        self.min_area = min_area
+        self.max_area = max_area
+
+        self.active = {}  # id: (polygon, value, score, row_end)
+        self.grid = {}  # (col, row): a set of ids
+        self.next_id = 0
+        self.removed_count = 0
+        self.saved_count = 0
+        # append polygons to a temporary file (not match I0_*.gpkg), rename it when closing,
+        # then an interrupted one is not merged as the result
+        self.tmp_path = save_path + '.tmp'
+        if os.path.isfile(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def _get_cells(self, bounds):
+        minx, miny, maxx, maxy = bounds
+        col_s, col_e = int(math.floor(minx / self.cell_size)), int(math.floor(maxx / self.cell_size))
+        row_s, row_e = int(math.floor(miny / self.cell_size)), int(math.floor(maxy / self.cell_size))
+        return [(col, row) for col in range(col_s, col_e + 1) for row in range(row_s, row_e + 1)]
+
+    def _remove_active(self, poly_id):
+        polygon = self.active.pop(poly_id)[0]
+        for cell in self._get_cells(polygon.bounds):
+            ids = self.grid.get(cell)
+            if ids is not None:
+                ids.discard(poly_id)
+                if len(ids) < 1:
+                    del self.grid[cell]
+
+    def add(self, polygon, value, score, row_end):
+        '''
+        add a polygon
+        :param polygon: a shapely polygon (map coordinates)
+        :param value: the value of the polygon (saved in the DN column)
+        :param score: the score of the mask, e.g., predicted_iou of SAM
+        :param row_end: the last row (pixel, exclusive) of the patch this polygon from
+        :return: True if the polygon is kept (for now), False if it is removed
+        '''
+        area = polygon.area
+        if area <= 0 or (self.min_area is not None and area < self.min_area) or \
+                (self.max_area is not None and area > self.max_area):
+            return False
+
+        candidates = set()
+        for cell in self._get_cells(polygon.bounds):
+            if cell in self.grid:
+                candidates.update(self.grid[cell])
+
+        minx, miny, maxx, maxy = polygon.bounds
+        replace_ids = []
+        for c_id in candidates:
+            c_poly, _, c_score, _ = self.active[c_id]
+            c_minx, c_miny, c_maxx, c_maxy = c_poly.bounds
+            if c_minx > maxx or c_maxx < minx or c_miny > maxy or c_maxy < miny:
+                continue
+            inter_area = polygon.intersection(c_poly).area
+            if inter_area <= 0:
+                continue
+            iou = inter_area / (area + c_poly.area - inter_area)
+            if iou <= self.iou_thr:
+                continue
+            if score <= c_score:
+                self.removed_count += 1
+                return False
+            replace_ids.append(c_id)
+
+        for c_id in replace_ids:
+            self._remove_active(c_id)
+            self.removed_count += 1
+
+        poly_id = self.next_id
+        self.next_id += 1
+        self.active[poly_id] = (polygon, value, score, row_end)
+        for cell in self._get_cells(polygon.bounds):
+            self.grid.setdefault(cell, set()).add(poly_id)
+        return True
+
+    def flush(self, row_start=None):
+        '''
+        move the polygons cannot overlap the coming patches out of the index, and append them to the vector file
+        :param row_start: the first row (pixel) of the coming patches, None for all polygons
+        :return:
+        '''
+        done_ids = [p_id for p_id, item in self.active.items() if row_start is None or item[3] <= row_start]
+        if len(done_ids) < 1:
+            return
+        out_polygons, out_values, out_scores = [], [], []
+        # keep the order they were added
+        for p_id in sorted(done_ids):
+            polygon, value, score, _ = self.active[p_id]
+            out_polygons.append(polygon)
+            out_values.append(value)
+            out_scores.append(score)
+            self._remove_active(p_id)
+        data_pd = pd.DataFrame({'polygon': out_polygons, 'DN': out_values, 'score': out_scores})
+        vector_gpd.save_polygons_to_files(data_pd, 'polygon', self.wkt_str, self.tmp_path, format='GPKG',
+                                          b_append=True)
+        self.saved_count += len(out_polygons)
+
+    def close(self):
+        '''
+        save the remaining polygons into the vector file
+        :return: the count of saved polygons
+        '''
+        self.flush()
+        basic.outputlogMessage('keep %d polygons, remove %d duplicated ones, save to %s' %
+                               (self.saved_count, self.removed_count, self.save_path))
+        if os.path.isfile(self.tmp_path):
+            os.replace(self.tmp_path, self.save_path)
+        return self.saved_count
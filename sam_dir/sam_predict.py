@@ -24,9 +24,7 @@ import basic_src.map_projection as map_projection
 import datasets.split_image as split_image
 import datasets.raster_io as raster_io
 import datasets.vector_gpd as vector_gpd
-
-import GPUtil
-from multiprocessing import Process
+import workflow.gpu_scheduler as gpu_scheduler
 
 import numpy as np
 import torch
@@ -100,6 +98,17 @@ def save_masks_as_shape(patch_boundary, masks,ref_raster, save_path, min_area=No
 
 
 
+def add_masks_to_nms(mask_nms, patch_boundary, masks, ref_raster):
+    # everything mode: covert masks of a patch to polygons, then add them to StreamingMaskNMS for removing duplicates
+    row_end = patch_boundary[1] + patch_boundary[3]
+    for mask in masks:
+        mask_array = mask_utils.decode(mask["segmentation"])
+        geometry_list, raster_values = raster_io.numpy_array_to_shape(mask_array,ref_raster,boundary=patch_boundary,nodata=0,connect8=True)
+        for geometry, value in zip(geometry_list, raster_values):
+            polygon = vector_gpd.json_geometry_to_polygons(geometry)
+            mask_nms.add(polygon, value, float(mask['predicted_iou']), row_end)
+
+
 def save_masks_to_disk(accumulate_count, patch_boundary, masks,ref_raster, save_path,scores=None, b_prompt=False):
     # patch boundary: (xoff,yoff ,xsize, ysize)
     # Set output image data type based on the number of objects
@@ -205,24 +214,91 @@ def is_a_box_totally_within_a_path(box, bounds):
         return True
     return False
 
-def get_prompt_points_a_patch(points_pixel_list, class_values, group_ids, patch_boundary):
+class PromptGridIndex(object):
+    """
+    put the locations (x, y in pixel) of prompts into the cells of a grid, usually, the cell size is the patch size
+    of sliding_window, then getting the prompts of a patch only need to check the prompts in a few cells,
+    instead of all prompts.
+    """
+
+    def __init__(self, xy_pixel_list, cell_w, cell_h):
+        """
+        :param xy_pixel_list: a list of (x, y), for boxes, use their upper left corners
+        :param cell_w: the width of a cell
+        :param cell_h: the height of a cell
+        """
+        self.cell_w = max(int(cell_w), 1)
+        self.cell_h = max(int(cell_h), 1)
+        self.count = len(xy_pixel_list)
+        if self.count < 1:
+            return
+        xy = np.asarray(xy_pixel_list, dtype=np.float64).reshape(-1, 2)
+        cols = np.floor(xy[:, 0] / self.cell_w).astype(np.int64)
+        rows = np.floor(xy[:, 1] / self.cell_h).astype(np.int64)
+        self.col_min, self.col_max = int(cols.min()), int(cols.max())
+        self.row_min, self.row_max = int(rows.min()), int(rows.max())
+        self.col_num = self.col_max - self.col_min + 1
+        cell_ids = (rows - self.row_min) * self.col_num + (cols - self.col_min)
+        # the index of prompts, sorted by cells; prompts in a cell keep their original order
+        self.order = np.argsort(cell_ids, kind='stable')
+        self.sorted_cell_ids = cell_ids[self.order]
+
+    def get_candidates(self, bounds):
+        '''
+        get the index of prompts in the cells overlapping a patch, need to check if they are within the patch later
+        :param bounds: (xoff,yoff ,xsize, ysize)
+        :return: a sorted list of index
+        '''
+        if self.count < 1:
+            return []
+        col_s = max(int(np.floor(bounds[0] / self.cell_w)), self.col_min)
+        col_e = min(int(np.floor((bounds[0] + bounds[2]) / self.cell_w)), self.col_max)
+        row_s = max(int(np.floor(bounds[1] / self.cell_h)), self.row_min)
+        row_e = min(int(np.floor((bounds[1] + bounds[3]) / self.cell_h)), self.row_max)
+        if col_s > col_e or row_s > row_e:
+            return []
+        idx_parts = []
+        for row in range(row_s, row_e + 1):
+            # the cells of a row in the patch are continuous in sorted_cell_ids
+            id_s = (row - self.row_min) * self.col_num + (col_s - self.col_min)
+            id_e = (row - self.row_min) * self.col_num + (col_e - self.col_min)
+            loc_s = np.searchsorted(self.sorted_cell_ids, id_s, side='left')
+            loc_e = np.searchsorted(self.sorted_cell_ids, id_e, side='right')
+            if loc_e > loc_s:
+                idx_parts.append(self.order[loc_s:loc_e])
+        if len(idx_parts) < 1:
+            return []
+        return np.sort(np.concatenate(idx_parts)).tolist()
+
+def get_prompt_points_a_patch(points_pixel_list, class_values, group_ids, patch_boundary, grid_index=None):
     # extract points in a patch
     # patch boundary: (xoff,yoff ,xsize, ysize)
-    idx_list = [idx for idx, p in enumerate(points_pixel_list) if is_a_point_within_patch(p,patch_boundary)]
+    # grid_index: PromptGridIndex of the points, if None, check all points
+    if grid_index is None:
+        idx_list = [idx for idx, p in enumerate(points_pixel_list) if is_a_point_within_patch(p,patch_boundary)]
+    else:
+        idx_list = [idx for idx in grid_index.get_candidates(patch_boundary)
+                    if is_a_point_within_patch(points_pixel_list[idx], patch_boundary)]
     points_sel = [[points_pixel_list[idx][0] - patch_boundary[0],
                    points_pixel_list[idx][1] - patch_boundary[1] ] for idx in idx_list]     # substract xoff, yoff
     class_values_sel = [class_values[idx] for idx in idx_list]
     group_ids_sel = [group_ids[idx] for idx in idx_list]
     return points_sel, class_values_sel, group_ids_sel
 
-def get_prompt_boxes_a_patch(boxes_pixel_list, class_values, group_ids, patch_boundary, b_ignore_touch_edge=True):
+def get_prompt_boxes_a_patch(boxes_pixel_list, class_values, group_ids, patch_boundary, b_ignore_touch_edge=True,
+                             grid_index=None):
     # extract boxes in a patch
     # box list: (x1,y1, x2, y2) list. (left, up, right, down)
     # patch boundary: (xoff,yoff ,xsize, ysize)
     # when b_ignore_touch_edge is true, then ignore those boxes touch the patch edge
+    # grid_index: PromptGridIndex of the upper left corners of boxes, if None, check all boxes
 
     if b_ignore_touch_edge:
-        idx_list = [idx for idx, box in enumerate(boxes_pixel_list) if is_a_box_totally_within_a_path(box,patch_boundary)]
+        if grid_index is None:
+            idx_list = [idx for idx, box in enumerate(boxes_pixel_list) if is_a_box_totally_within_a_path(box,patch_boundary)]
+        else:
+            idx_list = [idx for idx in grid_index.get_candidates(patch_boundary)
+                        if is_a_box_totally_within_a_path(boxes_pixel_list[idx], patch_boundary)]
         box_sel = [ [boxes_pixel_list[idx][0] - patch_boundary[0],
                      boxes_pixel_list[idx][1] - patch_boundary[1],
                      boxes_pixel_list[idx][2] - patch_boundary[0],
@@ -254,8 +330,149 @@ def group_prompt_points_boxes(points_pixel_list, class_values, group_ids,input_b
 
     return group_prompts_all
 
+def get_group_prompt_arrays(a_group_prompt):
+    # get points, point labels, and boxes of a group, return None for the absent one
+    points = np.array(a_group_prompt['point']) if 'point' in a_group_prompt.keys() else None
+    p_labels = np.array(a_group_prompt['p_class']) if 'p_class' in a_group_prompt.keys() else None
+    boxes = np.array(a_group_prompt['box']) if 'box' in a_group_prompt.keys() else None
+    b_labels = np.array(a_group_prompt['b_class']) if 'b_class' in a_group_prompt.keys() else None
+    # for each group, usually, only have one box, but may have multiple points
+    if b_labels is None or np.sum(b_labels) == 0:   # 0 is background, we don't need boxes for background
+        boxes = None
+    return points, p_labels, boxes
+
+def predict_prompt_groups_batch(predictor, group_prompts_dict, prompt_batch_size=64):
+    '''
+    run SAM for all the prompt groups in a patch (set_image already called), stack prompts of many groups into one
+    predict_torch call, instead of calling predict for each group
+    :param predictor: SamPredictor
+    :param group_prompts_dict: the output of group_prompt_points_boxes
+    :param prompt_batch_size: the maximum number of groups in one predict_torch call (limit GPU memory)
+    :return: a dict: group id -> the best mask (2D bool array)
+    '''
+    best_masks = {}
+    # groups with the same (multimask, has points, has a box) can be stacked together
+    buckets = {}
+    for key_id in group_prompts_dict.keys():
+        points, p_labels, boxes = get_group_prompt_arrays(group_prompts_dict[key_id])
+        # if all the labels are 0 (background), then ignore this group
+        if p_labels is not None and bool(np.any(p_labels == 1)) is False:
+            basic.outputlogMessage('warning, In group %d, all points are labeled as 0, ignore this group' % key_id)
+            continue
+        if points is None and boxes is None:
+            continue
+        # for the case only use box, b_multimask is also False in the example.
+        b_multimask = points is not None and len(points) < 2
+        if boxes is not None and len(boxes) > 1:
+            # more than one box in a group, cannot be stacked with other groups
+            masks, scores, _ = predictor.predict(point_coords=points, point_labels=p_labels, box=boxes,
+                                                 multimask_output=b_multimask)
+            best_masks[key_id] = masks[scores.argmax(), :, :]
+            continue
+        buckets.setdefault((b_multimask, points is not None, boxes is not None), []).append(
+            (key_id, points, p_labels, boxes))
+
+    for (b_multimask, b_points, b_boxes), groups in buckets.items():
+        for s_idx in range(0, len(groups), prompt_batch_size):
+            a_batch = groups[s_idx: s_idx + prompt_batch_size]
+            coords_torch, labels_torch, boxes_torch = None, None, None
+            if b_points:
+                # groups have different number of points, pad with the label of -1 (not a point)
+                max_count = max([len(item[1]) for item in a_batch])
+                coords = np.zeros((len(a_batch), max_count, 2), dtype=np.float32)
+                labels = np.full((len(a_batch), max_count), -1, dtype=np.int32)
+                for idx, item in enumerate(a_batch):
+                    coords[idx, :len(item[1]), :] = item[1]
+                    labels[idx, :len(item[2])] = item[2]
+                coords = predictor.transform.apply_coords(coords, predictor.original_size)
+                coords_torch = torch.as_tensor(coords, dtype=torch.float, device=predictor.device)
+                labels_torch = torch.as_tensor(labels, dtype=torch.int, device=predictor.device)
+            if b_boxes:
+                boxes = np.array([item[3][0] for item in a_batch], dtype=np.float32)
+                boxes = predictor.transform.apply_boxes(boxes, predictor.original_size)
+                boxes_torch = torch.as_tensor(boxes, dtype=torch.float, device=predictor.device)
+
+            masks, scores, _ = predictor.predict_torch(coords_torch, labels_torch, boxes=boxes_torch,
+                                                       multimask_output=b_multimask)
+            # get the best segment map of each group
+            best_idx = scores.argmax(dim=1)
+            best = masks[torch.arange(len(a_batch), device=masks.device), best_idx].cpu().numpy()
+            for item, a_mask in zip(a_batch, best):
+                best_masks[item[0]] = a_mask
+
+    return best_masks
+
+def masks_to_polygons_labelled(group_masks, group_ids, ref_raster, patch_boundary, min_area, max_area):
+    '''
+    convert the masks of groups to polygons by one labelled raster, instead of one raster for each mask
+    :param group_masks: a dict: group id -> mask (2D bool array)
+    :param group_ids: group ids in order, if masks overlap, the latter one is kept
+    :param ref_raster: the image
+    :param patch_boundary: (xoff,yoff ,xsize, ysize)
+    :param min_area: minimum area in pixel
+    :param max_area: maximum area in pixel
+    :return: {'mask': geometry list, 'value': group id list}
+    '''
+    seg_map_results = {'mask': [], 'value': []}
+    label_map = np.zeros((patch_boundary[3], patch_boundary[2]), dtype=np.int32)
+    label_group_ids = []
+    for key_id in group_ids:
+        if key_id not in group_masks.keys():
+            continue
+        group_seg_map = group_masks[key_id]
+        # calculate area, remove mask that is too small or too big
+        seg_map_size_pixel = int(np.sum(group_seg_map))
+        if seg_map_size_pixel < min_area or seg_map_size_pixel > max_area:
+            continue
+        label_group_ids.append(key_id)
+        label_map[group_seg_map] = len(label_group_ids)    # 0 is background
+
+    if len(label_group_ids) < 1:
+        return seg_map_results
+    # after numpy_array_to_shape, one region may end in several polygons, and some of them are very small.
+    # in the later step (save_masks_as_shape), remove these tiny polygons
+    geometry_list, raster_values = raster_io.numpy_array_to_shape(label_map, ref_raster, boundary=patch_boundary,
+                                                                  nodata=0, connect8=True)
+    seg_map_results['mask'].extend(geometry_list)
+    seg_map_results['value'].extend([label_group_ids[int(item) - 1] for item in raster_values])
+    return seg_map_results
+
+def get_sam_preprocess_settings(predictor):
+    # the settings affect the image embedding, besides the image and the model
+    return {'image_format': predictor.model.image_format,
+            'target_length': predictor.transform.target_length,
+            'pixel_mean': predictor.model.pixel_mean.flatten().tolist(),
+            'pixel_std': predictor.model.pixel_std.flatten().tolist()}
+
+def set_image_with_cache(predictor, image, embedding_cache=None, cache_key=None):
+    '''
+    set the image of a SamPredictor, use the embedding in the cache if it exists (skip the image encoder)
+    :param predictor: SamPredictor
+    :param image: the image patch (HWC, uint8)
+    :param embedding_cache: SamEmbeddingCache, None for not using the cache
+    :param cache_key: the key of this patch
+    :return: True if the embedding is from the cache, otherwise, False
+    '''
+    if embedding_cache is None:
+        predictor.set_image(image)
+        return False
+    cached = embedding_cache.get(cache_key)
+    if cached is not None:
+        embedding, original_size, input_size = cached
+        predictor.reset_image()
+        predictor.features = torch.from_numpy(np.array(embedding)).to(device=predictor.device, dtype=torch.float32)
+        predictor.original_size = original_size
+        predictor.input_size = input_size
+        predictor.is_image_set = True
+        return True
+    predictor.set_image(image)
+    embedding_cache.put(cache_key, predictor.features.cpu().numpy(), predictor.original_size, predictor.input_size)
+    return False
+
 def segment_rs_image_sam(image_path, save_dir, model, model_type, patch_w, patch_h, overlay_x, overlay_y,
-                        batch_size=1, min_area=10, max_area=40000, prompts=None, finetune_m=None):
+                        batch_size=1, min_area=10, max_area=40000, prompts=None, finetune_m=None, b_skip_invalid=False,
+                        b_streaming=False, prompt_batch_size=64, embedding_cache_dir=None, cache_size_gb=20,
+                        nms_iou_thr=0.5):
 
     # for each region, after SAM, its area (in pixel) should be within [min_area, max_area],
     # otherwise, remove it
@@ -289,22 +506,28 @@ def segment_rs_image_sam(image_path, save_dir, model, model_type, patch_w, patch
     # boxes_pixel, box_class_values, box_group_ids = None, None, None
     # print('Debug, prompts is:', prompts)
     if prompts is None:
-        if overlay_x > 0 or overlay_y >0:
-            raise ValueError('For everything mode, overlay_x and overlay_y should be zero')
         # segment everything
         mask_generator = SamAutomaticMaskGenerator(sam, output_mode="coco_rle")  # "binary_mask" take a lot of memory
     else:
         # only segment targets
         mask_generator = SamPredictor(sam)
+        embedding_cache, preprocess = None, None
+        if embedding_cache_dir is not None:
+            # save image embeddings, then running with other prompts don't need to run the image encoder again
+            from sam_embedding_cache import SamEmbeddingCache, get_embedding_key
+            embedding_cache = SamEmbeddingCache(embedding_cache_dir, max_size_gb=cache_size_gb)
+            preprocess = get_sam_preprocess_settings(mask_generator)
 
         # read prompts
         for p_path in prompts:
             if p_path.endswith('point.shp'):
                 points_pixel, class_values, group_ids = get_prompt_points_list(p_path,image_path)
-                prompts_dict['point'] = {'xy_pixel':points_pixel,'class_value':class_values, 'group_id':group_ids }
+                prompts_dict['point'] = {'xy_pixel':points_pixel,'class_value':class_values, 'group_id':group_ids,
+                                         'grid_index': PromptGridIndex(points_pixel, patch_w, patch_h)}
             elif p_path.endswith('box.shp'):
                 boxes_pixel, box_class_values, box_group_ids = get_prompt_boxes_list(p_path, image_path)
-                prompts_dict['box'] = {'xyxy_pixel': boxes_pixel, 'class_value': box_class_values, 'group_id': box_group_ids}
+                prompts_dict['box'] = {'xyxy_pixel': boxes_pixel, 'class_value': box_class_values, 'group_id': box_group_ids,
+                                       'grid_index': PromptGridIndex([box[:2] for box in boxes_pixel], patch_w, patch_h)}
             else:
                 raise ValueError('Cannot find prompt type in the file name: %s'%os.path.basename(p_path))
 
@@ -318,9 +541,15 @@ def segment_rs_image_sam(image_path, save_dir, model, model_type, patch_w, patch
     # print('input image: height, width, band_num, date_type',height, width, band_num, date_type)
     xres, yres = raster_io.get_xres_yres_file(image_path)
 
-    # read the entire image
-    entire_img_data, nodata = raster_io.read_raster_all_bands_np(image_path)
-    entire_img_data = entire_img_data.transpose(1, 2, 0)  # to opencv format  # in HWC uint8 format
+    if b_streaming:
+        # read patches on demand, only keep a few row strips in memory
+        # the maximum patch height (including the overlap and the enlarged last patch), a patch covers at most two strips
+        max_patch_h = int(split_image.get_window_ranges(height, patch_h, adj_overlay=overlay_y)[:, 1].max())
+        entire_img_data = raster_io.RasterStripReader(image_path, min_rows=max_patch_h)
+    else:
+        # read the entire image
+        entire_img_data, nodata = raster_io.read_raster_all_bands_np(image_path)
+        entire_img_data = entire_img_data.transpose(1, 2, 0)  # to opencv format  # in HWC uint8 format
     # # # RGB to BGR: Matplotlib image to OpenCV https://www.scivision.dev/numpy-image-bgr-to-rgb/
     # entire_img_data = entire_img_data[..., ::-1].copy() # no need, hlc July 9, 2023. in amg.py, they use cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
     entire_height, entire_width, band_num = entire_img_data.shape
@@ -335,12 +564,29 @@ def segment_rs_image_sam(image_path, save_dir, model, model_type, patch_w, patch
         f_obj.writelines(str(datetime.now()) + ': The process has started\n')
 
     # divide the image the many small patches, then calculate one by one, solving memory issues.
-    image_patches = split_image.sliding_window(width, height, patch_w, patch_h, adj_overlay_x=overlay_x,
-                                               adj_overlay_y=overlay_y)
+    image_patches = split_image.sliding_window_array(width, height, patch_w, patch_h, adj_overlay_x=overlay_x,
+                                                     adj_overlay_y=overlay_y)
+    if b_skip_invalid:
+        # skip the patches without valid pixels (nodata)
+        image_patches = raster_io.get_valid_patches(image_path, image_patches)
+    if b_streaming or prompts is None:
+        # read patches row by row, then the cached strips can be reused,
+        # and for everything mode, polygons can be moved out of NMS after the patch rows are done
+        image_patches = split_image.sort_boundary_array_by_rows(image_patches)
+    image_patches = split_image.boundary_array_to_list(image_patches)
     # patch boundary: (xoff,yoff ,xsize, ysize)
     patch_count = len(image_patches)
     total_seg_count = 0
 
+    if prompts is None:
+        # remove duplicated masks from overlapping patches, and save all polygons into one file
+        from sam_mask_nms import StreamingMaskNMS
+        wkt_str = raster_io.get_projection(image_path, format='wkt')
+        cell_size = max(patch_w * abs(xres), patch_h * abs(yres))
+        # the file name match I0_*.gpkg, which is merged in postProcess.py
+        mask_nms = StreamingMaskNMS(os.path.join(save_dir, 'I0_everything.gpkg'), wkt_str, cell_size,
+                                    iou_thr=nms_iou_thr, min_area=min_area*(xres**2))
+
     for p_idx, a_patch in enumerate(image_patches):
         t0 = time.time()
         # get width, height, and band_num of a patch, then create a darknet image.
@@ -359,7 +605,10 @@ def segment_rs_image_sam(image_path, save_dir, model, model_type, patch_w, patch
             masks = mask_generator.generate(image)
             masks = [item for item in masks  if item['area'] >= min_area and item['area'] <= max_area]    # remove big and small region
             # save_masks_to_disk(total_seg_count,a_patch,masks, image_path,save_path)
-            save_masks_as_shape(a_patch,masks,image_path,save_path, min_area=min_area*(xres**2))
+            # save_masks_as_shape(a_patch,masks,image_path,save_path, min_area=min_area*(xres**2))
+            # polygons from previous patch rows cannot overlap this patch
+            mask_nms.flush(row_start=a_patch[1])
+            add_masks_to_nms(mask_nms, a_patch, masks, image_path)
             total_seg_count += len(masks)
         else:
             # generate masks based on input points
@@ -368,12 +617,14 @@ def segment_rs_image_sam(image_path, save_dir, model, model_type, patch_w, patch
             if 'point' in prompts_dict.keys():
                 input_point, input_label, group_id = get_prompt_points_a_patch( prompts_dict['point']['xy_pixel'],
                                                                                 prompts_dict['point']['class_value'],
-                                                                                prompts_dict['point']['group_id'], a_patch)
+                                                                                prompts_dict['point']['group_id'], a_patch,
+                                                                                grid_index=prompts_dict['point']['grid_index'])
             input_boxes, box_label, box_group_id = None, None, None
             if 'box' in prompts_dict.keys():
                 input_boxes, box_label, box_group_id= get_prompt_boxes_a_patch(prompts_dict['box']['xyxy_pixel'],
                                                                                 prompts_dict['box']['class_value'],
-                                                                                prompts_dict['box']['group_id'], a_patch)
+                                                                                prompts_dict['box']['group_id'], a_patch,
+                                                                                grid_index=prompts_dict['box']['grid_index'])
 
             # input_point = np.array(input_point[-2:-1])
             # input_label = np.array(input_label[-2:-1])
@@ -385,61 +636,15 @@ def segment_rs_image_sam(image_path, save_dir, model, model_type, patch_w, patch
                 continue
 
             group_prompts_dict = group_prompt_points_boxes(input_point, input_label, group_id,input_boxes, box_label, box_group_id)
-            mask_generator.set_image(image)
-            # seg_map = np.zeros((a_patch[3], a_patch[2]), dtype=np.uint32)
-            seg_map_results = {'mask':[], 'value':[]}
-            for key_id in group_prompts_dict.keys():
-                a_group_prompt = group_prompts_dict[key_id]
-                points = np.array(a_group_prompt['point']) if 'point' in a_group_prompt.keys() else None
-                p_labels = np.array(a_group_prompt['p_class']) if 'p_class' in a_group_prompt.keys() else None
-                boxes = np.array(a_group_prompt['box']) if 'box' in a_group_prompt.keys() else None
-                b_labels = np.array(a_group_prompt['b_class']) if 'b_class' in a_group_prompt.keys() else None
-
-                # for each group, usually, only have one box, but may have multiple points
-                if np.sum(b_labels) == 0:   # 0 is background, we don't need boxes for background
-                    boxes = None
-
-                # if all the labels are 0 (background), then ignore this group
-                if p_labels is not None and np.any(p_labels==1) is False:
-                    basic.outputlogMessage('warning, In group %d, all points are labeled as 0, ignore this group'%key_id)
-                    continue
-                # print(key_id, points, labels)
-                b_multimask = False
-                if points is not None and len(points) < 2:
-                    b_multimask = True
-                # b_multimask = True if len(points) < 2 and boxes is None else False
-                # for the case only use box, b_multimask is also False in the example.
-                masks, scores, logits = mask_generator.predict(
-                    point_coords=points,
-                    point_labels=p_labels,
-                    box = boxes,
-                    multimask_output=b_multimask,
-                )
-                # get the best segment map
-                group_seg_map = masks[scores.argmax(),:,:]  # the output is True or False
-
-                # calculate area, remove mask that is too small or too big
-                seg_map_size_pixel = int(np.sum(group_seg_map))
-
-                # print('type', type(min_area), type(max_area), type(seg_map_size_pixel))
-                if seg_map_size_pixel < min_area or seg_map_size_pixel > max_area:
-                    # print('removed, %d'%key_id)
-                    continue
-                # print('key_id: %d, its seg map has %s pixel, (min, max are %s, %s)  ' % (key_id, str(seg_map_size_pixel), min_area, max_area))
-                # print('polygon count: %d'%len(seg_map_results['mask']))
-
-                # print(group_seg_map.dtype, group_seg_map.shape)
-                # seg_map[group_seg_map ] = key_id   # save key id
-                group_seg_map = group_seg_map.astype(np.uint8)
-                # print('group_seg_map uint8, pixel count: ', np.sum(group_seg_map))
-
-                # after numpy_array_to_shape, one region may end in several polygons, and some of them are very small.
-                # in the later step (save_masks_as_shape), remove these tiny polygons
-                geometry_list, raster_values = raster_io.numpy_array_to_shape(group_seg_map, image_path,
-                                                                              boundary=a_patch, nodata=0,
-                                                                              connect8=True)
-                seg_map_results['mask'].extend(geometry_list)
-                seg_map_results['value'].extend([key_id]*len(geometry_list))
+            cache_key = None
+            if embedding_cache is not None:
+                cache_key = get_embedding_key(image_path, a_patch, model, finetune_m=finetune_m, preprocess=preprocess)
+            set_image_with_cache(mask_generator, image, embedding_cache=embedding_cache, cache_key=cache_key)
+            # stack the prompts of all groups, then convert all the kept masks to polygons at once
+            group_masks = predict_prompt_groups_batch(mask_generator, group_prompts_dict,
+                                                      prompt_batch_size=prompt_batch_size)
+            seg_map_results = masks_to_polygons_labelled(group_masks, list(group_prompts_dict.keys()), image_path,
+                                                         a_patch, min_area, max_area)
 
             # save to disk
             # save_masks_to_disk(0, a_patch, seg_map, image_path, save_path, scores=None, b_prompt=True)
@@ -467,6 +672,13 @@ def segment_rs_image_sam(image_path, save_dir, model, model_type, patch_w, patch
         # if p_idx % 100 == 0:
         print('Processed %d patch, total: %d, this batch costs %f second' % (p_idx, patch_count, time.time() - t0))
 
+    if b_streaming:
+        entire_img_data.close()
+    if prompts is None:
+        mask_nms.close()
+    if prompts is not None and embedding_cache is not None:
+        embedding_cache.print_statistics()
+
 
 def get_prompts_for_an_image(image_path, area_prompt_path, save_dir,prompt_type='point'):
     '''
@@ -514,6 +726,22 @@ def segment_remoteSensing_image(para_file, area_ini, image_path, save_dir, netwo
     patch_h = parameters.get_digit_parameters(para_file, "inf_patch_height", 'int')
     overlay_x = parameters.get_digit_parameters(para_file, "inf_pixel_overlay_x", 'int')
     overlay_y = parameters.get_digit_parameters(para_file, "inf_pixel_overlay_y", 'int')
+    b_skip_invalid = parameters.get_bool_parameters_None_if_absence(para_file, 'b_inf_skip_invalid_patches')
+    # if not buffer the entire image in memory, read patches on demand
+    b_use_memory = parameters.get_bool_parameters_None_if_absence(para_file, 'b_inf_memory_buffer')
+    # the maximum number of prompt groups decoded in one batch
+    prompt_batch_size = parameters.get_digit_parameters_None_if_absence(para_file, 'sam_prompt_batch_size', 'int')
+    if prompt_batch_size is None:
+        prompt_batch_size = 64
+    # the folder for caching image embeddings of SAM (prompt mode), not set: don't cache
+    embedding_cache_dir = parameters.get_directory_None_if_absence(para_file, 'sam_embedding_cache_dir')
+    cache_size_gb = parameters.get_digit_parameters_None_if_absence(para_file, 'sam_embedding_cache_size_gb', 'float')
+    if cache_size_gb is None:
+        cache_size_gb = 20
+    # for everything mode, the IoU threshold for removing duplicated masks from overlapping patches
+    nms_iou_thr = parameters.get_digit_parameters_None_if_absence(para_file, 'sam_nms_iou_threshold', 'float')
+    if nms_iou_thr is None:
+        nms_iou_thr = 0.5
 
     # sam_mask_min_area = parameters.get_digit_parameters(para_file, "sam_mask_min_area_pixel", 'int')
     # sam_mask_max_area = parameters.get_digit_parameters(para_file, "sam_mask_max_area_pixel", 'int')
@@ -575,7 +803,10 @@ def segment_remoteSensing_image(para_file, area_ini, image_path, save_dir, netwo
     out = segment_rs_image_sam(image_path, save_dir, model, model_type,
                                patch_w, patch_h, overlay_x, overlay_y, batch_size=batch_size,
                                min_area=sam_mask_min_area, max_area=sam_mask_max_area,
-                               prompts=prompts_an_image_list,finetune_m=finedtuned_model)
+                               prompts=prompts_an_image_list,finetune_m=finedtuned_model,
+                               b_skip_invalid=b_skip_invalid is True, b_streaming=b_use_memory is False,
+                               prompt_batch_size=prompt_batch_size, embedding_cache_dir=embedding_cache_dir,
+                               cache_size_gb=cache_size_gb, nms_iou_thr=nms_iou_thr)
 
 def segment_one_image_sam(para_file, area_ini, image_path, img_save_dir, inf_list_file, gpuid):
 
@@ -616,9 +847,13 @@ def parallel_segment_main(para_file):
     multi_inf_regions = parameters.get_string_list_parameters(para_file, 'inference_regions')
     b_use_multiGPUs = parameters.get_bool_parameters(para_file, 'b_use_multiGPUs')
     maximum_prediction_jobs = parameters.get_digit_parameters(para_file, 'maximum_prediction_jobs', 'int')
+    # the number of images running on a GPU at the same time
+    jobs_per_gpu = parameters.get_digit_parameters_None_if_absence(para_file, 'inf_jobs_per_gpu', 'int')
+    if jobs_per_gpu is None:
+        jobs_per_gpu = 1
+    scheduler = None
 
     # loop each inference regions
-    sub_tasks = []
     for area_idx, area_ini in enumerate(multi_inf_regions):
         basic.outputlogMessage(f'({area_idx+1}/{len(multi_inf_regions)}) working on {area_ini}')
 
@@ -642,104 +877,34 @@ def parallel_segment_main(para_file):
         io_function.mkdir(area_save_dir)
 
         # parallel inference images for this area
-        CUDA_VISIBLE_DEVICES = []
-        if 'CUDA_VISIBLE_DEVICES' in os.environ.keys():
-            CUDA_VISIBLE_DEVICES = [int(item.strip()) for item in os.environ['CUDA_VISIBLE_DEVICES'].split(',')]
-        idx = 0
-        while idx < img_count:
-
-            while basic.alive_process_count(sub_tasks) >= maximum_prediction_jobs:
-                print(datetime.now(),
-                      '%d jobs are running simultaneously, wait 5 seconds' % basic.alive_process_count(sub_tasks))
-                time.sleep(60)  # wait 60 seconds, then check the count of running jobs again
-
-            if b_use_multiGPUs:
-                # get available GPUs  # https://github.com/anderskm/gputil
-                # memory: orders the available GPU device ids by ascending memory usage
-                deviceIDs = GPUtil.getAvailable(order='memory', limit=100, maxLoad=0.5,
-                                                maxMemory=0.5, includeNan=False, excludeID=[], excludeUUID=[])
-                # only use the one in CUDA_VISIBLE_DEVICES
-                if len(CUDA_VISIBLE_DEVICES) > 0:
-                    deviceIDs = [item for item in deviceIDs if item in CUDA_VISIBLE_DEVICES]
-                    basic.outputlogMessage('on ' + machine_name + ', available GPUs:' + str(deviceIDs) +
-                                           ', among visible ones:' + str(CUDA_VISIBLE_DEVICES))
-                else:
-                    basic.outputlogMessage('on ' + machine_name + ', available GPUs:' + str(deviceIDs))
-
-                if len(deviceIDs) < 1:
-                    time.sleep(60)  # wait 60 seconds, then check the available GPUs again
-                    continue
-                # set only the first available visible
-                gpuid = deviceIDs[0]
-                basic.outputlogMessage(
-                    '%d: predict image %s on GPU %d of %s' % (idx, inf_img_list[idx], gpuid, machine_name))
-            else:
-                gpuid = None
-                basic.outputlogMessage('%d: predict image %s on %s' % (idx, inf_img_list[idx], machine_name))
-
-            # run inference
+        jobs = []
+        for idx in range(img_count):
             img_save_dir = os.path.join(area_save_dir, 'I%d' % idx)
             inf_list_file = os.path.join(area_save_dir, '%d.txt' % idx)
 
             done_indicator = '%s_done' % inf_list_file
             if os.path.isfile(done_indicator):
                 basic.outputlogMessage('warning, %s exist, skip prediction' % done_indicator)
-                idx += 1
                 continue
 
             # if it already exists, then skip
             if os.path.isdir(img_save_dir) and is_file_exist_in_folder(img_save_dir):
                 basic.outputlogMessage('folder of %dth image (%s) already exist, '
                                        'it has been predicted or is being predicted' % (idx, inf_img_list[idx]))
-                idx += 1
                 continue
 
             with open(inf_list_file, 'w') as inf_obj:
                 inf_obj.writelines(inf_img_list[idx] + '\n')
+            basic.outputlogMessage('%d: predict image %s on %s' % (idx, inf_img_list[idx], machine_name))
+            jobs.append((segment_one_image_sam, (para_file, area_ini, inf_img_list[idx], img_save_dir, inf_list_file), {}))
+
+        # start the next image as soon as a GPU slot is free
+        if scheduler is None:
+            scheduler = gpu_scheduler.GPUScheduler(gpu_scheduler.get_scheduler_gpus(b_use_multiGPUs, order='memory'),
+                                                   jobs_per_gpu=jobs_per_gpu, max_jobs=maximum_prediction_jobs)
+        if len(scheduler.run(jobs)) > 0:
+            sys.exit(1)
 
-            sub_process = Process(target=segment_one_image_sam,
-                                  args=(para_file, area_ini, inf_img_list[idx], img_save_dir, inf_list_file, gpuid))
-
-            sub_process.start()
-            sub_tasks.append(sub_process)
-
-            if b_use_multiGPUs is False:
-                # wait until previous one finished
-                while sub_process.is_alive():
-                    time.sleep(1)
-
-            idx += 1
-
-            # wait until predicted image patches exist or exceed 20 minutes
-            time0 = time.time()
-            elapsed_time = time.time() - time0
-            while elapsed_time < 20 * 60:
-                elapsed_time = time.time() - time0
-                file_exist = os.path.isdir(img_save_dir) and is_file_exist_in_folder(img_save_dir)
-                if file_exist is True or sub_process.is_alive() is False:
-                    break
-                else:
-                    time.sleep(1)
-
-            if sub_process.exitcode is not None and sub_process.exitcode != 0:
-                sys.exit(1)
-
-            basic.close_remove_completed_process(sub_tasks)
-            # if 'chpc' in machine_name:
-            #     time.sleep(60)  # wait 60 second on ITSC services
-            # else:
-            #     time.sleep(10)
-            time.sleep(15) # wait a few seconds allowing models being loaded before moving to next
-
-    # check all the tasks already finished
-    wait_all_finish = 0
-    while basic.b_all_process_finish(sub_tasks) is False:
-        if wait_all_finish % 100 == 0:
-            basic.outputlogMessage('wait all tasks to finish')
-        time.sleep(1)
-        wait_all_finish += 1
-
-    basic.close_remove_completed_process(sub_tasks)
     end_time = datetime.now()
 
     diff_time = end_time - start_time
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# Filename: convert_to_8bit_hist.py
+"""
+introduction: convert a large raster (e.g., 16 bit PlanetScope or float DEM-derived images) to 8 bit
+using the percent cut of histograms, without reading the entire image into memory
+
+authors: Huang Lingcao
+email:huanglingcao@gmail.com
+add time: 18 October, 2026
+"""
+
+import os,sys
+from optparse import OptionParser
+
+code_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, code_dir)
+
+import datasets.raster_io as raster_io
+
+def parse_min_max_values(min_max_str_list):
+    # e.g., ['0,3000', '0,4000'] to [(0.0, 3000.0), (0.0, 4000.0)]
+    if min_max_str_list is None or len(min_max_str_list) < 1:
+        return None
+    min_max_values = []
+    for item in min_max_str_list:
+        values = [float(tmp) for tmp in item.split(',')]
+        if len(values) != 2:
+            raise ValueError('min_max should be "min,max", but get %s' % item)
+        min_max_values.append((values[0], values[1]))
+    return min_max_values
+
+def main(options, args):
+    image_path = args[0]
+    save_path = options.save_path
+    if save_path is None:
+        save_path = os.path.splitext(os.path.basename(image_path))[0] + '_8bit.tif'
+    if os.path.isfile(save_path):
+        print('%s already exists, skip' % save_path)
+        return
+
+    raster_io.convert_raster_to_8bit_hist(image_path, save_path,
+                                          min_max_values=parse_min_max_values(options.min_max),
+                                          per_min=options.per_min, per_max=options.per_max,
+                                          bin_count=options.bin_count, src_nodata=options.src_nodata,
+                                          dst_nodata=options.dst_nodata, overview_factor=options.overview_factor,
+                                          thread_num=options.thread_num, block_size=options.block_size,
+                                          compress=options.compress)
+
+
+if __name__ == '__main__':
+
+    usage = "usage: %prog [options] image_path "
+    parser = OptionParser(usage=usage, version="1.0 2026-10-18")
+    parser.description = 'Introduction: convert a raster to 8 bit using the percent cut of histograms (block by block) '
+
+    parser.add_option("-o", "--save_path",
+                      action="store", dest="save_path",
+                      help="the path for saving the 8 bit raster, default: the input name with _8bit.tif")
+
+    parser.add_option("", "--per_min",
+                      action="store", dest="per_min", type=float, default=0.01,
+                      help="the percent cut at the bottom of histograms")
+
+    parser.add_option("", "--per_max",
+                      action="store", dest="per_max", type=float, default=0.99,
+                      help="the percent cut at the top of histograms")
+
+    parser.add_option("-b", "--bin_count",
+                      action="store", dest="bin_count", type=int, default=10000,
+                      help="the bin count of histograms")
+
+    parser.add_option("-m", "--min_max",
+                      action="append", dest="min_max",
+                      help="min,max for limiting the min and max from histograms (also the histogram range), "
+                           "set one for all bands, or one for each band, e.g., -m 0,3000 -m 0,4000")
+
+    parser.add_option("-s", "--src_nodata",
+                      action="store", dest="src_nodata", type=float,
+                      help="the nodata of the input, default: the one in the raster")
+
+    parser.add_option("-d", "--dst_nodata",
+                      action="store", dest="dst_nodata", type=int,
+                      help="the nodata of the output, e.g., 0 (then the valid values are 1-255)")
+
+    parser.add_option("-v", "--overview_factor",
+                      action="store", dest="overview_factor", type=int,
+                      help="calculate histograms from the image decimated by this factor (use overviews if available)")
+
+    parser.add_option("-t", "--thread_num",
+                      action="store", dest="thread_num", type=int, default=4,
+                      help="the number of threads for reading and converting blocks")
+
+    parser.add_option("", "--block_size",
+                      action="store", dest="block_size", type=int, default=512,
+                      help="the tile size of the output")
+
+    parser.add_option("-c", "--compress",
+                      action="store", dest="compress", default='lzw',
+                      help="the compression of the output")
+
+    (options, args) = parser.parse_args()
+    if len(sys.argv) < 2 or len(args) < 1:
+        parser.print_help()
+        sys.exit(2)
+
+    main(options, args)
@@ -17,11 +17,11 @@ sys.path.insert(0, code_dir)
 import datasets.raster_io as raster_io
 import basic_src.io_function as io_function
 
-def delete_images_low_quality(img_list, backup_folder):
+def delete_images_low_quality(img_list, backup_folder, thread_num=8):
     keep_image_label_list = []
     delete_image_label_list = []
-    for image_path in img_list:
-        valid_per, entropy = raster_io.get_valid_percent_shannon_entropy(image_path)  # base=10
+    valid_per_list, entropy_list = raster_io.get_valid_percent_entropy_list(img_list, thread_num=thread_num)  # base=10
+    for image_path, valid_per, entropy in zip(img_list, valid_per_list, entropy_list):
         if valid_per > 60 and entropy >= 0.5:
             keep_image_label_list.append(image_path)
         else:
@@ -36,7 +36,7 @@ def main(options, args):
     if os.path.isdir(backup_folder) is False:
         io_function.mkdir(backup_folder)
     img_list = io_function.get_file_list_by_ext('.tif',img_folder,bsub_folder=False)
-    delete_images_low_quality(img_list,backup_folder)
+    delete_images_low_quality(img_list,backup_folder, thread_num=options.thread_num)
 
 if __name__ == '__main__':
 
@@ -44,6 +44,10 @@ if __name__ == '__main__':
     parser = OptionParser(usage=usage, version="1.0 2024-05-02")
     parser.description = 'Introduction: remove images with low quality  '
 
+    parser.add_option("-t", "--thread_num",
+                      action="store", dest="thread_num", type=int, default=8,
+                      help="the number of threads for reading images")
+
     (options, args) = parser.parse_args()
     if len(sys.argv) < 2:
         parser.print_help()
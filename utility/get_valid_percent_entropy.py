@@ -33,7 +33,7 @@ def np_histogram_a_list(in_list,bin_count=255,axis_range=(0, 10)):
 
     return hist, bin_edges
 
-def plot_valid_entropy(in_folder, save_file_pre=None):
+def plot_valid_entropy(in_folder, save_file_pre=None, thread_num=8):
 
     if save_file_pre is None:
         save_file_pre  = os.path.basename(in_folder)
@@ -43,14 +43,9 @@ def plot_valid_entropy(in_folder, save_file_pre=None):
     image_paths = io_function.get_file_list_by_ext('.tif', in_folder, bsub_folder=True)
     if len(image_paths) < 1:
         raise IOError('no tif files in %s' % in_folder)
-    valid_per_list = []
-    entropy_list = []
-    img_count = len(image_paths)
-    for idx, img_path in enumerate(image_paths):
-        print('%d/%d'%(idx+1, img_count))
-        valid_per, entropy = raster_io.get_valid_percent_shannon_entropy(img_path, log_base=10)
-        valid_per_list.append(valid_per)
-        entropy_list.append(entropy)
+    # read images block by block in parallel
+    valid_per_list, entropy_list = raster_io.get_valid_percent_entropy_list(image_paths, log_base=10,
+                                                                            thread_num=thread_num)
 
     per_entropy_txt = save_file_pre + '_' + 'valid_per_entropy.txt'
     save_hist_path = save_file_pre +'_' + 'hist.jpg'
@@ -73,7 +68,7 @@ def main(options, args):
     in_folder = args[0]
 
     save_file_pre = options.save_file_pre
-    plot_valid_entropy(in_folder, save_file_pre)
+    plot_valid_entropy(in_folder, save_file_pre, thread_num=options.thread_num)
 
 
 
@@ -88,6 +83,10 @@ if __name__ == '__main__':
                       action="store", dest="save_file_pre",
                       help="the prefix for saving files")
 
+    parser.add_option("-t", "--thread_num",
+                      action="store", dest="thread_num", type=int, default=8,
+                      help="the number of threads for reading images")
+
     (options, args) = parser.parse_args()
     if len(sys.argv) < 2 or len(args) < 1:
         parser.print_help()
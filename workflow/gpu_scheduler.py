@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# Filename: gpu_scheduler.py
+"""
+introduction: schedule the prediction jobs (one job for one image) on GPUs.
+Each GPU has at most "jobs_per_gpu" slots. Before starting a job, the usage of GPUs is queried again (GPUtil):
+an idle GPU (low load and memory usage) can be used even if it was busy at the beginning, and one more job is
+put on a GPU already running our jobs only if its memory usage is still low. The workers tell the scheduler
+when they start and finish through a queue, instead of checking GPUs and output files then sleeping.
+
+authors: Huang Lingcao
+email:huanglingcao@gmail.com
+add time: 18 October, 2026
+"""
+
+import os, sys
+import time
+import queue
+import multiprocessing
+from multiprocessing import Process
+
+code_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, code_dir)
+import basic_src.basic as basic
+
+
+def get_available_gpus(order='first', maxLoad=0.5, maxMemory=0.5, wait_seconds=60):
+    """
+    get the available GPUs (only those in CUDA_VISIBLE_DEVICES if it is set), wait until at least one is available
+    :param order: the order of GPUs, first or memory (ascending memory usage)
+    :param maxLoad: GPUs with a load larger than this are not available
+    :param maxMemory: GPUs with a memory usage larger than this are not available
+    :param wait_seconds: the seconds for waiting if no GPU is available
+    :return: a list of GPU ids
+    """
+    import GPUtil
+    machine_name = os.uname()[1]
+    CUDA_VISIBLE_DEVICES = []
+    if 'CUDA_VISIBLE_DEVICES' in os.environ.keys():
+        CUDA_VISIBLE_DEVICES = [int(item.strip()) for item in os.environ['CUDA_VISIBLE_DEVICES'].split(',')]
+    while True:
+        # https://github.com/anderskm/gputil
+        deviceIDs = GPUtil.getAvailable(order=order, limit=100, maxLoad=maxLoad,
+                                        maxMemory=maxMemory, includeNan=False, excludeID=[], excludeUUID=[])
+        # only use the one in CUDA_VISIBLE_DEVICES
+        if len(CUDA_VISIBLE_DEVICES) > 0:
+            deviceIDs = [item for item in deviceIDs if item in CUDA_VISIBLE_DEVICES]
+            basic.outputlogMessage('on ' + machine_name + ', available GPUs:' + str(deviceIDs) +
+                                   ', among visible ones:' + str(CUDA_VISIBLE_DEVICES))
+        else:
+            basic.outputlogMessage('on ' + machine_name + ', available GPUs:' + str(deviceIDs))
+        if len(deviceIDs) > 0:
+            return deviceIDs
+        time.sleep(wait_seconds)  # wait, then check the available GPUs again
+
+
+def get_visible_gpus():
+    # the ids of all the GPUs (only those in CUDA_VISIBLE_DEVICES if it is set), no matter they are busy or not
+    import GPUtil
+    deviceIDs = [gpu.id for gpu in GPUtil.getGPUs()]
+    if 'CUDA_VISIBLE_DEVICES' in os.environ.keys():
+        CUDA_VISIBLE_DEVICES = [int(item.strip()) for item in os.environ['CUDA_VISIBLE_DEVICES'].split(',')]
+        deviceIDs = [item for item in deviceIDs if item in CUDA_VISIBLE_DEVICES]
+    return deviceIDs
+
+
+def get_gpu_usage():
+    # the current load and memory usage (0-1) of each GPU, {id: (load, memory_util)}
+    import GPUtil
+    return {gpu.id: (gpu.load, gpu.memoryUtil) for gpu in GPUtil.getGPUs()}
+
+
+def _run_job(target, args, kwargs, job_idx, gpuid, event_queue):
+    # run a job in a sub-process, and tell the scheduler when it starts and finishes
+    event_queue.put(('start', job_idx, gpuid, None))
+    exitcode = 0
+    try:
+        target(*args, gpuid=gpuid, **kwargs)
+    except SystemExit as e:
+        exitcode = e.code if isinstance(e.code, int) else 1
+    except Exception as e:
+        basic.outputlogMessage('Error, job %d on GPU %s failed: %s' % (job_idx, str(gpuid), str(e)))
+        exitcode = 1
+    event_queue.put(('finish', job_idx, gpuid, exitcode))
+    if exitcode != 0:
+        sys.exit(exitcode)
+
+
+class GPUScheduler(object):
+    """
+    run jobs on GPUs, each GPU can run at most "jobs_per_gpu" jobs at the same time.
+    A job is (target, args, kwargs), the target is called as target(*args, gpuid=gpuid, **kwargs) in a sub-process.
+    """
+
+    def __init__(self, gpu_ids, jobs_per_gpu=1, max_jobs=None, check_interval=10, b_check_usage=None,
+                 maxLoad=0.5, maxMemory=0.5, settle_seconds=30):
+        """
+        :param gpu_ids: a list of GPU ids, [None] for running on CPU (or the default GPU)
+        :param jobs_per_gpu: the maximum number of jobs running on a GPU at the same time
+        :param max_jobs: the maximum number of jobs running at the same time, None for no limit
+        :param check_interval: seconds, check if any sub-process exited without sending the finish event,
+        and check the usage of GPUs again if no GPU is available
+        :param b_check_usage: if True, query the usage of GPUs before starting a job, None for True if gpu_ids
+        are real GPUs (not [None]). If False, the slots are fixed.
+        :param maxLoad: a GPU not running our jobs is used only if its load is not larger than this
+        :param maxMemory: a GPU is used (or gets one more job) only if its memory usage is not larger than this
+        :param settle_seconds: after starting a job on a GPU, wait this long before putting another job on it,
+        the memory usage of the new job is not shown immediately
+        """
+        if len(gpu_ids) < 1:
+            raise ValueError('No GPU for the scheduler')
+        if jobs_per_gpu < 1:
+            raise ValueError('jobs_per_gpu should be at least 1, but get %d' % jobs_per_gpu)
+        self.gpu_ids = list(gpu_ids)
+        self.jobs_per_gpu = jobs_per_gpu
+        self.max_jobs = max_jobs
+        self.check_interval = check_interval
+        self.free_slots = {gpuid: jobs_per_gpu for gpuid in self.gpu_ids}
+        if b_check_usage is None:
+            b_check_usage = None not in self.gpu_ids
+        self.b_check_usage = b_check_usage
+        self.maxLoad = maxLoad
+        self.maxMemory = maxMemory
+        self.settle_seconds = settle_seconds
+        self.last_start = {gpuid: 0 for gpuid in self.gpu_ids}
+        self.event_queue = multiprocessing.Queue()
+        self.running = {}  # job_idx: (process, gpuid)
+        self.failed_jobs = []
+
+    def _get_free_gpu(self):
+        if self.max_jobs is not None and len(self.running) >= self.max_jobs:
+            return False, None
+        candidates = [item for item in self.gpu_ids if self.free_slots[item] > 0]
+        if len(candidates) < 1:
+            return False, None
+        if self.b_check_usage is False:
+            # the GPU with the most free slots
+            return True, max(candidates, key=lambda item: self.free_slots[item])
+
+        usage = get_gpu_usage()
+        available = []
+        for gpuid in candidates:
+            if gpuid not in usage:
+                continue
+            load, memory_util = usage[gpuid]
+            if self.free_slots[gpuid] == self.jobs_per_gpu:
+                # not running our jobs, it should be idle (it may be used by others)
+                if load > self.maxLoad or memory_util > self.maxMemory:
+                    continue
+            else:
+                # running our jobs, add one more only if the memory allows
+                if time.time() - self.last_start[gpuid] < self.settle_seconds or memory_util > self.maxMemory:
+                    continue
+            available.append(gpuid)
+        if len(available) < 1:
+            return False, None
+        # the GPU with the most free slots, then the lowest memory usage
+        return True, min(available, key=lambda item: (-self.free_slots[item], usage[item][1]))
+
+    def _start_job(self, job_idx, job, gpuid):
+        target, args, kwargs = job
+        sub_process = Process(target=_run_job, args=(target, args, kwargs, job_idx, gpuid, self.event_queue))
+        sub_process.start()
+        self.free_slots[gpuid] -= 1
+        self.last_start[gpuid] = time.time()
+        self.running[job_idx] = (sub_process, gpuid)
+
+    def _finish_job(self, job_idx, exitcode):
+        sub_process, gpuid = self.running.pop(job_idx)
+        sub_process.join()
+        if exitcode is None:
+            exitcode = sub_process.exitcode
+        if exitcode != 0:
+            self.failed_jobs.append(job_idx)
+        sub_process.close()
+        self.free_slots[gpuid] += 1
+
+    def _wait_event(self, b_return_on_timeout=False):
+        # wait for the next finish event; also check the sub-processes which exited without sending the event
+        # if b_return_on_timeout, return after check_interval (then the usage of GPUs can be checked again)
+        while True:
+            try:
+                event, job_idx, gpuid, exitcode = self.event_queue.get(timeout=self.check_interval)
+            except queue.Empty:
+                for job_idx in list(self.running.keys()):
+                    sub_process, _ = self.running[job_idx]
+                    if sub_process.is_alive() is False:
+                        # drain the events of this process (if any) before treating it as crashed
+                        time.sleep(1)
+                        if self.event_queue.empty() and job_idx in self.running:
+                            basic.outputlogMessage('job %d exited without the finish event' % job_idx)
+                            self._finish_job(job_idx, None)
+                            return
+                if b_return_on_timeout:
+                    return
+                continue
+            if event == 'start':
+                basic.outputlogMessage('job %d started on GPU %s' % (job_idx, str(gpuid)))
+            elif event == 'finish' and job_idx in self.running:
+                self._finish_job(job_idx, exitcode)
+                return
+
+    def run(self, jobs, stop_on_error=True):
+        """
+        run all the jobs
+        :param jobs: a list of (target, args, kwargs)
+        :param stop_on_error: if True, don't start new jobs after a job failed
+        :return: a list of the index of failed jobs
+        """
+        job_idx = 0
+        while job_idx < len(jobs) or len(self.running) > 0:
+            if stop_on_error and len(self.failed_jobs) > 0:
+                if len(self.running) < 1:
+                    break
+                self._wait_event()
+                continue
+            b_free, gpuid = self._get_free_gpu()
+            if job_idx < len(jobs) and b_free:
+                self._start_job(job_idx, jobs[job_idx], gpuid)
+                job_idx += 1
+                continue
+            if job_idx < len(jobs) and self.b_check_usage:
+                # a slot is free but the GPU is busy, check again later
+                if len(self.running) < 1:
+                    time.sleep(self.check_interval)
+                else:
+                    self._wait_event(b_return_on_timeout=True)
+                continue
+            self._wait_event()
+        return self.failed_jobs
+
+
+def sort_jobs_by_pixel_count(jobs, image_paths):
+    """
+    sort the jobs by the pixel count of their images (largest first), so the large images don't start at the end
+    :param jobs: a list of jobs
+    :param image_paths: the image path of each job
+    :return: the sorted jobs
+    """
+    import datasets.raster_io as raster_io
+    if len(jobs) != len(image_paths):
+        raise ValueError('the count of jobs (%d) and images (%d) are different' % (len(jobs), len(image_paths)))
+    pixel_counts = []
+    for img_path in image_paths:
+        height, width, _, _ = raster_io.get_height_width_bandnum_dtype(img_path)
+        pixel_counts.append(height * width)
+    # sorted is stable, images with the same size keep their order
+    order = sorted(range(len(jobs)), key=lambda idx: pixel_counts[idx], reverse=True)
+    return [jobs[idx] for idx in order]
+
+
+def get_scheduler_gpus(b_use_multiGPUs, order='first'):
+    """
+    get the GPU ids for the scheduler
+    :param b_use_multiGPUs: if False, use the default GPU (or CPU)
+    :param order: the order of GPUs, first or memory
+    :return: a list of GPU ids, all visible GPUs (the scheduler checks their usage before starting a job)
+    """
+    if b_use_multiGPUs:
+        gpu_ids = get_visible_gpus()
+        basic.outputlogMessage('on %s, visible GPUs: %s' % (os.uname()[1], str(gpu_ids)))
+        if order == 'memory':
+            usage = get_gpu_usage()
+            gpu_ids = sorted(gpu_ids, key=lambda item: usage.get(item, (0, 0))[1])
+        return gpu_ids
+    return [None]
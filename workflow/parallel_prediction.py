@@ -15,9 +15,10 @@ import os, sys
 import time
 from optparse import OptionParser
 
-import GPUtil
 import datetime
-from multiprocessing import Process
+import subprocess
+import threading
+import queue
 
 code_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
 sys.path.insert(0, code_dir)
@@ -25,16 +26,24 @@ import parameters
 
 import basic_src.io_function as io_function
 import basic_src.basic as basic
+import workflow.gpu_scheduler as gpu_scheduler
 
 from workflow.deeplab_train import get_trained_iteration
 
 # the python with tensorflow 1.x installed
 tf1x_python = 'python'
 
+# the prefix of the line written by deeplab_inference.py (worker mode) after a job is done
+worker_done_prefix = 'INF_WORKER_DONE:'
+
 def is_file_exist_in_folder(folder):
     # only check the first ten files
     # update on July 21, 2020. For some case, the first 10 may not exist (ignore if they are black)
     # so, if we find any file exist from 0 to 1000000, then return True
+    # when the results are saved in one mosaic (inf_output_mode = mosaic), it is renamed to I0_mosaic.tif after
+    # all the patches are written (an interrupted one is I0_mosaic.tif.tmp, not counted)
+    if os.path.isfile(os.path.join(folder, 'I0_mosaic.tif')):
+        return True
     for i in range(1000000):
         if os.path.isfile(os.path.join(folder, 'I0_%d.tif' % i)):
             return True
@@ -46,6 +55,23 @@ def is_file_exist_in_folder(folder):
     #     return False
 
 
+def get_frozen_graph_path(para_file, trained_model=None):
+    if trained_model is None:
+        WORK_DIR = os.getcwd()
+        expr_name = parameters.get_string_parameters(para_file, 'expr_name')
+        EXP_FOLDER = expr_name
+        EXPORT_DIR = os.path.join(WORK_DIR, EXP_FOLDER, 'export')
+        TRAIN_LOGDIR = os.path.join(WORK_DIR, EXP_FOLDER, 'train')
+        iteration_num = get_trained_iteration(TRAIN_LOGDIR)
+        EXPORT_PATH = os.path.join(EXPORT_DIR, 'frozen_inference_graph_%s.pb' % iteration_num)
+        frozen_graph_path = EXPORT_PATH
+    else:
+        frozen_graph_path = trained_model
+
+    if os.path.isfile(frozen_graph_path) is False:
+        raise IOError('cannot find trained model: %s'%frozen_graph_path)
+    return frozen_graph_path
+
 def predict_one_image_deeplab(deeplab_inf_script, para_file,network_ini, save_dir,inf_list_file,gpuid=None, trained_model=None):
 
     done_indicator = '%s_done'%inf_list_file
@@ -62,20 +88,7 @@ def predict_one_image_deeplab(deeplab_inf_script, para_file,network_ini, save_di
     # # os.system(command_string + "&")  # don't know when it finished
     # os.system(command_string )      # this work
 
-    if trained_model is None:
-        WORK_DIR = os.getcwd()
-        expr_name = parameters.get_string_parameters(para_file, 'expr_name')
-        EXP_FOLDER = expr_name
-        EXPORT_DIR = os.path.join(WORK_DIR, EXP_FOLDER, 'export')
-        TRAIN_LOGDIR = os.path.join(WORK_DIR, EXP_FOLDER, 'train')
-        iteration_num = get_trained_iteration(TRAIN_LOGDIR)
-        EXPORT_PATH = os.path.join(EXPORT_DIR, 'frozen_inference_graph_%s.pb' % iteration_num)
-        frozen_graph_path = EXPORT_PATH
-    else:
-        frozen_graph_path = trained_model
-
-    if os.path.isfile(frozen_graph_path) is False:
-        raise IOError('cannot find trained model: %s'%frozen_graph_path)
+    frozen_graph_path = get_frozen_graph_path(para_file, trained_model=trained_model)
 
     inf_batch_size = parameters.get_digit_parameters_None_if_absence(network_ini,'inf_batch_size','int')
     if inf_batch_size is None:
@@ -101,6 +114,96 @@ def predict_one_image_deeplab(deeplab_inf_script, para_file,network_ini, save_di
 
 
 
+def deeplab_inference_worker(deeplab_inf_script, para_file, network_ini, job_queue, failed_jobs, gpuid=None,
+                             trained_model=None):
+    """
+    start a long-lived deeplab_inference.py process (the frozen graph is loaded once) on a GPU,
+    then send the jobs in job_queue to it one by one.
+    :param job_queue: a queue of (image path, save_dir, inf_list_file)
+    :param failed_jobs: a list for saving the failed jobs
+    :param gpuid: the GPU for this worker, None for using the default
+    :return:
+    """
+    frozen_graph_path = get_frozen_graph_path(para_file, trained_model=trained_model)
+    inf_batch_size = parameters.get_digit_parameters_None_if_absence(network_ini,'inf_batch_size','int')
+    if inf_batch_size is None:
+        raise ValueError('inf_batch_size not set in %s'%network_ini)
+
+    command_string = tf1x_python + ' '  +  deeplab_inf_script \
+                + ' --inf_para_file='+para_file \
+                + ' --inf_batch_size='+str(inf_batch_size) \
+                + ' --frozen_graph_path='+frozen_graph_path \
+                + ' --inf_worker_mode=True'
+    worker_env = os.environ.copy()
+    if gpuid is not None:
+        worker_env['CUDA_VISIBLE_DEVICES'] = str(gpuid)
+    worker = subprocess.Popen(command_string, shell=True, env=worker_env, stdin=subprocess.PIPE,
+                              stdout=subprocess.PIPE, universal_newlines=True, bufsize=1)
+
+    while True:
+        try:
+            image_path, save_dir, inf_list_file = job_queue.get_nowait()
+        except queue.Empty:
+            break
+        time0 = time.time()
+        basic.outputlogMessage('predict image %s on GPU %s' % (image_path, str(gpuid)))
+        worker.stdin.write('%s\t%s\n' % (inf_list_file, save_dir))
+        worker.stdin.flush()
+
+        # print the output of the worker until the job is done
+        status = 'failed'
+        for line in worker.stdout:
+            if line.startswith(worker_done_prefix):
+                status = line[len(worker_done_prefix):].split('\t')[0]
+                break
+            print(line, end='')
+        if status != 'success':
+            failed_jobs.append(inf_list_file)
+            basic.outputlogMessage('Error, prediction of %s failed' % image_path)
+            if worker.poll() is not None:
+                # the worker exited, stop this worker
+                break
+            continue
+
+        duration = time.time() - time0
+        os.system('echo "$(date): time cost of inference for image in %s: %.2f seconds">>"time_cost.txt"' % (inf_list_file, duration))
+        # write a file to indicate that the prediction has done.
+        os.system('echo %s > %s_done'%(inf_list_file,inf_list_file))
+
+    if worker.poll() is None:
+        worker.stdin.write('exit\n')
+        worker.stdin.flush()
+    worker.stdin.close()
+    worker.wait()
+
+
+def predict_with_persistent_workers(deeplab_inf_script, para_file, network_ini, jobs, b_use_multiGPUs,
+                                    trained_model=None):
+    """
+    run prediction of all the jobs using one long-lived worker on each GPU, instead of one process for each image
+    :param jobs: a list of (image path, save_dir, inf_list_file)
+    :param b_use_multiGPUs: if True, start a worker on each available GPU
+    :return: a list of the failed jobs
+    """
+    gpu_ids = gpu_scheduler.get_scheduler_gpus(b_use_multiGPUs)[:len(jobs)]
+
+    job_queue = queue.Queue()
+    for job in jobs:
+        job_queue.put(job)
+    failed_jobs = []
+    workers = [threading.Thread(target=deeplab_inference_worker,
+                                args=(deeplab_inf_script, para_file, network_ini, job_queue, failed_jobs, gpuid,
+                                      trained_model)) for gpuid in gpu_ids]
+    for thr in workers:
+        thr.start()
+    for thr in workers:
+        thr.join()
+    # if all the workers stopped because of errors, the remaining jobs were not run
+    while job_queue.empty() is False:
+        failed_jobs.append(job_queue.get_nowait()[2])
+    return failed_jobs
+
+
 def b_all_task_finish(all_tasks):
     for task in all_tasks:
         if task.is_alive():
@@ -148,9 +251,17 @@ def main(options, args):
     # max_parallel_inf_task = parameters.get_digit_parameters(para_file,'max_parallel_inf_task','int')
 
     b_use_multiGPUs = parameters.get_bool_parameters(para_file,'b_use_multiGPUs')
+    # keep one process on each GPU to load the model once, instead of starting a process for each image
+    b_persistent_worker = parameters.get_bool_parameters_None_if_absence(para_file,'b_inf_persistent_worker')
+
+    # the number of images running on a GPU at the same time
+    jobs_per_gpu = parameters.get_digit_parameters_None_if_absence(para_file,'inf_jobs_per_gpu','int')
+    if jobs_per_gpu is None:
+        jobs_per_gpu = 1
 
+    # (image path, save_dir, inf_list_file) of all the images in all the regions
+    all_images = []
     # loop each inference regions
-    sub_tasks = []
     for area_idx, area_ini in enumerate(multi_inf_regions):
 
         area_name = parameters.get_string_parameters(area_ini,'area_name')
@@ -170,86 +281,48 @@ def main(options, args):
         area_save_dir = os.path.join(outdir, area_name + '_' + area_remark + '_' + area_time)
         io_function.mkdir(area_save_dir)
 
-        # parallel inference images for this area
-        CUDA_VISIBLE_DEVICES = []
-        if 'CUDA_VISIBLE_DEVICES' in os.environ.keys():
-            CUDA_VISIBLE_DEVICES = [int(item.strip()) for item in os.environ['CUDA_VISIBLE_DEVICES'].split(',')]
-        idx = 0
-        while idx < img_count:
-
-            if b_use_multiGPUs:
-                # get available GPUs  # https://github.com/anderskm/gputil
-                deviceIDs = GPUtil.getAvailable(order='first', limit=100, maxLoad=0.5,
-                                                maxMemory=0.5, includeNan=False, excludeID=[], excludeUUID=[])
-                # only use the one in CUDA_VISIBLE_DEVICES
-                if len(CUDA_VISIBLE_DEVICES) > 0:
-                    deviceIDs = [ item for item in deviceIDs if item in CUDA_VISIBLE_DEVICES]
-                    basic.outputlogMessage('on ' + machine_name + ', available GPUs:'+str(deviceIDs) +
-                                           ', among visible ones:'+str(CUDA_VISIBLE_DEVICES))
-                else:
-                    basic.outputlogMessage('on ' + machine_name + ', available GPUs:' + str(deviceIDs))
-
-                if len(deviceIDs) < 1:
-                    time.sleep(60)  # wait one minute, then check the available GPUs again
-                    continue
-                # set only the first available visible
-                gpuid = deviceIDs[0]
-                basic.outputlogMessage('%d: predict image %s on GPU %d of %s' % (idx, inf_img_list[idx], gpuid, machine_name))
-            else:
-                gpuid = None
-                basic.outputlogMessage('%d: predict image %s on %s' % (idx, inf_img_list[idx], machine_name))
-
-            # run inference
+        # pool the images of all the regions, keep the folder layout: area_save_dir/I{idx}
+        for idx in range(img_count):
             img_save_dir = os.path.join(area_save_dir,'I%d'%idx)
             inf_list_file = os.path.join(area_save_dir,'%d.txt'%idx)
 
+            if b_persistent_worker:
+                if os.path.isfile('%s_done'%inf_list_file):
+                    basic.outputlogMessage('warning, %s_done exist, skip prediction'%inf_list_file)
+                    continue
             # if it already exist, then skip
-            if os.path.isdir(img_save_dir) and is_file_exist_in_folder(img_save_dir):
+            elif os.path.isdir(img_save_dir) and is_file_exist_in_folder(img_save_dir):
                 basic.outputlogMessage('folder of %dth image (%s) already exist, '
                                        'it has been predicted or is being predicted'%(idx, inf_img_list[idx]))
-                idx += 1
                 continue
 
             with open(inf_list_file,'w') as inf_obj:
                 inf_obj.writelines(inf_img_list[idx] + '\n')
-
-            sub_process = Process(target=predict_one_image_deeplab,
-                                  args=(deeplab_inf_script, para_file,network_setting_ini,img_save_dir,inf_list_file,gpuid,trained_model))
-            sub_process.start()
-            sub_tasks.append(sub_process)
-
-            if b_use_multiGPUs is False:
-                # wait until previous one finished
-                while sub_process.is_alive():
-                    time.sleep(5)
-
-            idx += 1
-
-            # wait until predicted image patches exist or exceed 20 minutes
-            time0 = time.time()
-            elapsed_time = time.time() - time0
-            while elapsed_time < 20*60:
-                elapsed_time = time.time() - time0
-                file_exist = is_file_exist_in_folder(img_save_dir)
-                if file_exist is True or sub_process.is_alive() is False:
-                    break
-                else:
-                    time.sleep(5)
-
-            if sub_process.exitcode is not None and sub_process.exitcode !=0:
-                sys.exit(1)
-
-            close_remove_completed_task(sub_tasks)
-            # if 'chpc' in machine_name:
-            #     time.sleep(60)  # wait 60 second on ITSC services
-            # else:
-            #     time.sleep(10)
-
-    # check all the tasks already finished
-    while b_all_task_finish(sub_tasks) is False:
-        basic.outputlogMessage('wait all tasks to finish')
-        time.sleep(60)
-    close_remove_completed_task(sub_tasks)
+            all_images.append((inf_img_list[idx], img_save_dir, inf_list_file))
+
+    # predict the largest images first, then the small ones fill the gaps on GPUs at the end
+    all_images = gpu_scheduler.sort_jobs_by_pixel_count(all_images, [item[0] for item in all_images])
+    basic.outputlogMessage('%d images of %d regions to predict on %s' % (len(all_images), len(multi_inf_regions),
+                                                                         machine_name))
+
+    if b_persistent_worker:
+        failed_jobs = predict_with_persistent_workers(deeplab_inf_script, para_file, network_setting_ini,
+                                                      all_images, b_use_multiGPUs, trained_model=trained_model)
+        if len(failed_jobs) > 0:
+            basic.outputlogMessage('Error, prediction of %d images failed: %s' % (len(failed_jobs), str(failed_jobs)))
+            sys.exit(1)
+    elif len(all_images) > 0:
+        jobs = [(predict_one_image_deeplab,
+                 (deeplab_inf_script, para_file, network_setting_ini, img_save_dir, inf_list_file),
+                 {'trained_model': trained_model}) for _, img_save_dir, inf_list_file in all_images]
+        # start the next image as soon as a GPU slot is free
+        scheduler = gpu_scheduler.GPUScheduler(gpu_scheduler.get_scheduler_gpus(b_use_multiGPUs),
+                                               jobs_per_gpu=jobs_per_gpu)
+        failed_jobs = scheduler.run(jobs)
+        if len(failed_jobs) > 0:
+            basic.outputlogMessage('Error, prediction of %d images failed: %s' %
+                                   (len(failed_jobs), str([all_images[item][0] for item in failed_jobs])))
+            sys.exit(1)
 
     end_time = datetime.datetime.now()
 
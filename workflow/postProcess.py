@@ -69,6 +69,9 @@ def inf_results_to_shapefile(curr_dir,img_idx, area_save_dir, test_id):
     merged_tif = 'I%d'%img_idx + '_' + out_name + '.tif'
     if os.path.isfile(merged_tif):
         print('%s already exist'%merged_tif)
+    elif os.path.isfile('I0_mosaic.tif'):
+        # the results have been written into one mosaic during inference, no need to run gdal_merge.py
+        io_function.move_file_to_dst('I0_mosaic.tif', merged_tif)
     else:
         # check if tif exists
         tif_list = io_function.get_file_list_by_pattern('./', 'I0_*.tif')
@@ -197,11 +200,9 @@ def get_occurence_for_multi_observation(shp_list):
     import polygons_change_analyze
 
     # check projection of the shape file, should be the same
-    new_shp_proj4 = map_projection.get_raster_or_vector_srs_info_proj4(shp_list[0])
     for idx in range(len(shp_list)-1):
-        shp_proj4 = map_projection.get_raster_or_vector_srs_info_proj4(shp_list[ idx+1 ])
-        if shp_proj4 != new_shp_proj4:
-            raise ValueError('error, projection insistence between %s and %s'%(new_shp_proj4, shp_proj4))
+        if map_projection.is_same_projection(shp_list[0], shp_list[ idx+1 ]) is False:
+            raise ValueError('error, projection insistence between %s and %s'%(shp_list[0], shp_list[ idx+1 ]))
 
     polygons_change_analyze.cal_multi_temporal_iou_and_occurrence(shp_list, '')
 
@@ -23,6 +23,7 @@ from merge_shapefiles import merge_shape_files
 
 import vector_gpd
 import raster_io
+import detection_results
 
 from datasets.get_polygon_attributes import add_boxes_attributes
 from datasets.remove_mappedPolygons import remove_polygons_main
@@ -34,7 +35,7 @@ from workflow.postProcess import get_observation_save_dir_shp_pre
 from workflow.postProcess import get_occurence_for_multi_observation
 
 from yoltv4Based.yolt_func import convert_reverse
-from yoltv4Based.yolt_func import non_max_suppression
+from yoltv4Based.yolt_func import non_max_suppression_grid
 
 
 import rasterio
@@ -131,13 +132,55 @@ def boxes_minXYmaxXY_to_imageXY(idx, total, json_file, ref_image_src):
 
     return class_id_list, name_list, confidence_list, box_poly_list
 
+def pixel_boxes_to_geo_bounds(boxes, transform):
+    '''
+    convert boxes in pixel coordinates to geo bounds, all boxes at once
+    :param boxes: (N, 4) array: xmin, ymin, xmax, ymax (pixel)
+    :param transform: the affine transform of the image
+    :return: (N, 4) array: minX, minY, maxX, maxY (geo)
+    '''
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    affine = np.array([[transform[0], transform[1], transform[2]],
+                       [transform[3], transform[4], transform[5]]], dtype=np.float64)
+    # corners (xmin, ymin) and (xmax, ymax) as homogeneous coordinates, (2N, 3)
+    corners = np.ones((len(boxes) * 2, 3), dtype=np.float64)
+    corners[:, :2] = boxes.reshape(-1, 2)
+    geo_xy = (corners @ affine.T).reshape(-1, 2, 2)
+    # Y direction in geo may be opposite to the in pixel, so use min and max
+    return np.concatenate([geo_xy.min(axis=1), geo_xy.max(axis=1)], axis=1)
+
+def read_patch_json_to_arrays(json_files):
+    '''
+    read the detected objects in the json files of patches
+    :param json_files: json files, each one is a list of objects (bbox, class_id, name, confidence)
+    :return: class_id (N,), name (N,), confidence (N,), boxes (N, 4) (xmin, ymin, xmax, ymax in pixel)
+    '''
+    class_id_list = []
+    name_list = []
+    confidence_list = []
+    bbox_list = []
+    for f_json in json_files:
+        objects = io_function.read_dict_from_txt_json(f_json)
+        if objects is None or len(objects) < 1:
+            continue
+        class_id_list.extend([obj['class_id'] for obj in objects])
+        name_list.extend([obj['name'] for obj in objects])
+        confidence_list.extend([obj['confidence'] for obj in objects])
+        bbox_list.extend([obj['bbox'] for obj in objects])
+    return np.array(class_id_list, dtype=np.int32), np.array(name_list, dtype=object), \
+        np.array(confidence_list, dtype=np.float64), np.array(bbox_list, dtype=np.float64).reshape(-1, 4)
+
 def yolo_results_to_shapefile(curr_dir,img_idx, area_save_dir, nms_overlap_thr, test_id):
 
     img_save_dir = os.path.join(area_save_dir, 'I%d' % img_idx)
     res_yolo_json = img_save_dir + '_result.json'
     res_json_files = []
+    # the detected objects of all patches in one file
+    res_npy = detection_results.get_detection_result_path(img_save_dir)
     if os.path.isfile(res_yolo_json):
         print('found %s in %s, will get shapefile from it'%(res_yolo_json, area_save_dir))
+    elif os.path.isfile(res_npy):
+        print('found %s, will get shapefile from it' % res_npy)
     else:
         if os.path.isdir(img_save_dir):
             res_json_files = io_function.get_file_list_by_ext('.json',img_save_dir,bsub_folder=False)
@@ -159,13 +202,19 @@ def yolo_results_to_shapefile(curr_dir,img_idx, area_save_dir, nms_overlap_thr,
     if os.path.isfile(out_shp_path):
         print('%s already exist' % out_shp_path)
     else:
-        class_id_list = []
-        name_list = []
-        box_bounds_list = []
-        confidence_list = []
-        source_image_list = []
-
-        if len(res_json_files) < 1:
+        if os.path.isfile(res_npy) and not os.path.isfile(res_yolo_json):
+            image1 = io_function.read_list_from_txt(os.path.join(area_save_dir, '%d.txt'%img_idx))[0]
+            class_ids, names, confidences, pixel_boxes = detection_results.read_detection_results(res_npy)
+            with rasterio.open(image1) as src:
+                transform = src.transform
+            box_bounds = pixel_boxes_to_geo_bounds(pixel_boxes, transform)
+            source_images = np.array([os.path.basename(image1)]*len(box_bounds), dtype=object)
+        elif len(res_json_files) < 1:
+            class_id_list = []
+            name_list = []
+            box_bounds_list = []
+            confidence_list = []
+            source_image_list = []
             # use the result in *_result.json
             yolo_res_dict_list = io_function.read_dict_from_txt_json(res_yolo_json)
             total_frame = len(yolo_res_dict_list)
@@ -177,45 +226,34 @@ def yolo_results_to_shapefile(curr_dir,img_idx, area_save_dir, nms_overlap_thr,
                 confidence_list.extend(con_list)
                 box_bounds_list.extend(box_list)
                 source_image_list.extend( [os.path.basename(image1)]*len(box_list) )
+            class_ids = np.array(class_id_list)
+            names = np.array(name_list, dtype=object)
+            confidences = np.array(confidence_list, dtype=np.float64)
+            box_bounds = np.array(box_bounds_list, dtype=np.float64).reshape(-1, 4)
+            source_images = np.array(source_image_list, dtype=object)
         else:
-            # use the results in I0/*.json
+            # use the results in I0/*.json (results of old versions)
             image1 = io_function.read_list_from_txt(os.path.join(area_save_dir, '%d.txt'%img_idx))[0]
-            total_frame = len(res_json_files)   # the patch numbers
-
-            # only open image once
+            class_ids, names, confidences, pixel_boxes = read_patch_json_to_arrays(res_json_files)
             with rasterio.open(image1) as src:
-                for idx, f_json in enumerate(res_json_files):
-                    id_list, na_list, con_list, box_list = boxes_minXYmaxXY_to_imageXY(idx, total_frame,f_json,src)
-                    class_id_list.extend(id_list)
-                    name_list.extend(na_list)
-                    confidence_list.extend(con_list)
-                    box_bounds_list.extend(box_list)
-
-            source_image_list.extend([os.path.basename(image1)]*len(box_bounds_list))
+                transform = src.transform
+            box_bounds = pixel_boxes_to_geo_bounds(pixel_boxes, transform)
+            source_images = np.array([os.path.basename(image1)]*len(box_bounds), dtype=object)
 
-        if len(box_bounds_list) < 1:
+        if len(box_bounds) < 1:
             print('Warning, no predicted boxes in %s' % img_save_dir)
             return None
 
-        # apply non_max_suppression
-        # print('box_bounds_list',box_bounds_list)
-        # print('confidence_list',confidence_list)
-        pick_index = non_max_suppression(np.array(box_bounds_list), probs=np.array(confidence_list),
-                                         overlapThresh=nms_overlap_thr,b_geo=True)
-        # print('pick_index', pick_index)
-        class_id_list = [class_id_list[idx] for idx in pick_index]
-        name_list = [name_list[idx] for idx in pick_index ]
-        confidence_list = [confidence_list[idx] for idx in pick_index ]
-        box_bounds_list = [ box_bounds_list[idx] for idx in pick_index ]
-        source_image_list = [ source_image_list[idx] for idx in pick_index ]
+        # apply non_max_suppression, only check boxes nearby
+        pick_index = non_max_suppression_grid(box_bounds, confidences, overlapThresh=nms_overlap_thr, b_geo=True)
+        print('non-max suppression: keep %d of %d boxes' % (len(pick_index), len(box_bounds)))
         # to polygon
-        box_poly_list = [ vector_gpd.convert_image_bound_to_shapely_polygon(item) for item in box_bounds_list]
-
-        # box_poly_list
+        box_poly_list = vector_gpd.convert_bounds_array_to_polygons(box_bounds[pick_index])
 
         # save to shapefile
-        detect_boxes_dict = {'class_id':class_id_list, 'name':name_list, 'source_img':source_image_list,
-                             'confidence':confidence_list, "Polygon":box_poly_list}
+        detect_boxes_dict = {'class_id':class_ids[pick_index], 'name':names[pick_index],
+                             'source_img':source_images[pick_index],
+                             'confidence':confidences[pick_index], "Polygon":box_poly_list}
         save_pd = pd.DataFrame(detect_boxes_dict)
         ref_prj = map_projection.get_raster_or_vector_srs_info_proj4(image1)
         vector_gpd.save_polygons_to_files(save_pd,'Polygon',ref_prj,out_shp_path)
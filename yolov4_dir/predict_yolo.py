@@ -13,8 +13,6 @@ import time
 from datetime import datetime
 from optparse import OptionParser
 
-import GPUtil
-from multiprocessing import Process
 
 code_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
 sys.path.insert(0, code_dir)
@@ -24,7 +22,9 @@ import basic_src.io_function as io_function
 import basic_src.basic as basic
 import datasets.split_image as split_image
 import datasets.raster_io as raster_io
+import workflow.gpu_scheduler as gpu_scheduler
 import datasets.build_RS_data as build_RS_data
+import datasets.detection_results as detection_results
 
 # add darknet Python API
 darknet_dir = os.environ.get('DARKNET_PATH', './')
@@ -276,7 +276,7 @@ def copy_one_patch_image_data(patch, entire_img_data):
 
 
 def darknet_batch_detection_rs_images(network, image_path,save_dir, patch_groups, patch_count, class_names,batch_size,
-                    thresh=0.25, hier_thresh=.5, nms=.45):
+                    det_buffer, thresh=0.25, hier_thresh=.5, nms=.45, b_streaming=False):
     '''
     # run batch detection of YOLO on an remote sensing image.
     :param network: a darknet network (already load the weight)
@@ -284,14 +284,21 @@ def darknet_batch_detection_rs_images(network, image_path,save_dir, patch_groups
     :param patch_groups: the group of images patch, each group has the same width and height.
     :param class_names:
     :param batch_size:
+    :param det_buffer: DetectionBuffer, the detected objects are added to it
     :param thresh:
     :param hier_thresh:
     :param nms:
+    :param b_streaming: if True, read patches from the disk on demand, instead of reading the entire image
     :return:
     '''
-    # read the entire image
-    entire_img_data, nodata = raster_io.read_raster_all_bands_np(image_path)
-    entire_img_data = entire_img_data.transpose(1, 2, 0)    # to opencv format
+    if b_streaming:
+        # read patches on demand, only keep a few row strips in memory
+        max_patch_h = max([patches[0][3] for patches in patch_groups.values()]) if len(patch_groups) > 0 else 0
+        entire_img_data = raster_io.RasterStripReader(image_path, min_rows=max_patch_h)
+    else:
+        # read the entire image
+        entire_img_data, nodata = raster_io.read_raster_all_bands_np(image_path)
+        entire_img_data = entire_img_data.transpose(1, 2, 0)    # to opencv format
     # # RGB to BGR: Matplotlib image to OpenCV https://www.scivision.dev/numpy-image-bgr-to-rgb/
     # entire_img_data = entire_img_data[..., ::-1].copy()       # cancel RGB to BGR, since it make results worse, (maybe darknet already read images as RGB during training)
     entire_height, entire_width, band_num = entire_img_data.shape
@@ -361,9 +368,8 @@ def darknet_batch_detection_rs_images(network, image_path,save_dir, patch_groups
                 if idx >= input_batch_size:
                     break
                 # save results
-                save_res_json = os.path.join(save_dir, '%d.json' % patch_idx)
                 # the confidence output by network_predict_batch is 0-1, convert to percent
-                save_one_patch_detection_json(patch, predictions, class_names, save_res_json, b_percent=True)
+                add_one_patch_detections(patch_idx, patch, predictions, class_names, det_buffer, b_percent=True)
 
                 
                 # cv2.imwrite('%d.png'%patch_idx, image)    # save for testing
@@ -376,6 +382,9 @@ def darknet_batch_detection_rs_images(network, image_path,save_dir, patch_groups
 
                 patch_idx += 1
 
+    if b_streaming:
+        entire_img_data.close()
+
 
 def test_darknet_batch_detection_rs_images():
     print('\n')
@@ -420,14 +429,18 @@ def test_darknet_batch_detection_rs_images():
     # load network
     network, class_names, class_colors = load_darknet_network(config_file, yolo_data, weights, batch_size=batch_size)
 
+    det_buffer = detection_results.DetectionBuffer(class_names)
     darknet_batch_detection_rs_images(network, image_path, save_dir, patch_groups, patch_count, class_names, batch_size,
-                                      thresh=0.25, hier_thresh=.5, nms=.45)
+                                      det_buffer, thresh=0.25, hier_thresh=.5, nms=.45)
+    det_buffer.save(detection_results.get_detection_result_path(save_dir))
 
 
 
-def save_one_patch_detection_json(patch,detections,class_names,save_res_json,b_percent=False):
-    # patch (xoff,yoff ,xsize, ysize)
-    objects = []
+def add_one_patch_detections(patch_idx, patch, detections, class_names, det_buffer, b_percent=False):
+    # patch (xoff,yoff ,xsize, ysize), add the detected objects of a patch to det_buffer (DetectionBuffer)
+    class_id_list = []
+    confidence_list = []
+    out_bbox_list = []
     bbox_list = []
     for label, confidence, bbox in detections:
         # print('yolo relative',bbox, confidence,label)
@@ -453,15 +466,11 @@ def save_one_patch_detection_json(patch,detections,class_names,save_res_json,b_p
 
         if b_percent:
             confidence = round(confidence*100,2)
-        object = {'class_id': class_names.index(label),
-                  'name': label,
-                  'bbox': bbox,
-                  'confidence': confidence}
-        objects.append(object)
-
-    json_data = json.dumps(objects, indent=2)
-    with open(save_res_json, "w") as f_obj:
-        f_obj.write(json_data)
+        class_id_list.append(class_names.index(label))
+        out_bbox_list.append(bbox)
+        confidence_list.append(float(confidence))
+
+    det_buffer.add(patch_idx, class_id_list, out_bbox_list, confidence_list)
 
 def merge_patch_json_files_to_one(res_json_files, save_path):
     all_objects = []
@@ -475,7 +484,8 @@ def merge_patch_json_files_to_one(res_json_files, save_path):
         f_obj.write(json_data)
 
 def predict_rs_image_yolo_poythonAPI(image_path, save_dir, model, config_file, yolo_data,
-                                     patch_w, patch_h, overlay_x, overlay_y, batch_size=1):
+                                     patch_w, patch_h, overlay_x, overlay_y, batch_size=1, b_skip_invalid=False,
+                                     b_streaming=False):
     '''
     predict an remote sensing using YOLO Python API
     :param image_path:
@@ -488,13 +498,21 @@ def predict_rs_image_yolo_poythonAPI(image_path, save_dir, model, config_file, y
     :param overlay_x:
     :param overlay_y:
     :param batch_size:
+    :param b_skip_invalid: if True, skip the patches without valid pixels (nodata)
+    :param b_streaming: if True, read patches from the disk on demand, instead of reading the entire image
     :return:
     '''
     height, width, band_num, date_type = raster_io.get_height_width_bandnum_dtype(image_path)
     # print('input image: height, width, band_num, date_type',height, width, band_num, date_type)
 
     # divide the image the many small patches, then calcuate one by one, solving memory issues.
-    image_patches = split_image.sliding_window(width,height,patch_w,patch_h,adj_overlay_x=overlay_x,adj_overlay_y=overlay_y)
+    image_patches = split_image.sliding_window_array(width,height,patch_w,patch_h,adj_overlay_x=overlay_x,adj_overlay_y=overlay_y)
+    if b_skip_invalid:
+        image_patches = raster_io.get_valid_patches(image_path, image_patches)
+    if b_streaming:
+        # read patches row by row (in each group), then the cached strips can be reused
+        image_patches = split_image.sort_boundary_array_by_rows(image_patches)
+    image_patches = split_image.boundary_array_to_list(image_patches)
     patch_count = len(image_patches)
 
     if os.path.isdir(save_dir) is False:
@@ -510,15 +528,26 @@ def predict_rs_image_yolo_poythonAPI(image_path, save_dir, model, config_file, y
             patch_groups[wh_str] = [patch]
 
     network, class_names, _ = load_darknet_network(config_file, yolo_data, model, batch_size=batch_size)
+    # keep the detected objects of all patches in memory, save them to one file at the end
+    det_buffer = detection_results.DetectionBuffer(class_names)
+    save_res_path = detection_results.get_detection_result_path(save_dir)
 
     # batch detection
     if batch_size > 1:
-        return darknet_batch_detection_rs_images(network, image_path,save_dir, patch_groups, patch_count,class_names,batch_size)
+        darknet_batch_detection_rs_images(network, image_path,save_dir, patch_groups, patch_count,class_names,batch_size,
+                                          det_buffer, b_streaming=b_streaming)
+        det_buffer.save(save_res_path)
+        return
 
 
-    # read the entire image
-    entire_img_data, nodata = raster_io.read_raster_all_bands_np(image_path)
-    entire_img_data = entire_img_data.transpose(1, 2, 0)    # to opencv format
+    if b_streaming:
+        # read patches on demand, only keep a few row strips in memory
+        max_patch_h = max([patches[0][3] for patches in patch_groups.values()]) if len(patch_groups) > 0 else 0
+        entire_img_data = raster_io.RasterStripReader(image_path, min_rows=max_patch_h)
+    else:
+        # read the entire image
+        entire_img_data, nodata = raster_io.read_raster_all_bands_np(image_path)
+        entire_img_data = entire_img_data.transpose(1, 2, 0)    # to opencv format
     # # RGB to BGR: Matplotlib image to OpenCV https://www.scivision.dev/numpy-image-bgr-to-rgb/
     # entire_img_data = entire_img_data[..., ::-1].copy() # cancel RGB to BGR, since it make results worse, (maybe darknet already read images as RGB during training)
     entire_height, entire_width, band_num = entire_img_data.shape
@@ -555,8 +584,7 @@ def predict_rs_image_yolo_poythonAPI(image_path, save_dir, model, config_file, y
             detections = darknet.detect_image(network, class_names, darknet_image, thresh=0.25)
 
             # save results
-            save_res_json = os.path.join(save_dir,'%d.json'%patch_idx)
-            save_one_patch_detection_json(patch,detections,class_names,save_res_json)
+            add_one_patch_detections(patch_idx, patch, detections, class_names, det_buffer)
 
             if patch_idx % 100 == 0:
                 print('saving %d patch, total: %d, cost %f second'%(patch_idx,patch_count, time.time()-t0))
@@ -565,6 +593,10 @@ def predict_rs_image_yolo_poythonAPI(image_path, save_dir, model, config_file, y
 
         darknet.free_image(darknet_image)
 
+    if b_streaming:
+        entire_img_data.close()
+    det_buffer.save(save_res_path)
+
 
 
 
@@ -586,19 +618,16 @@ def predict_remoteSensing_image(para_file, image_path, save_dir,model, config_fi
     patch_h = parameters.get_digit_parameters(para_file, "inf_patch_height", 'int')
     overlay_x = parameters.get_digit_parameters(para_file, "inf_pixel_overlay_x", 'int')
     overlay_y = parameters.get_digit_parameters(para_file, "inf_pixel_overlay_y", 'int')
+    b_skip_invalid = parameters.get_bool_parameters_None_if_absence(para_file, 'b_inf_skip_invalid_patches')
+    # if not buffer the entire image in memory, read patches on demand
+    b_use_memory = parameters.get_bool_parameters_None_if_absence(para_file, 'b_inf_memory_buffer')
 
     if b_python_api:
         # using the python API
         predict_rs_image_yolo_poythonAPI(image_path, save_dir, model, config_file, yolo_data,
-                                         patch_w, patch_h, overlay_x, overlay_y, batch_size=batch_size)
-
-        # for each patch has a json file, may end up with a lot of json files, affect I/O
-        # try to merge them to one json file.
-        res_json_files = io_function.get_file_list_by_ext('.json', save_dir, bsub_folder=False)
-        merge_josn_path = os.path.join(save_dir,'all_patches.json')
-        merge_patch_json_files_to_one(res_json_files,merge_josn_path)
-        for f_json in res_json_files:
-            io_function.delete_file_or_dir(f_json)
+                                         patch_w, patch_h, overlay_x, overlay_y, batch_size=batch_size,
+                                         b_skip_invalid=b_skip_invalid is True, b_streaming=b_use_memory is False)
+        # the objects of all patches are saved in one file (detection_results.result_file_name)
 
     else:
         # divide image the many patches, then run prediction.
@@ -663,9 +692,13 @@ def parallel_prediction_main(para_file, trained_model):
     multi_inf_regions = parameters.get_string_list_parameters(para_file, 'inference_regions')
     b_use_multiGPUs = parameters.get_bool_parameters(para_file, 'b_use_multiGPUs')
     maximum_prediction_jobs = parameters.get_digit_parameters(para_file,'maximum_prediction_jobs','int')
+    # the number of images running on a GPU at the same time
+    jobs_per_gpu = parameters.get_digit_parameters_None_if_absence(para_file, 'inf_jobs_per_gpu', 'int')
+    if jobs_per_gpu is None:
+        jobs_per_gpu = 1
+    scheduler = None
 
     # loop each inference regions
-    sub_tasks = []
     for area_idx, area_ini in enumerate(multi_inf_regions):
 
         area_name = parameters.get_string_parameters(area_ini, 'area_name')
@@ -687,101 +720,35 @@ def parallel_prediction_main(para_file, trained_model):
         io_function.mkdir(area_save_dir)
 
         # parallel inference images for this area
-        CUDA_VISIBLE_DEVICES = []
-        if 'CUDA_VISIBLE_DEVICES' in os.environ.keys():
-            CUDA_VISIBLE_DEVICES = [int(item.strip()) for item in os.environ['CUDA_VISIBLE_DEVICES'].split(',')]
-        idx = 0
-        while idx < img_count:
-
-            while basic.alive_process_count(sub_tasks) >= maximum_prediction_jobs:
-                print(datetime.now(),'%d jobs are running simultaneously, wait 5 seconds'%basic.alive_process_count(sub_tasks))
-                time.sleep(5)   # wait 5 seconds, then check the count of running jobs again
-
-            if b_use_multiGPUs:
-                # get available GPUs  # https://github.com/anderskm/gputil
-                # memory: orders the available GPU device ids by ascending memory usage
-                deviceIDs = GPUtil.getAvailable(order='memory', limit=100, maxLoad=0.5,
-                                                maxMemory=0.5, includeNan=False, excludeID=[], excludeUUID=[])
-                # only use the one in CUDA_VISIBLE_DEVICES
-                if len(CUDA_VISIBLE_DEVICES) > 0:
-                    deviceIDs = [item for item in deviceIDs if item in CUDA_VISIBLE_DEVICES]
-                    basic.outputlogMessage('on ' + machine_name + ', available GPUs:' + str(deviceIDs) +
-                                           ', among visible ones:' + str(CUDA_VISIBLE_DEVICES))
-                else:
-                    basic.outputlogMessage('on ' + machine_name + ', available GPUs:' + str(deviceIDs))
-
-                if len(deviceIDs) < 1:
-                    time.sleep(5)  # wait 5 seconds, then check the available GPUs again
-                    continue
-                # set only the first available visible
-                gpuid = deviceIDs[0]
-                basic.outputlogMessage('%d: predict image %s on GPU %d of %s' % (idx, inf_img_list[idx], gpuid, machine_name))
-            else:
-                gpuid = None
-                basic.outputlogMessage('%d: predict image %s on %s' % (idx, inf_img_list[idx], machine_name))
-
-            # run inference
+        jobs = []
+        for idx in range(img_count):
             img_save_dir = os.path.join(area_save_dir, 'I%d' % idx)
             inf_list_file = os.path.join(area_save_dir, '%d.txt' % idx)
 
             done_indicator = '%s_done' % inf_list_file
             if os.path.isfile(done_indicator):
                 basic.outputlogMessage('warning, %s exist, skip prediction' % done_indicator)
-                idx += 1
                 continue
 
             # if it already exist, then skip
             if os.path.isdir(img_save_dir) and is_file_exist_in_folder(img_save_dir):
                 basic.outputlogMessage('folder of %dth image (%s) already exist, '
                                        'it has been predicted or is being predicted' % (idx, inf_img_list[idx]))
-                idx += 1
                 continue
 
             with open(inf_list_file, 'w') as inf_obj:
                 inf_obj.writelines(inf_img_list[idx] + '\n')
+            basic.outputlogMessage('%d: predict image %s on %s' % (idx, inf_img_list[idx], machine_name))
+            jobs.append((predict_one_image_yolo, (para_file,inf_img_list[idx], img_save_dir, inf_list_file),
+                         {'trained_model': trained_model}))
+
+        # start the next image as soon as a GPU slot is free
+        if scheduler is None:
+            scheduler = gpu_scheduler.GPUScheduler(gpu_scheduler.get_scheduler_gpus(b_use_multiGPUs, order='memory'),
+                                                   jobs_per_gpu=jobs_per_gpu, max_jobs=maximum_prediction_jobs)
+        if len(scheduler.run(jobs)) > 0:
+            sys.exit(1)
 
-            sub_process = Process(target=predict_one_image_yolo,
-                                  args=(para_file,inf_img_list[idx], img_save_dir, inf_list_file,
-                                        gpuid, trained_model))
-            sub_process.start()
-            sub_tasks.append(sub_process)
-
-            if b_use_multiGPUs is False:
-                # wait until previous one finished
-                while sub_process.is_alive():
-                    time.sleep(1)
-
-            idx += 1
-
-            # wait until predicted image patches exist or exceed 20 minutes
-            time0 = time.time()
-            elapsed_time = time.time() - time0
-            while elapsed_time < 20 * 60:
-                elapsed_time = time.time() - time0
-                file_exist = os.path.isdir(img_save_dir) and is_file_exist_in_folder(img_save_dir)
-                if file_exist is True or sub_process.is_alive() is False:
-                    break
-                else:
-                    time.sleep(1)
-
-            if sub_process.exitcode is not None and sub_process.exitcode != 0:
-                sys.exit(1)
-
-            close_remove_completed_task(sub_tasks)
-            # if 'chpc' in machine_name:
-            #     time.sleep(60)  # wait 60 second on ITSC services
-            # else:
-            #     time.sleep(10)
-
-    # check all the tasks already finished
-    wait_all_finish = 0
-    while b_all_task_finish(sub_tasks) is False:
-        if wait_all_finish % 100 == 0:
-            basic.outputlogMessage('wait all tasks to finish')
-        time.sleep(1)
-        wait_all_finish += 1
-
-    close_remove_completed_task(sub_tasks)
     end_time = datetime.now()
 
     diff_time = end_time - start_time
@@ -20,10 +20,10 @@ import basic_src.io_function as io_function
 import basic_src.basic as basic
 import datasets.split_image as split_image
 import datasets.raster_io as raster_io
+import workflow.gpu_scheduler as gpu_scheduler
+import datasets.detection_results as detection_results
 
 import json
-import GPUtil
-from multiprocessing import Process
 
 def is_file_exist_in_folder(folder):
     # just check if the folder is empty
@@ -43,17 +43,18 @@ def copy_one_patch_image_data(patch, entire_img_data):
     return patch_data
 
 
-def save_one_patch_yolov8_detection_json(patch_idx, patch, detections, class_names, save_dir, b_percent=False):
-    # patch (xoff,yoff ,xsize, ysize)
-    save_res_json = os.path.join(save_dir, '%d.json' % patch_idx)
-    objects = []
+def add_one_patch_yolov8_detections(patch_idx, patch, detections, det_buffer, b_percent=False):
+    # patch (xoff,yoff ,xsize, ysize), add the detected objects of a patch to det_buffer (DetectionBuffer)
+    class_id_list = []
+    confidence_list = []
+    out_bbox_list = []
     bbox_list = []
     boxes = detections.boxes.cpu().numpy()
     # xyxy:  box with xyxy format, (N, 4)
     for cls, confidence, bbox in zip( boxes.cls, boxes.conf, boxes.xyxy,):
         # print('cls, confidence, bbox',cls, confidence, bbox)
         # make sure # xmin >=0, ymin >=0, xmax<=xsize, ymax <= yszie
-        bbox = [max(bbox[0], 0), max(bbox[1], 0), min(bbox[2], patch[2]), min(bbox[3], patch[3])]
+        bbox = [max(float(bbox[0]), 0), max(float(bbox[1]), 0), min(float(bbox[2]), patch[2]), min(float(bbox[3]), patch[3])]
         # remove many duplicate boxes if exists
         if bbox in bbox_list:
             # print('remove duplicated')
@@ -71,20 +72,16 @@ def save_one_patch_yolov8_detection_json(patch_idx, patch, detections, class_nam
 
         if b_percent:
             confidence = round(confidence * 100, 2)
-        object = {'class_id': int(cls),
-                  'name': class_names[int(cls)],
-                  'bbox': bbox,
-                  'confidence': float(confidence)}
-        objects.append(object)
+        class_id_list.append(int(cls))
+        out_bbox_list.append(bbox)
+        confidence_list.append(float(confidence))
 
-    return objects
-    # json_data = json.dumps(objects, indent=2)
-    # with open(save_res_json, "w") as f_obj:
-    #     f_obj.write(json_data)
+    det_buffer.add(patch_idx, class_id_list, out_bbox_list, confidence_list)
 
 
 def predict_rs_image_yolo8(image_path, save_dir, model, ultralytics_dir,class_names,
-                           patch_w, patch_h, overlay_x, overlay_y, batch_size=1):
+                           patch_w, patch_h, overlay_x, overlay_y, batch_size=1, b_skip_invalid=False,
+                           b_streaming=False):
     sys.path.insert(0, ultralytics_dir)
     from ultralytics import YOLO
 
@@ -92,8 +89,15 @@ def predict_rs_image_yolo8(image_path, save_dir, model, ultralytics_dir,class_na
     # print('input image: height, width, band_num, date_type',height, width, band_num, date_type)
 
     # divide the image the many small patches, then calcuate one by one, solving memory issues.
-    image_patches = split_image.sliding_window(width, height, patch_w, patch_h, adj_overlay_x=overlay_x,
-                                               adj_overlay_y=overlay_y)
+    image_patches = split_image.sliding_window_array(width, height, patch_w, patch_h, adj_overlay_x=overlay_x,
+                                                     adj_overlay_y=overlay_y)
+    if b_skip_invalid:
+        # skip the patches without valid pixels (nodata)
+        image_patches = raster_io.get_valid_patches(image_path, image_patches)
+    if b_streaming:
+        # read patches row by row, then the cached strips can be reused
+        image_patches = split_image.sort_boundary_array_by_rows(image_patches)
+    image_patches = split_image.boundary_array_to_list(image_patches)
     patch_count = len(image_patches)
 
     if os.path.isdir(save_dir) is False:
@@ -105,18 +109,24 @@ def predict_rs_image_yolo8(image_path, save_dir, model, ultralytics_dir,class_na
     model = YOLO(model)
 
 
-    # read the entire image
-    entire_img_data, nodata = raster_io.read_raster_all_bands_np(image_path)
-    entire_img_data = entire_img_data.transpose(1, 2, 0)  # to opencv format
-    # # RGB to BGR: Matplotlib image to OpenCV https://www.scivision.dev/numpy-image-bgr-to-rgb/
-    entire_img_data = entire_img_data[..., ::-1].copy()
+    if b_streaming:
+        # read patches on demand, only keep a few row strips in memory
+        max_patch_h = max([item[3] for item in image_patches]) if patch_count > 0 else patch_h
+        entire_img_data = raster_io.RasterStripReader(image_path, min_rows=max_patch_h, b_bgr=True)
+    else:
+        # read the entire image
+        entire_img_data, nodata = raster_io.read_raster_all_bands_np(image_path)
+        entire_img_data = entire_img_data.transpose(1, 2, 0)  # to opencv format
+        # # RGB to BGR: Matplotlib image to OpenCV https://www.scivision.dev/numpy-image-bgr-to-rgb/
+        entire_img_data = entire_img_data[..., ::-1].copy()
     entire_height, entire_width, band_num = entire_img_data.shape
     print("entire_height, entire_width, band_num", entire_height, entire_width, band_num)
     if band_num not in [1, 3]:
         raise ValueError('only accept one band or three band images')
 
     patch_idx = 0
-    all_objects = []
+    # keep the detected objects of all patches in memory, save them to one file at the end
+    det_buffer = detection_results.DetectionBuffer(class_names)
     with open(os.path.join(save_dir,'started.txt'),'w') as f_obj:
         f_obj.writelines(str(datetime.now()) + ': The process has started')
     for b_idx, a_batch_patch in enumerate(batch_patches):
@@ -134,17 +144,18 @@ def predict_rs_image_yolo8(image_path, save_dir, model, ultralytics_dir,class_na
         det_results = model(images, stream=True)  # generator of Results objects
 
         # save results
-        objects = [save_one_patch_yolov8_detection_json(patch_idx + idx, patch, det_res,class_names, save_dir)
-         for idx, (patch, det_res) in enumerate(zip(a_batch_patch,det_results))]
-        [ all_objects.extend(item) for item in objects if len(item) > 0]   # ignore empty results
+        for idx, (patch, det_res) in enumerate(zip(a_batch_patch, det_results)):
+            add_one_patch_yolov8_detections(patch_idx + idx, patch, det_res, det_buffer)
 
 
         if b_idx % 100 == 0:
             print('Processed %d patch, total: %d, this batch costs %f second' % (patch_idx + batch_size, patch_count, time.time() - t0))
 
         patch_idx += len(a_batch_patch)
+    if b_streaming:
+        entire_img_data.close()
     print('Have obtained results of all patches')
-    return all_objects
+    return det_buffer
 
 def merge_patch_json_files_to_one(res_json_files, save_path):
     all_objects = []
@@ -175,23 +186,19 @@ def predict_remoteSensing_image(para_file, image_path, save_dir, model, network_
     overlay_x = parameters.get_digit_parameters(para_file, "inf_pixel_overlay_x", 'int')
     overlay_y = parameters.get_digit_parameters(para_file, "inf_pixel_overlay_y", 'int')
     object_names = parameters.get_string_list_parameters(para_file, 'object_names')
+    b_skip_invalid = parameters.get_bool_parameters_None_if_absence(para_file, 'b_inf_skip_invalid_patches')
+    # if not buffer the entire image in memory, read patches on demand
+    b_use_memory = parameters.get_bool_parameters_None_if_absence(para_file, 'b_inf_memory_buffer')
 
     ultralytics_dir = parameters.get_file_path_parameters(network_ini,'ultralytics_dir')
 
     # using the python API
-    all_objects = predict_rs_image_yolo8(image_path, save_dir, model, ultralytics_dir,object_names,
-                                     patch_w, patch_h, overlay_x, overlay_y, batch_size=batch_size)
-
-    # for each patch has a json file, may end up with a lot of json files, affect I/O
-    # try to merge them to one json file.
-    # res_json_files = io_function.get_file_list_by_ext('.json', save_dir, bsub_folder=False)
-    merge_josn_path = os.path.join(save_dir,'all_patches.json')
-    # merge_patch_json_files_to_one(res_json_files,merge_josn_path)
-    # for f_json in res_json_files:
-    #     io_function.delete_file_or_dir(f_json)
-    json_data = json.dumps(all_objects, indent=2)
-    with open(merge_josn_path, "w") as f_obj:
-        f_obj.write(json_data)
+    det_buffer = predict_rs_image_yolo8(image_path, save_dir, model, ultralytics_dir,object_names,
+                                     patch_w, patch_h, overlay_x, overlay_y, batch_size=batch_size,
+                                     b_skip_invalid=b_skip_invalid is True, b_streaming=b_use_memory is False)
+
+    # save the objects of all patches to one file, instead of one json file per patch
+    det_buffer.save(detection_results.get_detection_result_path(save_dir))
 
 
 
@@ -249,9 +256,13 @@ def parallel_prediction_main(para_file, trained_model):
     multi_inf_regions = parameters.get_string_list_parameters(para_file, 'inference_regions')
     b_use_multiGPUs = parameters.get_bool_parameters(para_file, 'b_use_multiGPUs')
     maximum_prediction_jobs = parameters.get_digit_parameters(para_file,'maximum_prediction_jobs','int')
+    # the number of images running on a GPU at the same time
+    jobs_per_gpu = parameters.get_digit_parameters_None_if_absence(para_file, 'inf_jobs_per_gpu', 'int')
+    if jobs_per_gpu is None:
+        jobs_per_gpu = 1
+    scheduler = None
 
     # loop each inference regions
-    sub_tasks = []
     for area_idx, area_ini in enumerate(multi_inf_regions):
 
         area_name = parameters.get_string_parameters(area_ini, 'area_name')
@@ -273,102 +284,35 @@ def parallel_prediction_main(para_file, trained_model):
         io_function.mkdir(area_save_dir)
 
         # parallel inference images for this area
-        CUDA_VISIBLE_DEVICES = []
-        if 'CUDA_VISIBLE_DEVICES' in os.environ.keys():
-            CUDA_VISIBLE_DEVICES = [int(item.strip()) for item in os.environ['CUDA_VISIBLE_DEVICES'].split(',')]
-        idx = 0
-        while idx < img_count:
-
-            while basic.alive_process_count(sub_tasks) >= maximum_prediction_jobs:
-                print(datetime.now(),'%d jobs are running simultaneously, wait 5 seconds'%basic.alive_process_count(sub_tasks))
-                time.sleep(5)   # wait 5 seconds, then check the count of running jobs again
-
-            if b_use_multiGPUs:
-                # get available GPUs  # https://github.com/anderskm/gputil
-                # memory: orders the available GPU device ids by ascending memory usage
-                deviceIDs = GPUtil.getAvailable(order='memory', limit=100, maxLoad=0.5,
-                                                maxMemory=0.5, includeNan=False, excludeID=[], excludeUUID=[])
-                # only use the one in CUDA_VISIBLE_DEVICES
-                if len(CUDA_VISIBLE_DEVICES) > 0:
-                    deviceIDs = [item for item in deviceIDs if item in CUDA_VISIBLE_DEVICES]
-                    basic.outputlogMessage('on ' + machine_name + ', available GPUs:' + str(deviceIDs) +
-                                           ', among visible ones:' + str(CUDA_VISIBLE_DEVICES))
-                else:
-                    basic.outputlogMessage('on ' + machine_name + ', available GPUs:' + str(deviceIDs))
-
-                if len(deviceIDs) < 1:
-                    time.sleep(5)  # wait 5 seconds, then check the available GPUs again
-                    continue
-                # set only the first available visible
-                gpuid = deviceIDs[0]
-                basic.outputlogMessage('%d: predict image %s on GPU %d of %s' % (idx, inf_img_list[idx], gpuid, machine_name))
-            else:
-                gpuid = None
-                basic.outputlogMessage('%d: predict image %s on %s' % (idx, inf_img_list[idx], machine_name))
-
-            # run inference
+        jobs = []
+        for idx in range(img_count):
             img_save_dir = os.path.join(area_save_dir, 'I%d' % idx)
             inf_list_file = os.path.join(area_save_dir, '%d.txt' % idx)
 
             done_indicator = '%s_done' % inf_list_file
             if os.path.isfile(done_indicator):
                 basic.outputlogMessage('warning, %s exist, skip prediction' % done_indicator)
-                idx += 1
                 continue
 
             # if it already exist, then skip
             if os.path.isdir(img_save_dir) and is_file_exist_in_folder(img_save_dir):
                 basic.outputlogMessage('folder of %dth image (%s) already exist, '
                                        'it has been predicted or is being predicted' % (idx, inf_img_list[idx]))
-                idx += 1
                 continue
 
             with open(inf_list_file, 'w') as inf_obj:
                 inf_obj.writelines(inf_img_list[idx] + '\n')
+            basic.outputlogMessage('%d: predict image %s on %s' % (idx, inf_img_list[idx], machine_name))
+            jobs.append((predict_one_image_yolov8, (para_file,inf_img_list[idx], img_save_dir, inf_list_file),
+                         {'trained_model': trained_model}))
+
+        # start the next image as soon as a GPU slot is free
+        if scheduler is None:
+            scheduler = gpu_scheduler.GPUScheduler(gpu_scheduler.get_scheduler_gpus(b_use_multiGPUs, order='memory'),
+                                                   jobs_per_gpu=jobs_per_gpu, max_jobs=maximum_prediction_jobs)
+        if len(scheduler.run(jobs)) > 0:
+            sys.exit(1)
 
-            sub_process = Process(target=predict_one_image_yolov8,
-                                  args=(para_file,inf_img_list[idx], img_save_dir, inf_list_file,
-                                        gpuid, trained_model))
-
-            sub_process.start()
-            sub_tasks.append(sub_process)
-
-            if b_use_multiGPUs is False:
-                # wait until previous one finished
-                while sub_process.is_alive():
-                    time.sleep(1)
-
-            idx += 1
-
-            # wait until predicted image patches exist or exceed 20 minutes
-            time0 = time.time()
-            elapsed_time = time.time() - time0
-            while elapsed_time < 20 * 60:
-                elapsed_time = time.time() - time0
-                file_exist = os.path.isdir(img_save_dir) and is_file_exist_in_folder(img_save_dir)
-                if file_exist is True or sub_process.is_alive() is False:
-                    break
-                else:
-                    time.sleep(1)
-
-            if sub_process.exitcode is not None and sub_process.exitcode != 0:
-                sys.exit(1)
-
-            basic.close_remove_completed_process(sub_tasks)
-            # if 'chpc' in machine_name:
-            #     time.sleep(60)  # wait 60 second on ITSC services
-            # else:
-            #     time.sleep(10)
-
-    # check all the tasks already finished
-    wait_all_finish = 0
-    while basic.b_all_process_finish(sub_tasks) is False:
-        if wait_all_finish % 100 == 0:
-            basic.outputlogMessage('wait all tasks to finish')
-        time.sleep(1)
-        wait_all_finish += 1
-
-    basic.close_remove_completed_process(sub_tasks)
     end_time = datetime.now()
 
     diff_time = end_time - start_time
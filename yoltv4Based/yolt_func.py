@@ -140,4 +140,107 @@ def non_max_suppression(boxes, probs=[], overlapThresh=0.5, b_geo=False):
             np.concatenate(([last], np.where(overlap > overlapThresh)[0])))
 
     print("  non-max suppression final boxes:", len(pick))
-    return pick
\ No newline at end of file
+    return pick
+
+def get_box_pairs_in_grid(boxes, cell_size):
+    '''
+    get the pairs of boxes falling in the same grid cell (candidates of overlapping boxes)
+    :param boxes: (N, 4) array, [[xmin, ymin, xmax, ymax], [...] ]
+    :param cell_size: the size of grid cells, should not smaller than the width and height of boxes,
+    then a box is in at most 2*2 cells
+    :return: two arrays of box indices (a < b), each pair only once
+    '''
+    col0 = np.floor(boxes[:, 0] / cell_size).astype(np.int64)
+    col1 = np.floor(boxes[:, 2] / cell_size).astype(np.int64)
+    row0 = np.floor(boxes[:, 1] / cell_size).astype(np.int64)
+    row1 = np.floor(boxes[:, 3] / cell_size).astype(np.int64)
+    col_min, row_min = col0.min(), row0.min()
+    col_count = int(col1.max() - col_min) + 2
+
+    box_ids, cell_keys = [], []
+    all_ids = np.arange(len(boxes))
+    for d_col in (0, 1):
+        for d_row in (0, 1):
+            sel = (col0 + d_col <= col1) & (row0 + d_row <= row1)
+            box_ids.append(all_ids[sel])
+            cell_keys.append((row0[sel] + d_row - row_min) * col_count + (col0[sel] + d_col - col_min))
+    box_ids = np.concatenate(box_ids)
+    cell_keys = np.concatenate(cell_keys)
+
+    # sort by cells, then boxes in the same cell are adjacent, pair each box with the following ones in its cell
+    order = np.argsort(cell_keys, kind='stable')
+    box_ids, cell_keys = box_ids[order], cell_keys[order]
+    _, group_start, group_count = np.unique(cell_keys, return_index=True, return_counts=True)
+    pair_a, pair_b = [], []
+    for offset in range(1, int(group_count.max())):
+        same_cell = cell_keys[:-offset] == cell_keys[offset:]
+        pair_a.append(box_ids[:-offset][same_cell])
+        pair_b.append(box_ids[offset:][same_cell])
+    if len(pair_a) < 1:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    pair_a, pair_b = np.concatenate(pair_a), np.concatenate(pair_b)
+    # two boxes may share more than one cell
+    pair_key = np.unique(np.minimum(pair_a, pair_b) * len(boxes) + np.maximum(pair_a, pair_b))
+    return pair_key // len(boxes), pair_key % len(boxes)
+
+
+def non_max_suppression_grid(boxes, probs, overlapThresh=0.5, b_geo=False, cell_size=None):
+    """
+    The same as non_max_suppression (a box is removed if the ratio of its area overlapped by a kept box
+    with higher probability is larger than overlapThresh), but only checks boxes in the same grid cells,
+    and computes overlaps of all candidate pairs at once, for many boxes (e.g. all boxes of a large image).
+    Boxes are checked from the highest probability to the lowest.
+    Arguments
+    ---------
+    boxes : np.array
+        Prediction boxes with the format: [[xmin, ymin, xmax, ymax], [...] ]
+    probs : np.array
+        Array of prediction scores or probabilities.
+    overlapThresh : float
+        minimum overlap to remove a box.  Defaults to ``0.5``.
+    b_geo: if boxes are georeferenced, no need to +1 for width and height
+    cell_size: the size of grid cells, None for the maximum width or height of boxes
+    Returns
+    -------
+    pick : np.array
+        Array of indices to keep (sorted by probabilities, descending)
+    """
+    boxes = np.asarray(boxes, dtype=np.float64)
+    if len(boxes) == 0:
+        return np.zeros(0, dtype=np.int64)
+    boxes = boxes[:, :4]
+    probs = np.asarray(probs, dtype=np.float64)
+    offset = 0 if b_geo else 1
+    area = (boxes[:, 2] - boxes[:, 0] + offset) * (boxes[:, 3] - boxes[:, 1] + offset)
+
+    # rank 0 is the box with the highest probability
+    order = np.argsort(-probs, kind='stable')
+    rank = np.empty(len(boxes), dtype=np.int64)
+    rank[order] = np.arange(len(boxes))
+
+    if cell_size is None:
+        cell_size = max(np.max(boxes[:, 2] - boxes[:, 0]), np.max(boxes[:, 3] - boxes[:, 1])) + offset
+    if cell_size <= 0:
+        cell_size = 1.0
+    pair_a, pair_b = get_box_pairs_in_grid(boxes, cell_size)
+    if len(pair_a) < 1:
+        return order
+
+    # hi: the box with higher probability, lo: the one may be removed
+    b_swap = rank[pair_a] > rank[pair_b]
+    hi = np.where(b_swap, pair_b, pair_a)
+    lo = np.where(b_swap, pair_a, pair_b)
+    w = np.maximum(0, np.minimum(boxes[hi, 2], boxes[lo, 2]) - np.maximum(boxes[hi, 0], boxes[lo, 0]) + offset)
+    h = np.maximum(0, np.minimum(boxes[hi, 3], boxes[lo, 3]) - np.maximum(boxes[hi, 1], boxes[lo, 1]) + offset)
+    sel = (w * h) / area[lo] > overlapThresh
+    hi, lo = hi[sel], lo[sel]
+
+    # a box is removed only if the box overlapping it is kept, check pairs in the order of the lower box,
+    # then the status of all the higher boxes is known
+    keep = np.ones(len(boxes), dtype=bool)
+    pair_order = np.argsort(rank[lo], kind='stable')
+    for h_idx, l_idx in zip(hi[pair_order].tolist(), lo[pair_order].tolist()):
+        if keep[h_idx]:
+            keep[l_idx] = False
+
+    return order[keep[order]]